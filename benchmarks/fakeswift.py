@@ -0,0 +1,253 @@
+"""
+Local Identity + CloudFiles Stand-in Server
+
+Serves just enough of the Rackspace identity (v2.0 tokens) and CloudFiles (Swift)
+APIs for rcbu.client.auth.Authentication and rcbu.cloud.files.CloudFiles:
+
+    POST /v2.0/tokens                   - token and service catalog
+    GET|HEAD /v1/AUTH_<dc>              - container listing / account metadata
+    GET|HEAD /v1/AUTH_<dc>/<container>  - object listing / container metadata
+    GET|HEAD /v1/AUTH_<dc>/<c>/<object> - object body (with Range support)
+
+Every container holds the same generated objects. Latency is added to every
+request and bodies are throttled to the configured bandwidth. A fraction of the
+CloudFiles requests can be refused with 503 (and Retry-After) to exercise the
+client retries.
+"""
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs, unquote
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote
+
+
+DEFAULT_REGIONS = ('DFW', 'ORD')
+DEFAULT_CONTAINERS = 10
+DEFAULT_OBJECTS = 1000
+DEFAULT_OBJECT_SIZE = 2 ** 20
+TOKEN_EXPIRES = '2099-01-01T00:00:00.000Z'
+
+
+class FakeCloudFilesConfig(object):
+    """
+    Contents and behaviour of the stand-in server
+    """
+
+    def __init__(self, regions=DEFAULT_REGIONS, containers=DEFAULT_CONTAINERS, objects=DEFAULT_OBJECTS, object_size=DEFAULT_OBJECT_SIZE, latency=0.0, bandwidth=0, error_rate=0.0, retry_after=None):
+        """
+          regions - data centers in the service catalog
+          containers - number of containers in every region
+          objects - number of objects in every container
+          object_size - size of every object in bytes
+          latency - seconds added before every response
+          bandwidth - bytes per second bodies are throttled to; 0 is unlimited
+          error_rate - fraction of the CloudFiles requests refused with 503
+          retry_after - optional Retry-After (seconds) sent with the refusals
+        """
+        self.regions = list(regions)
+        self.container_names = ['container-%04d' % index for index in range(containers)]
+        self.object_names = ['object-%08d' % index for index in range(objects)]
+        self.object_size = object_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.errors = 0
+        # Every object has the same body
+        pattern = b''.join(bytes(bytearray([index % 251])) for index in range(251))
+        self.body = (pattern * (object_size // len(pattern) + 1))[:object_size]
+        self.etag = hashlib.md5(self.body).hexdigest()
+        self.object_entries = []
+        for name in self.object_names:
+            self.object_entries.append({'name': name, 'bytes': object_size, 'hash': self.etag, 'content_type': 'application/octet-stream', 'last_modified': '2014-01-01T00:00:00.000000'})
+        self.container_entries = []
+        for name in self.container_names:
+            self.container_entries.append({'name': name, 'count': objects, 'bytes': objects * object_size})
+
+
+def FilterListing(entries, query):
+    """
+    Apply the Swift listing query parameters to a sorted list of entries
+    """
+    prefix = query.get('prefix', '')
+    marker = query.get('marker', '')
+    end_marker = query.get('end_marker', '')
+    delimiter = query.get('delimiter', '')
+    limit = int(query.get('limit', 10000))
+    results = []
+    for entry in entries:
+        name = entry['name']
+        if not name.startswith(prefix) or (len(marker) and name <= marker) or (len(end_marker) and name >= end_marker):
+            continue
+        if len(delimiter) and delimiter in name[len(prefix):]:
+            subdir = name[:name.index(delimiter, len(prefix)) + len(delimiter)]
+            if (len(marker) and subdir <= marker) or (len(results) and results[-1].get('subdir') == subdir):
+                continue
+            results.append({'subdir': subdir})
+        else:
+            results.append(entry)
+        if len(results) >= limit:
+            break
+    return results
+
+
+class FakeCloudFilesHandler(BaseHTTPRequestHandler):
+    """
+    Request handler for the stand-in server
+    """
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without this Nagle's algorithm
+    # and delayed ACKs add ~40ms to every small response
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        """Requests are not logged"""
+        pass
+
+    @property
+    def Config(self):
+        """Server configuration"""
+        return self.server.config
+
+    def __Send(self, code, body=b'', headers=None):
+        """
+        Send a response, throttling the body to the configured bandwidth
+        """
+        self.send_response(code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command == 'HEAD' or not len(body):
+            return
+        if not self.Config.bandwidth:
+            self.wfile.write(body)
+            return
+        block_size = max(1, self.Config.bandwidth // 100)
+        for offset in range(0, len(body), block_size):
+            self.wfile.write(body[offset:offset + block_size])
+            time.sleep(float(block_size) / self.Config.bandwidth)
+
+    def __Listing(self, entries, query, headers):
+        """
+        Send a JSON listing
+        """
+        results = FilterListing(entries, query)
+        if not len(results):
+            return self.__Send(204, b'', headers)
+        headers['Content-Type'] = 'application/json; charset=utf-8'
+        return self.__Send(200, json.dumps(results).encode('utf-8'), headers)
+
+    def do_POST(self):
+        """Identity: issue a token and service catalog"""
+        time.sleep(self.Config.latency)
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        base_uri = 'http://%s:%d/v1/AUTH_' % self.server.server_address[:2]
+        endpoints = []
+        for region in self.Config.regions:
+            endpoints.append({'region': region, 'publicURL': base_uri + region, 'internalURL': base_uri + region})
+        auth_data = {'access': {
+            'token': {'id': 'fake-token', 'expires': TOKEN_EXPIRES, 'tenant': {'id': '123456'}},
+            'serviceCatalog': [{'name': 'cloudFiles', 'endpoints': endpoints}]}}
+        self.__Send(200, json.dumps(auth_data).encode('utf-8'), {'Content-Type': 'application/json'})
+
+    def do_HEAD(self):
+        """CloudFiles: metadata"""
+        self.do_GET()
+
+    def do_GET(self):
+        """CloudFiles: listings and objects"""
+        time.sleep(self.Config.latency)
+        request_uri = urlparse(self.path)
+        query = dict((key, values[0]) for key, values in parse_qs(request_uri.query).items())
+        path = unquote(request_uri.path).split('/', 4)
+        if self.headers.get('X-Auth-Token') != 'fake-token':
+            return self.__Send(401)
+        if self.Config.error_rate and random.random() < self.Config.error_rate:
+            self.Config.errors += 1
+            headers = {}
+            if self.Config.retry_after is not None:
+                headers['Retry-After'] = str(self.Config.retry_after)
+            return self.__Send(503, b'', headers)
+
+        if len(path) == 3 or (len(path) == 4 and not len(path[3])):
+            headers = {}
+            headers['X-Account-Container-Count'] = str(len(self.Config.container_names))
+            headers['X-Account-Bytes-Used'] = str(sum(entry['bytes'] for entry in self.Config.container_entries))
+            return self.__Listing(self.Config.container_entries, query, headers)
+
+        if path[3] not in self.Config.container_names:
+            return self.__Send(404)
+        if len(path) == 4 or not len(path[4]):
+            headers = {}
+            headers['X-Container-Object-Count'] = str(len(self.Config.object_names))
+            headers['X-Container-Bytes-Used'] = str(len(self.Config.object_names) * self.Config.object_size)
+            return self.__Listing(self.Config.object_entries, query, headers)
+
+        return self.__Object(path[4])
+
+    def __Object(self, name):
+        """
+        Send an object body, or the requested range of it
+        """
+        if name not in self.Config.object_names:
+            return self.__Send(404)
+        body = self.Config.body
+        headers = {'ETag': self.Config.etag, 'Content-Type': 'application/octet-stream', 'Accept-Ranges': 'bytes'}
+        requested_range = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if requested_range is None:
+            return self.__Send(200, body, headers)
+        first = int(requested_range.group(1))
+        last = len(body) - 1
+        if len(requested_range.group(2)):
+            last = min(last, int(requested_range.group(2)))
+        if first > last:
+            return self.__Send(416)
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (first, last, len(body))
+        return self.__Send(206, body[first:last + 1], headers)
+
+
+class FakeCloudFilesServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded stand-in server
+    """
+    daemon_threads = True
+
+    def __init__(self, config, host='127.0.0.1', port=0):
+        """
+        Bind the server; port 0 picks a free port
+        """
+        HTTPServer.__init__(self, (host, port), FakeCloudFilesHandler)
+        self.config = config
+        self.thread = None
+
+    @property
+    def ApiHost(self):
+        """host:port of the server"""
+        return '%s:%d' % self.server_address[:2]
+
+    def Start(self):
+        """
+        Serve requests on a background thread
+        """
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def Stop(self):
+        """
+        Stop serving requests
+        """
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+Cloud Files Viewer Benchmarks
+
+Runs the client API against a local stand-in identity + CloudFiles server
+(see fakeswift.py) so that performance can be compared between changes
+without touching a real account:
+
+    python benchmarks/run_benchmarks.py --objects 20000 --latency 0.005 --output results.json
+
+Each benchmark is repeated and the min/median/mean/max time of the runs is
+reported along with its throughput; --output writes the results as JSON.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+# The client is imported from the source tree next to the benchmarks, so the path
+# has to be set up before the imports below
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from rcbu.client.auth import Authentication  # noqa: E402
+from rcbu.cloud.files import CloudFiles  # noqa: E402
+from rcbu.cloud import transfer  # noqa: E402
+from rcbu.common.command import Command  # noqa: E402
+
+import fakeswift  # noqa: E402
+
+
+BENCHMARKS = ('auth', 'containers', 'objects', 'download', 'download-ranged')
+
+
+def summarize(name, timings, units, unit_name):
+    """
+    Summarize the timings of the runs of a benchmark
+      name - benchmark name
+      timings - list of seconds taken by each run
+      units - amount of work done by each run (requests, entries, bytes)
+      unit_name - name of the units of work
+    """
+    ordered = sorted(timings)
+    median = ordered[len(ordered) // 2]
+    if not len(ordered) % 2:
+        median = (ordered[len(ordered) // 2 - 1] + median) / 2.0
+    result = {}
+    result['name'] = name
+    result['runs'] = len(timings)
+    result['timings'] = timings
+    result['min'] = ordered[0]
+    result['median'] = median
+    result['mean'] = sum(timings) / len(timings)
+    result['max'] = ordered[-1]
+    result['units'] = units
+    result['unit-name'] = unit_name
+    result['throughput'] = 0.0
+    if median > 0:
+        result['throughput'] = units / median
+    return result
+
+
+def time_runs(repeat, run):
+    """
+    Time repeat calls of run()
+    """
+    timings = []
+    for _ in range(repeat):
+        start_time = time.time()
+        run()
+        timings.append(time.time() - start_time)
+    return timings
+
+
+class Benchmarks(object):
+    """
+    The benchmarks, all run against the same stand-in server
+    """
+
+    def __init__(self, server, arguments):
+        """
+          server - running fakeswift.FakeCloudFilesServer
+          arguments - parsed command-line arguments
+        """
+        self.server = server
+        self.arguments = arguments
+        self.auth_engine = Authentication('benchmark', 'benchmark', apihost=server.ApiHost, sslenabled=False)
+        self.auth_engine.AuthToken
+        self.cloudfiles = CloudFiles(False, self.auth_engine)
+        region = server.config.regions[0]
+        self.uri = self.auth_engine.GetCloudFilesUri(region)[0]['uri'].split('://', 1)[-1]
+        self.container = server.config.container_names[0]
+        self.object_data = dict(server.config.object_entries[0])
+        self.target_dir = tempfile.mkdtemp(prefix='cloudfiles-benchmark-')
+
+    def Close(self):
+        """
+        Remove the downloaded files
+        """
+        shutil.rmtree(self.target_dir, ignore_errors=True)
+
+    def Auth(self):
+        """Time to authenticate and retrieve the service catalog"""
+        def run():
+            auth_engine = Authentication('benchmark', 'benchmark', apihost=self.server.ApiHost, sslenabled=False)
+            auth_engine.GetCloudFilesUri(self.server.config.regions[0])
+        return summarize('auth', time_runs(self.arguments.repeat, run), 1, 'requests')
+
+    def Containers(self):
+        """Time to page through the container listing"""
+        def run():
+            count = 0
+            for _ in self.cloudfiles.IterContainers(self.uri, limit=self.arguments.page_size):
+                count += 1
+            assert count == len(self.server.config.container_names), 'container listing incomplete'
+        return summarize('containers', time_runs(self.arguments.repeat, run), len(self.server.config.container_names), 'entries')
+
+    def Objects(self):
+        """Time to page through an object listing"""
+        def run():
+            count = 0
+            for _ in self.cloudfiles.IterContainerObjects(self.uri, self.container, limit=self.arguments.page_size):
+                count += 1
+            assert count == len(self.server.config.object_names), 'object listing incomplete'
+        return summarize('objects', time_runs(self.arguments.repeat, run), len(self.server.config.object_names), 'entries')
+
+    def __Download(self, name, **download_options):
+        """
+        Time to download (and verify) a single object
+        """
+        localpath = os.path.join(self.target_dir, name)
+
+        def run():
+            self.cloudfiles.DownloadObject(self.uri, self.container, dict(self.object_data), localpath, **download_options)
+        return summarize(name, time_runs(self.arguments.repeat, run), self.server.config.object_size, 'bytes')
+
+    def Download(self):
+        """Single stream download throughput"""
+        return self.__Download('download', digests=self.arguments.digests, io_mode=self.arguments.io_mode)
+
+    def DownloadRanged(self):
+        """Parallel ranged download throughput"""
+        part_size = max(1, self.server.config.object_size // self.arguments.download_concurrency)
+        return self.__Download('download-ranged', part_size=part_size, concurrency=self.arguments.download_concurrency, digests=self.arguments.digests, io_mode=self.arguments.io_mode)
+
+    def Run(self, names):
+        """
+        Run the named benchmarks in order
+        """
+        benchmarks = {
+            'auth': self.Auth,
+            'containers': self.Containers,
+            'objects': self.Objects,
+            'download': self.Download,
+            'download-ranged': self.DownloadRanged
+        }
+        results = []
+        for name in names:
+            results.append(benchmarks[name]())
+        return results
+
+
+def main():
+    """
+    Run the benchmarks
+    """
+    argument_parser = argparse.ArgumentParser(description='Cloud Files Viewer Benchmarks')
+    argument_parser.add_argument('--benchmark', action='append', choices=BENCHMARKS, help='Benchmark to run; may be repeated (default: all)')
+    argument_parser.add_argument('--repeat', type=int, default=5, help='Number of times each benchmark is run')
+    argument_parser.add_argument('--containers', type=int, default=fakeswift.DEFAULT_CONTAINERS, help='Number of containers on the server')
+    argument_parser.add_argument('--objects', type=int, default=fakeswift.DEFAULT_OBJECTS, help='Number of objects in each container')
+    argument_parser.add_argument('--object-size', type=int, default=fakeswift.DEFAULT_OBJECT_SIZE, help='Size of each object in bytes')
+    argument_parser.add_argument('--latency', type=float, default=0.0, help='Seconds the server waits before each response')
+    argument_parser.add_argument('--bandwidth', type=int, default=0, help='Bytes per second each response body is throttled to (0: unlimited)')
+    argument_parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of the CloudFiles requests the server refuses with 503')
+    argument_parser.add_argument('--page-size', type=int, default=1000, help='Listing page size')
+    argument_parser.add_argument('--download-concurrency', type=int, default=4, help='Number of parts downloaded at the same time by download-ranged')
+    argument_parser.add_argument('--digests', default='md5+sha1', help='Digests computed during downloads')
+    argument_parser.add_argument('--io-mode', default=transfer.DEFAULT_IO_MODE, choices=transfer.IO_CHOICES, help='How downloads are moved to disk')
+    argument_parser.add_argument('--output', default=None, help='Write the results as JSON to this file')
+    argument_parser.add_argument('--verbose', action='store_true', help='Log the client API calls')
+    arguments = argument_parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if arguments.verbose else logging.WARNING)
+
+    config = fakeswift.FakeCloudFilesConfig(containers=arguments.containers, objects=arguments.objects, object_size=arguments.object_size, latency=arguments.latency, bandwidth=arguments.bandwidth, error_rate=arguments.error_rate)
+    server = fakeswift.FakeCloudFilesServer(config)
+    server.Start()
+    benchmarks = Benchmarks(server, arguments)
+    try:
+        results = benchmarks.Run(arguments.benchmark or BENCHMARKS)
+    finally:
+        benchmarks.Close()
+        server.Stop()
+
+    print('{0:<16} {1:>6} {2:>10} {3:>10} {4:>10} {5:>16}'.format('benchmark', 'runs', 'min (s)', 'median (s)', 'max (s)', 'throughput'))
+    for result in results:
+        print('{0:<16} {1:>6} {2:>10.4f} {3:>10.4f} {4:>10.4f} {5:>10.1f} {6}/s'.format(
+            result['name'], result['runs'], result['min'], result['median'], result['max'], result['throughput'], result['unit-name']))
+
+    if arguments.output is not None:
+        report = {}
+        report['python'] = platform.python_version()
+        report['platform'] = platform.platform()
+        report['time'] = time.time()
+        report['server'] = {
+            'containers': arguments.containers,
+            'objects': arguments.objects,
+            'object-size': arguments.object_size,
+            'latency': arguments.latency,
+            'bandwidth': arguments.bandwidth,
+            'error-rate': arguments.error_rate,
+            'errors': config.errors
+        }
+        report['connections'] = Command.ConnectionStats()
+        report['limiters'] = Command.LimiterStats()
+        report['requests'] = Command.Metrics().Snapshot()
+        report['results'] = results
+        with open(arguments.output, 'w') as output_file:
+            json.dump(report, output_file, indent=4, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
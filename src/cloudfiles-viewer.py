@@ -3,30 +3,80 @@ Rackspace CloudFiles Viewer
 """
 from __future__ import print_function
 
+import sys
+
+from rcbu import cli
+
+# The scriptable commands (see rcbu.cli) skip the imports and setup of the viewer
+if __name__ == "__main__" and cli.IsCommand(sys.argv[1:]):
+    sys.exit(cli.Main(sys.argv[1:]))
+
 import os
 import json
-import sys
 import logging
 import logging.config
 import argparse 
+import atexit
+import select
+import signal
+
+import requests
 
 from rcbu.client.auth import Authentication
 from rcbu.cloud.files import CloudFiles
+from rcbu.cloud import bulk
+from rcbu.cloud import cache
+from rcbu.cloud import downloads
+from rcbu.cloud import index
+from rcbu.cloud import listing
+from rcbu.cloud import manifest
+from rcbu.cloud import query
+from rcbu.cloud import regions
+from rcbu.cloud import sync
+from rcbu.cloud import transfer
+from rcbu.cloud import usage
+from rcbu.common import command
+from rcbu.common import metrics
+from rcbu.common import retry
+from rcbu.common.command import Command
+
+# Answers to prompt_download()
+DOWNLOAD_NOW = 'now'
+DOWNLOAD_QUEUE = 'queue'
+# Seconds between redraws of the background download progress
+DOWNLOAD_REFRESH_INTERVAL = 0.5
 
 
-def prompt_get_data_centers(auth_engine):
+def format_latency(cf_probe_result):
+    """
+    Describe the latency of an endpoint probe result (see rcbu.cloud.regions.EndpointProbe)
+    """
+    if cf_probe_result is None or cf_probe_result['latency'] is None:
+        return 'unreachable'
+    return '{0:.0f} ms'.format(cf_probe_result['latency'] * 1000.0)
+
+
+def prompt_get_data_centers(auth_engine, cf_probe=None):
     """
     Prompt the user to select a data center
 
-    Returns either:
-        NULL string to denote the user cancelled the operation
-        Data center name
+    cf_probe - optional rcbu.cloud.regions.EndpointProbe; when provided the latency of each
+               data center is shown and the fastest endpoint is offered as the first choice
+
+    Returns a tuple of either:
+        NULL strings to denote the user cancelled the operation
+        Data center name and a NULL string (the network is still to be selected)
+        Data center name and URI of the fastest endpoint
     """
     # Access the list of DCs from the service catalog
     cf_dcs = auth_engine.GetCloudFilesDataCenters()
+    cf_fastest = None
+    if cf_probe is not None:
+        cf_fastest = cf_probe.Fastest()
 
     found_dc = False
     return_dc = ''
+    return_uri = ''
     #
     #   Access the list of datacenters from the service catalog
     #   Allow the user to either select one or cancel the operation
@@ -37,7 +87,17 @@ def prompt_get_data_centers(auth_engine):
         print('Found Cloud Files Data Centers:')
         dc_counter = 0
         for dc in cf_dcs:
-            print('\t' + str(dc_counter) + ') ' + dc)
+            if cf_probe is not None:
+                print('\t' + str(dc_counter) + ') ' + dc + ' (' + format_latency(cf_probe.Fastest(dc)) + ')')
+            else:
+                print('\t' + str(dc_counter) + ') ' + dc)
+            dc_counter += 1
+
+        # Add the fastest endpoint entry
+        fastest_selection = -1
+        if cf_fastest is not None:
+            print('\t' + str(dc_counter) + ') fastest endpoint: ' + cf_fastest['region'] + ' ' + cf_fastest['network'] + ' (' + format_latency(cf_fastest) + ')')
+            fastest_selection = dc_counter
             dc_counter += 1
 
         # Add cancel entry
@@ -46,7 +106,12 @@ def prompt_get_data_centers(auth_engine):
         # Handle user input
         try:
             dc_selection = input('Please select data center: ')
-            if dc_selection >= 0 and dc_selection < dc_counter:
+            if fastest_selection >= 0 and dc_selection is fastest_selection:
+                # Fastest endpoint; no network to select
+                return_dc = cf_fastest['region']
+                return_uri = cf_fastest['uri']
+                found_dc = True
+            elif dc_selection >= 0 and dc_selection < len(cf_dcs):
                 # List selection
                 return_dc = cf_dcs[dc_selection]
                 found_dc = True
@@ -63,13 +128,16 @@ def prompt_get_data_centers(auth_engine):
             print('Invalid selection.')
             found_dc = False
 
-    return return_dc
+    return (return_dc, return_uri)
 
 
-def prompt_get_uri(auth_engine, dc):
+def prompt_get_uri(auth_engine, dc, cf_probe=None):
     """
     Prompt the user to select a uri (public or snet)
 
+    cf_probe - optional rcbu.cloud.regions.EndpointProbe; when provided the latency of each
+               network is shown
+
     Returns either:
         NULL string to denote the user cancelled the operation
         URI for the CloudFiles Network Access
@@ -89,7 +157,10 @@ def prompt_get_uri(auth_engine, dc):
         print('Available CloudFile Networks for ' + dc + ':')
         uri_counter = 0
         for uri in cf_uris:
-            print('\t' + str(uri_counter) + ') ' + uri['name'] + ' - ' + uri['uri'])
+            if cf_probe is not None:
+                print('\t' + str(uri_counter) + ') ' + uri['name'] + ' - ' + uri['uri'] + ' (' + format_latency(cf_probe.Fastest(dc, uri['name'])) + ')')
+            else:
+                print('\t' + str(uri_counter) + ') ' + uri['name'] + ' - ' + uri['uri'])
             uri_counter += 1
 
         # Add the cancel entry
@@ -117,24 +188,103 @@ def prompt_get_uri(auth_engine, dc):
 
     return return_uri
 
-def prompt_get_container(cloudfiles_engine, cf_container_uri, cf_container_limit=10):
+def refresh_listing_cache(cloudfiles_engine, cf_cache, cf_region, cf_container_uri, cf_container=cache.ACCOUNT_LISTING):
+    """
+    Bring the cached listing of a container (or of the account's containers) up to date
+
+    Returns False if the listing could not be validated and must be retrieved from CloudFiles
+    """
+    try:
+        cf_cache.Refresh(cloudfiles_engine, cf_region, cf_container_uri, cf_container)
+        return True
+    except UserWarning as ex:
+        print(str(ex))
+        return False
+
+
+def fetch_listing_page(cloudfiles_engine, cf_container_uri, cf_container, cf_limit, cf_marker, cf_cache=None, cf_region='', cf_pattern=None):
+    """
+    Retrieve a page of containers (cf_container is cache.ACCOUNT_LISTING) or of objects
+
+    Pages are served from cf_cache when it is provided; otherwise they are retrieved from CloudFiles
+
+    Raises UserWarning if the listing could not be retrieved
+    """
+    if cf_cache is not None:
+        return cf_cache.GetPage(str(cloudfiles_engine.authenticator.AuthId), cf_region, cf_container, cf_limit, cf_marker, cf_pattern)
+    if cf_container == cache.ACCOUNT_LISTING:
+        return cloudfiles_engine.GetContainers(cf_container_uri, cf_limit, cf_marker)
+    else:
+        return cloudfiles_engine.GetContainerObjects(cf_container_uri, cf_container, cf_limit, cf_marker)
+
+
+def get_listing_page(cloudfiles_engine, cf_container_uri, cf_container, cf_limit, cf_marker, cf_cache=None, cf_region='', cf_pattern=None):
+    """
+    Retrieve a page of containers or of objects (see fetch_listing_page)
+
+    An empty page is returned if the listing could not be retrieved
+    """
+    try:
+        return fetch_listing_page(cloudfiles_engine, cf_container_uri, cf_container, cf_limit, cf_marker, cf_cache, cf_region, cf_pattern)
+    except UserWarning as ex:
+        print(str(ex))
+        return []
+
+
+def open_listing_pages(cloudfiles_engine, cf_container_uri, cf_container, cf_limit, cf_cache=None, cf_region='', cf_pattern=None, cf_read_ahead=listing.DEFAULT_READ_AHEAD):
+    """
+    Page through containers or objects (see fetch_listing_page), retrieving the next
+    cf_read_ahead pages in the background while a page is shown
+
+    Returns an rcbu.cloud.listing.PagedListing; Close() it when done
+    """
+    # Pages are retrieved on a background thread and CloudFiles instances are not thread-safe
+    cf_lister = CloudFiles(cloudfiles_engine.sslenabled, cloudfiles_engine.authenticator)
+
+    def fetch(limit, marker):
+        return fetch_listing_page(cf_lister, cf_container_uri, cf_container, limit, marker, cf_cache, cf_region, cf_pattern)
+
+    return listing.PagedListing(fetch, cf_limit, cf_read_ahead)
+
+
+def get_listing_pages_page(cf_pages, cf_page_number):
+    """
+    Retrieve a page of an rcbu.cloud.listing.PagedListing
+
+    An empty page is returned if the listing could not be retrieved
+    """
+    try:
+        return cf_pages.Page(cf_page_number)
+    except (UserWarning, requests.exceptions.RequestException) as ex:
+        print(str(ex))
+        return []
+
+
+def prompt_get_container(cloudfiles_engine, cf_container_uri, cf_container_limit=10, cf_cache=None, cf_region='', cf_read_ahead=listing.DEFAULT_READ_AHEAD):
     """
     Prompt the user to select a container in Cloud Files
-    
+
+    cf_cache - optional rcbu.cloud.cache.ListingCache to serve the listing from
+    cf_region - data center of cf_container_uri; required with cf_cache
+    cf_read_ahead - number of pages retrieved in the background ahead of the page shown
+
     Returns either:
         NULL string to denote the user cancelled the operation
         Container name
     """
-    cf_container_marker = ''
+    if cf_cache is not None and not refresh_listing_cache(cloudfiles_engine, cf_cache, cf_region, cf_container_uri):
+        cf_cache = None
+    cf_pages = open_listing_pages(cloudfiles_engine, cf_container_uri, cache.ACCOUNT_LISTING, cf_container_limit, cf_cache, cf_region, cf_read_ahead=cf_read_ahead)
+    cf_page_number = 0
     return_container = ''
     continue_container_search = True
     #
     #   Access the list of containers up to cf_container_limit in size
-    #   List access must be repeated if the user wants more containers listed
+    #   The following pages are retrieved in the background while a page is shown
     #
     while continue_container_search:
         # Access the list of containers for the user in cloud files
-        cf_containers = cloudfiles_engine.GetContainers(cf_container_uri, cf_container_limit, cf_container_marker)
+        cf_containers = get_listing_pages_page(cf_pages, cf_page_number)
 
         found_container = False
         #
@@ -150,11 +300,18 @@ def prompt_get_container(cloudfiles_engine, cf_container_uri, cf_container_limit
 
             # Determine if we need to provide the user the option to get more containers
             has_more_containers = False
-            if len(cf_containers) and len(cf_containers) == cf_container_limit:
+            if len(cf_containers) and cf_pages.HasNext(cf_page_number):
                 print('\t' + str(container_counter) + ') Check for more containers')
                 has_more_containers = True
                 container_counter += 1
-            
+
+            # Earlier pages are usually still kept
+            previous_selection = -1
+            if cf_page_number > 0:
+                print('\t' + str(container_counter) + ') Previous containers (page ' + str(cf_page_number) + ')')
+                previous_selection = container_counter
+                container_counter += 1
+
             # Add the cancel operation
             print('\t' + str(container_counter) + ') return to previous menu')
 
@@ -166,12 +323,17 @@ def prompt_get_container(cloudfiles_engine, cf_container_uri, cf_container_limit
                     return_container = ''
                     found_container = True              # Exit inner loop
                     continue_container_search = False   # Exit outer loop
+                elif previous_selection >= 0 and container_selection is previous_selection:
+                    # Go back a page
+                    cf_page_number -= 1
+                    found_container = True              # Exit inner loop
+                    continue_container_search = True    # Continue outer loop
                 elif container_selection >= 0 and container_selection < container_counter:
                     # If there are more containers than len(cf_containers) is a phantom object that represents
                     #   the user request for more containers.
                     if has_more_containers and container_selection is len(cf_containers):
                         # Request more containers
-                        cf_container_marker = cf_containers[len(cf_containers)-1]['name']
+                        cf_page_number += 1
                         found_container = True              # Exit inner loop
                         continue_container_search = True    # Continue outer loop
                     else:
@@ -190,36 +352,276 @@ def prompt_get_container(cloudfiles_engine, cf_container_uri, cf_container_limit
                 print('Invalid selection.')
                 found_container = False                 # Repeat inner loop
                 containue_container_search = True       # Repeat outer loop
+    cf_pages.Close()
     return return_container
 
 
-def prompt_download():
+def prompt_download(cf_allow_queue=False):
     """
-    Ask the user if they want to download the object
+    Ask the user if they want to download the object, now or (when cf_allow_queue) in the background
+
+    Returns DOWNLOAD_NOW, DOWNLOAD_QUEUE or None
     """
     while True:
-        result = raw_input('Download? [y/n]')
+        if cf_allow_queue:
+            result = raw_input('Download? [y/n/q (in the background)]')
+        else:
+            result = raw_input('Download? [y/n]')
         if result == 'y' or result == 'Y':
-            return True
+            return DOWNLOAD_NOW
+        elif cf_allow_queue and (result == 'q' or result == 'Q'):
+            return DOWNLOAD_QUEUE
         elif result == 'n' or result == 'N':
-            return False
+            return None
         else:
             print('Invalid input. Please try again')
 
 
-def prompt_list_container(cloudfiles_engine, cf_container_uri, cf_container, cf_object_limit=10):
+def prompt_search_pattern():
+    """
+    Ask the user for a glob pattern to search object names with
+
+    Returns None to clear the search
+    """
+    result = raw_input('Search for objects matching (glob, empty to show all): ')
+    if not len(result):
+        return None
+    return result
+
+
+def show_object(cloudfiles_engine, cf_container_uri, cf_container, cf_object, cf_download_options, cf_downloads=None):
+    """
+    Show the details of an object and offer to download it
+
+    cf_downloads - optional rcbu.cloud.downloads.DownloadQueue to offer downloading in the background with
+    """
+    # List information about the object
+    print('\t\tName: ' + cf_object['name'])
+    print('\t\tSize: ' + str(cf_object['bytes']) + ' bytes')
+    print('\t\tContent-Type: ' + cf_object.get('content_type', ''))
+    print('\t\tLast Modified: ' + cf_object.get('last_modified', ''))
+    print('\t\tHash: ' + cf_object.get('hash', ''))
+
+    download_mode = prompt_download(cf_downloads is not None)
+    target_location = os.getcwd() + '/' + cf_object['name']
+    if download_mode == DOWNLOAD_NOW:
+        cloudfiles_engine.DownloadObject(cf_container_uri, cf_container, cf_object, target_location, **cf_download_options)
+    elif download_mode == DOWNLOAD_QUEUE:
+        cf_downloads.Add(cf_container_uri, cf_container, cf_object, target_location)
+        print('\tQueued; ' + str(cf_downloads.Pending()) + ' downloads in progress')
+
+    # Wait for the user
+    try:
+        input('\tPress ENTER to continue')
+    except SyntaxError:
+        pass
+
+
+def show_download_queue(cf_downloads, cf_interval=DOWNLOAD_REFRESH_INTERVAL, cf_wait=False):
+    """
+    Show the progress of the background downloads, redrawn every cf_interval seconds
+
+    The display is left when the user presses ENTER or, with cf_wait, once every download is finished
+    """
+    # Waiting for ENTER while redrawing needs a terminal that can be polled
+    cf_interactive = sys.stdout.isatty() and sys.stdin.isatty() and hasattr(select, 'poll')
+    cf_width = int(os.environ.get('COLUMNS', 80)) - 1
+    if cf_interactive:
+        cf_poll = select.poll()
+        cf_poll.register(sys.stdin, select.POLLIN)
+    if not cf_wait:
+        print('Press ENTER to return to the menu')
+    cf_lines = 0
+    while True:
+        objects, totals = cf_downloads.Snapshot()
+        cf_text = downloads.FormatSnapshot(objects, totals, cf_width)
+        if cf_interactive and cf_lines:
+            # Move back over the previous display and clear it
+            sys.stdout.write('\x1b[' + str(cf_lines) + 'F\x1b[J')
+        print('\n'.join(cf_text))
+        sys.stdout.flush()
+        cf_lines = len(cf_text)
+        if cf_wait:
+            if not totals['pending']:
+                return
+            cf_downloads.Wait(cf_interval)
+        elif cf_interactive:
+            if len(cf_poll.poll(cf_interval * 1000)):
+                sys.stdin.readline()
+                return
+        else:
+            # Show the progress once
+            try:
+                raw_input('')
+            except EOFError:
+                pass
+            return
+
+
+def build_object_index(cloudfiles_engine, cf_container_uri, cf_container, cf_cache=None, cf_region=''):
+    """
+    List every object in a container into an rcbu.cloud.index.ObjectIndex
+
+    The listing is read from cf_cache when it is provided; otherwise from CloudFiles
+    """
+    print('Indexing the objects in ' + cf_container + '...')
+    if cf_cache is None:
+        cf_index = index.ObjectIndex.FromListing(cloudfiles_engine.IterContainerObjects(cf_container_uri, cf_container))
+    else:
+        cf_index = index.ObjectIndex()
+        cf_marker = ''
+        while True:
+            cf_objects = get_listing_page(cloudfiles_engine, cf_container_uri, cf_container, 10000, cf_marker, cf_cache, cf_region)
+            cf_index.Extend(cf_objects)
+            if len(cf_objects) < 10000:
+                break
+            cf_marker = cf_objects[len(cf_objects)-1]['name']
+    print('\tIndexed ' + str(len(cf_index)) + ' objects')
+    return cf_index
+
+
+def prompt_sort_order():
+    """
+    Ask the user how to order the objects
+
+    Returns a tuple of the sort key (see rcbu.cloud.index.SORT_CHOICES) and whether it is descending
+    """
+    while True:
+        result = raw_input('Sort by (' + '/'.join(index.SORT_CHOICES) + '; prefix with - for descending): ')
+        descending = result.startswith('-')
+        if result.lstrip('-') in index.SORT_CHOICES:
+            return (result.lstrip('-'), descending)
+        print('Invalid input. Please try again')
+
+
+def print_index_stats(cf_index, cf_positions):
+    """
+    Print the aggregate statistics of the indexed objects (or of the search results in cf_positions)
+    """
+    stats = cf_index.Stats(cf_positions)
+    print('\tObjects: ' + str(stats['objects']))
+    print('\tTotal Size: ' + str(stats['bytes']) + ' bytes')
+    if stats['objects']:
+        print('\tOldest: ' + index.FormatLastModified(stats['oldest']))
+        print('\tNewest: ' + index.FormatLastModified(stats['newest']))
+    print('\tLargest objects:')
+    for position in cf_index.Largest(10, cf_positions):
+        print('\t\t' + cf_index.Name(position) + ' (Size: ' + str(cf_index.sizes[position]) + ' bytes)')
+    if cf_positions is None:
+        print('\tUsage by pseudo-directory:')
+        for prefix, count, size in cf_index.PrefixUsage():
+            print('\t\t' + (prefix or '(top level)') + ': ' + str(count) + ' objects, ' + str(size) + ' bytes')
+    try:
+        input('\tPress ENTER to continue')
+    except SyntaxError:
+        pass
+
+
+def prompt_browse_index(cloudfiles_engine, cf_container_uri, cf_container, cf_index, cf_object_limit=10, cf_download_options=None, cf_downloads=None):
+    """
+    Browse an rcbu.cloud.index.ObjectIndex of a container: search, sort, statistics and downloads
+
+    cf_downloads - optional rcbu.cloud.downloads.DownloadQueue to queue downloads with
+    """
+    if cf_download_options is None:
+        cf_download_options = {}
+    cf_positions = None
+    cf_sort = (index.SORT_NAME, False)
+    cf_ordered = cf_index.Sorted(cf_sort[0], cf_sort[1])
+    cf_start = 0
+    continue_browsing = True
+    while continue_browsing:
+        cf_page = cf_ordered[cf_start:cf_start + cf_object_limit]
+
+        # List the page of objects
+        object_counter = 0
+        for position in cf_page:
+            print('\t' + str(object_counter) + ') ' + cf_index.Name(position) + ' (Size: ' + str(cf_index.sizes[position]) + ' bytes, Modified: ' + index.FormatLastModified(cf_index.mtimes[position]) + ')')
+            object_counter += 1
+
+        more_selection = -1
+        if cf_start + cf_object_limit < len(cf_ordered):
+            print('\t' + str(object_counter) + ') Show more objects (' + str(len(cf_ordered) - cf_start - cf_object_limit) + ' remaining)')
+            more_selection = object_counter
+            object_counter += 1
+        search_selection = object_counter
+        print('\t' + str(object_counter) + ') Search objects')
+        object_counter += 1
+        sort_selection = object_counter
+        print('\t' + str(object_counter) + ') Sort objects')
+        object_counter += 1
+        stats_selection = object_counter
+        print('\t' + str(object_counter) + ') Statistics')
+        object_counter += 1
+        downloads_selection = -1
+        if cf_downloads is not None:
+            downloads_selection = object_counter
+            print('\t' + str(object_counter) + ') Show downloads (' + str(cf_downloads.Pending()) + ' in progress)')
+            object_counter += 1
+
+        # Add the cancel operation
+        print('\t' + str(object_counter) + ') return to previous menu')
+
+        # Handle user input
+        try:
+            object_selection = input('Please select object: ')
+            if object_selection is object_counter:
+                # Cancel operation
+                continue_browsing = False
+            elif more_selection >= 0 and object_selection is more_selection:
+                cf_start += cf_object_limit
+            elif object_selection is search_selection:
+                cf_pattern = prompt_search_pattern()
+                if cf_pattern is None:
+                    cf_positions = None
+                else:
+                    cf_positions = cf_index.Search(cf_pattern)
+                    print('\tFound ' + str(len(cf_positions)) + ' objects')
+                cf_ordered = cf_index.Sorted(cf_sort[0], cf_sort[1], cf_positions)
+                cf_start = 0
+            elif object_selection is sort_selection:
+                cf_sort = prompt_sort_order()
+                cf_ordered = cf_index.Sorted(cf_sort[0], cf_sort[1], cf_positions)
+                cf_start = 0
+            elif object_selection is stats_selection:
+                print_index_stats(cf_index, cf_positions)
+            elif downloads_selection >= 0 and object_selection is downloads_selection:
+                show_download_queue(cf_downloads)
+            elif object_selection >= 0 and object_selection < len(cf_page):
+                show_object(cloudfiles_engine, cf_container_uri, cf_container, cf_index.Entry(cf_page[object_selection]), cf_download_options, cf_downloads)
+            else:
+                # Invalid selection
+                print('Invalid selection')
+        except SyntaxError:
+            # Invalid selection through exception handling from input()
+            print('Invalid selection')
+
+
+def prompt_list_container(cloudfiles_engine, cf_container_uri, cf_container, cf_object_limit=10, cf_download_options=None, cf_cache=None, cf_region='', cf_read_ahead=listing.DEFAULT_READ_AHEAD, cf_downloads=None):
     """
     List the contents of a container in CloudFiles for the user
+
+    cf_download_options - optional dictionary of 'part_size', 'concurrency', 'resume', 'digests' and 'io_mode' for DownloadObject
+    cf_cache - optional rcbu.cloud.cache.ListingCache to serve and search the listing from
+    cf_region - data center of cf_container_uri; required with cf_cache
+    cf_read_ahead - number of pages retrieved in the background ahead of the page shown
+    cf_downloads - optional rcbu.cloud.downloads.DownloadQueue to queue downloads with
     """
-    cf_object_marker = ''
+    if cf_download_options is None:
+        cf_download_options = {}
+    if cf_cache is not None and not refresh_listing_cache(cloudfiles_engine, cf_cache, cf_region, cf_container_uri, cf_container):
+        cf_cache = None
+    cf_object_pattern = None
+    cf_pages = open_listing_pages(cloudfiles_engine, cf_container_uri, cf_container, cf_object_limit, cf_cache, cf_region, cf_object_pattern, cf_read_ahead)
+    cf_page_number = 0
     continue_object_search = True
     #
     #   Access the list of objects up to cf_object_limit in size
-    #   List access must be repeated if the user wants more objects listed
+    #   The following pages are retrieved in the background while a page is shown
     #
     while continue_object_search:
         # Access the list of objects in the container from CloudFiles
-        cf_objects = cloudfiles_engine.GetContainerObjects(cf_container_uri, cf_container, cf_object_limit, cf_object_marker)
+        cf_objects = get_listing_pages_page(cf_pages, cf_page_number)
 
         continue_list_objects = True
         #
@@ -235,11 +637,37 @@ def prompt_list_container(cloudfiles_engine, cf_container_uri, cf_container, cf_
 
             # Determine if we need to provide the user the option to get more objects
             has_more_objects = False
-            if len(cf_objects) and len(cf_objects) == cf_object_limit:
+            if len(cf_objects) and cf_pages.HasNext(cf_page_number):
                 print('\t' + str(object_counter) + ') Check for more objects')
                 has_more_objects = True
                 object_counter += 1
 
+            # Earlier pages are usually still kept
+            previous_selection = -1
+            if cf_page_number > 0:
+                print('\t' + str(object_counter) + ') Previous objects (page ' + str(cf_page_number) + ')')
+                previous_selection = object_counter
+                object_counter += 1
+
+            # Searching is served by the listing cache
+            search_selection = -1
+            if cf_cache is not None:
+                print('\t' + str(object_counter) + ') Search objects')
+                search_selection = object_counter
+                object_counter += 1
+
+            # Every object can be indexed for searching, sorting and statistics
+            print('\t' + str(object_counter) + ') Index all objects (search, sort, statistics)')
+            index_selection = object_counter
+            object_counter += 1
+
+            # Objects queued for download are downloaded in the background
+            downloads_selection = -1
+            if cf_downloads is not None:
+                print('\t' + str(object_counter) + ') Show downloads (' + str(cf_downloads.Pending()) + ' in progress)')
+                downloads_selection = object_counter
+                object_counter += 1
+
             # Add the cancel operation
             print('\t' + str(object_counter) + ') return to previous menu')
 
@@ -250,31 +678,41 @@ def prompt_list_container(cloudfiles_engine, cf_container_uri, cf_container, cf_
                     # Cancel operation
                     continue_list_objects = False       # Exit inner loop
                     continue_object_search = False      # Exit outter loop
+                elif object_selection is index_selection:
+                    try:
+                        cf_index = build_object_index(cloudfiles_engine, cf_container_uri, cf_container, cf_cache, cf_region)
+                        prompt_browse_index(cloudfiles_engine, cf_container_uri, cf_container, cf_index, cf_object_limit, cf_download_options, cf_downloads)
+                    except UserWarning as ex:
+                        print(str(ex))
+                    continue_list_objects = True    # Continue inner loop
+                    continue_object_search = True   # Continue outter loop
+                elif downloads_selection >= 0 and object_selection is downloads_selection:
+                    show_download_queue(cf_downloads)
+                    continue_list_objects = True    # Continue inner loop
+                    continue_object_search = True   # Continue outter loop
+                elif search_selection >= 0 and object_selection is search_selection:
+                    # Restart the listing with the matching objects
+                    cf_object_pattern = prompt_search_pattern()
+                    cf_pages.Close()
+                    cf_pages = open_listing_pages(cloudfiles_engine, cf_container_uri, cf_container, cf_object_limit, cf_cache, cf_region, cf_object_pattern, cf_read_ahead)
+                    cf_page_number = 0
+                    continue_list_objects = False   # Exit inner loop
+                    continue_object_search = True   # Continue outer loop
+                elif previous_selection >= 0 and object_selection is previous_selection:
+                    # Go back a page
+                    cf_page_number -= 1
+                    continue_list_objects = False   # Exit inner loop
+                    continue_object_search = True   # Continue outer loop
                 elif object_selection >= 0 and object_selection < object_counter:
                     # If there are more objects than len(cf_objects) is a phantom object that represents
                     #   the user request for more objects.
                     if has_more_objects and object_selection is len(cf_objects):
                         # Request more containers
-                        cf_object_marker = cf_objects[len(cf_objects)-1]['name']
+                        cf_page_number += 1
                         continue_list_objects = False   # Exit inner loop
                         continue_object_search = True   # Continue outer loop
                     else:
-                        # List information about the object
-                        print('\t\tName: ' + cf_objects[object_selection]['name'])
-                        print('\t\tSize: ' + str(cf_objects[object_selection]['bytes']) + ' bytes')
-                        print('\t\tContent-Type: ' + cf_objects[object_selection]['content_type'])
-                        print('\t\tLast Modified: ' + cf_objects[object_selection]['last_modified'])
-                        print('\t\tHash: ' + cf_objects[object_selection]['hash'])
-
-                        if prompt_download():
-                            target_location = os.getcwd() + '/' + cf_objects[object_selection]['name']
-                            cloudfiles_engine.DownloadObject(cf_container_uri, cf_container, cf_objects[object_selection], target_location)
-
-                        # Wait for the user
-                        try:
-                            dummy = input('\tPress ENTER to continue')
-                        except SyntaxError:
-                            pass
+                        show_object(cloudfiles_engine, cf_container_uri, cf_container, cf_objects[object_selection], cf_download_options, cf_downloads)
                         continue_list_objects = True    # Continue inner loop
                         continue_object_search = True   # Continue outter loop
                 else:
@@ -287,6 +725,272 @@ def prompt_list_container(cloudfiles_engine, cf_container_uri, cf_container, cf_
                 print('Invalid selection')
                 continue_list_objects = True        # Continue inner loop
                 continue_object_search = True       # Continue outter loop
+    cf_pages.Close()
+
+
+def find_uri(auth_engine, cf_dc, cf_network):
+    """
+    Find the URI (without the scheme) of a network ('public' or 'snet') in a data center
+
+    Returns a NULL string if the data center or network is not in the service catalog
+    """
+    for uri in auth_engine.GetCloudFilesUri(cf_dc):
+        if uri['name'] == cf_network:
+            return uri['uri'].split('://', 1)[-1]
+    return ''
+
+
+def select_endpoint(auth_engine, cf_probe, arguments):
+    """
+    Select the Cloud Files endpoint for the non-interactive operations
+
+    '--region' and '--network' are used when both are given; otherwise the fastest reachable
+    endpoint (within '--region' or '--network' when one of them is given) is probed for
+
+    Returns a tuple of the data center and the URI (without the scheme); NULL strings if none is found
+    """
+    if arguments.region is not None and arguments.network is not None:
+        cf_uri = find_uri(auth_engine, arguments.region, arguments.network)
+        if not len(cf_uri):
+            print('No ' + arguments.network + ' Cloud Files network found for ' + arguments.region)
+            return ('', '')
+        return (arguments.region, cf_uri)
+    cf_fastest = cf_probe.Fastest(arguments.region, arguments.network)
+    if cf_fastest is None:
+        print('No reachable Cloud Files endpoint found')
+        return ('', '')
+    print('Using the fastest endpoint: ' + cf_fastest['region'] + ' ' + cf_fastest['network'] + ' (' + format_latency(cf_fastest) + ')')
+    return (cf_fastest['region'], cf_fastest['uri'].split('://', 1)[-1])
+
+
+def print_endpoints(cf_probe):
+    """
+    Probe every Cloud Files endpoint and print them fastest first
+    """
+    for result in cf_probe.Probe(refresh=True):
+        print('\t' + result['region'] + ' ' + result['network'] + ' - ' + result['uri'] + ' (' + format_latency(result) + ')')
+    return 0
+
+
+def search_regions(auth_engine, arguments):
+    """
+    Non-interactively search a container for objects matching '--pattern' in every data center (or in --region)
+
+    Returns 0 if every data center was searched; otherwise -1
+    """
+    cf_regions = None
+    if arguments.region is not None:
+        cf_regions = [arguments.region]
+    multi_region = regions.MultiRegion(auth_engine, True, arguments.network or 'public', cf_regions)
+    results, failures = multi_region.SearchContainer(arguments.search_regions, arguments.pattern, arguments.prefix)
+    for region in sorted(results):
+        print(region + ': ' + str(len(results[region])) + ' objects')
+        for object_data in results[region]:
+            print('\t' + object_data['name'] + ' (Size: ' + str(object_data['bytes']) + ' bytes)')
+    for region in sorted(failures):
+        print(region + ': failed: ' + failures[region])
+    if len(failures):
+        return -1
+    return 0
+
+
+def query_container(cloudfiles_engine, cf_container_uri, arguments):
+    """
+    Non-interactively list the objects of a container matching a query (see rcbu.cloud.query.ObjectQuery.Parse)
+
+    Returns 0 if the container was queried; otherwise -1
+    """
+    cf_container, cf_query_text = arguments.query
+    try:
+        cf_query = query.ObjectQuery.Parse(cf_query_text)
+        if len(arguments.prefix):
+            cf_query.prefix = arguments.prefix
+        for object_data in cf_query.Run(cloudfiles_engine, cf_container_uri, cf_container):
+            if 'subdir' in object_data:
+                print('\t' + object_data['subdir'] + ' (pseudo-directory)')
+            else:
+                print('\t' + object_data['name'] + ' (Size: ' + str(object_data['bytes']) + ' bytes, Modified: ' + object_data.get('last_modified', '') + ')')
+    except (UserWarning, requests.exceptions.RequestException) as ex:
+        print('Unable to query ' + cf_container + ': ' + str(ex))
+        return -1
+    stats = cf_query.Stats
+    print('Matched ' + str(stats['matched']) + ' of ' + str(stats['listed']) + ' listed entries (' + str(stats['bytes']) + ' bytes) in {0:.2f} seconds'.format(stats['elapsed']))
+    return 0
+
+
+def export_manifest(cloudfiles_engine, cf_container_uri, arguments):
+    """
+    Non-interactively write the listing of a container to a manifest file (see rcbu.cloud.manifest)
+
+    Returns 0 if the manifest was written; otherwise -1
+    """
+    cf_container = arguments.export_manifest
+    cf_manifest_path = arguments.output
+    if cf_manifest_path == '-':
+        cf_manifest_path = cf_container + '.ndjson.gz'
+    print('Exporting ' + cf_container + '/' + arguments.prefix + '* to ' + cf_manifest_path)
+    try:
+        stats = manifest.ExportContainer(cloudfiles_engine, cf_container_uri, cf_container, cf_manifest_path, arguments.manifest_format, arguments.prefix)
+    except (UserWarning, IOError, OSError, requests.exceptions.RequestException) as ex:
+        print('Unable to export ' + cf_container + ': ' + str(ex))
+        return -1
+    print('\tExported: ' + str(stats['objects']) + ' objects (' + str(stats['bytes']) + ' bytes) in {0:.2f} seconds'.format(stats['elapsed']))
+    return 0
+
+
+def diff_manifests(arguments):
+    """
+    Print the objects added, removed or changed between two manifests
+
+    Returns 0 if the manifests were compared; otherwise -1
+    """
+    cf_old_manifest, cf_new_manifest = arguments.diff_manifests
+    counts = {manifest.CHANGE_ADDED: 0, manifest.CHANGE_REMOVED: 0, manifest.CHANGE_CHANGED: 0}
+    try:
+        for change, old_entry, new_entry in manifest.Diff(cf_old_manifest, cf_new_manifest):
+            counts[change] += 1
+            if change == manifest.CHANGE_ADDED:
+                print('\t+ ' + new_entry['name'] + ' (Size: ' + str(new_entry['bytes']) + ' bytes)')
+            elif change == manifest.CHANGE_REMOVED:
+                print('\t- ' + old_entry['name'] + ' (Size: ' + str(old_entry['bytes']) + ' bytes)')
+            else:
+                print('\t* ' + new_entry['name'] + ' (Size: ' + str(old_entry['bytes']) + ' -> ' + str(new_entry['bytes']) + ' bytes, Modified: ' + new_entry.get('last_modified', '') + ')')
+    except (UserWarning, IOError, OSError) as ex:
+        print('Unable to compare the manifests: ' + str(ex))
+        return -1
+    print('Added: ' + str(counts[manifest.CHANGE_ADDED]) + ', Removed: ' + str(counts[manifest.CHANGE_REMOVED]) + ', Changed: ' + str(counts[manifest.CHANGE_CHANGED]))
+    return 0
+
+
+def search_manifest(arguments):
+    """
+    Print the objects of a manifest matching a query (see rcbu.cloud.query.ObjectQuery.Parse)
+
+    Returns 0 if the manifest was searched; otherwise -1
+    """
+    cf_manifest_path, cf_query_text = arguments.search_manifest
+    matched = 0
+    try:
+        cf_query = query.ObjectQuery.Parse(cf_query_text)
+        if len(arguments.prefix):
+            cf_query.prefix = arguments.prefix
+        for object_data in manifest.Search(cf_manifest_path, cf_query):
+            matched += 1
+            print('\t' + object_data['name'] + ' (Size: ' + str(object_data['bytes']) + ' bytes, Modified: ' + object_data.get('last_modified', '') + ')')
+    except (UserWarning, IOError, OSError) as ex:
+        print('Unable to search ' + cf_manifest_path + ': ' + str(ex))
+        return -1
+    print('Matched ' + str(matched) + ' objects')
+    return 0
+
+
+def download_container(cloudfiles_engine, cf_container_uri, arguments, download_options):
+    """
+    Non-interactively download a container (or the objects under a prefix) into a local directory
+
+    Returns 0 if every object was downloaded; otherwise -1
+    """
+    print('Downloading ' + arguments.download_container + '/' + arguments.prefix + '* to ' + arguments.target)
+    bulk_download = bulk.BulkDownload(cloudfiles_engine, cf_container_uri, arguments.download_container, arguments.target, arguments.prefix, arguments.workers, download_options)
+    success = bulk_download.Run()
+    stats = bulk_download.Stats
+    print('\tDownloaded: ' + str(stats['downloaded']) + ' objects (' + str(stats['bytes']) + ' bytes)')
+    print('\tSkipped (already present): ' + str(stats['skipped']))
+    print('\tFailed: ' + str(stats['failed']))
+    for name, reason in bulk_download.Failures:
+        print('\t\t' + name + ': ' + reason)
+    print('\tRate: {0:.2f} objects/s, {1:.2f} MB/s'.format(stats['objects-per-second'], stats['bytes-per-second'] / 2 ** 20))
+    if success:
+        return 0
+    return -1
+
+
+def sync_container(cloudfiles_engine, cf_container_uri, arguments, download_options):
+    """
+    Non-interactively mirror a container (or the objects under a prefix) into a local directory
+
+    Returns 0 if every new or changed object was downloaded; otherwise -1
+    """
+    print('Syncing ' + arguments.sync_container + '/' + arguments.prefix + '* to ' + arguments.target)
+    container_sync = sync.ContainerSync(cloudfiles_engine, cf_container_uri, arguments.sync_container, arguments.target, arguments.prefix, arguments.workers, download_options, arguments.prune)
+    success = container_sync.Run()
+    stats = container_sync.Stats
+    print('\tNew: ' + str(stats['new']))
+    print('\tChanged: ' + str(stats['changed']))
+    print('\tUnchanged: ' + str(stats['unchanged']))
+    print('\tAlready present: ' + str(stats['adopted']))
+    print('\tRemoved from the container: ' + str(stats['removed']) + ' (' + str(stats['pruned']) + ' pruned locally)')
+    print('\tDownloaded: ' + str(stats['downloaded']) + ' objects (' + str(stats['bytes']) + ' bytes)')
+    print('\tFailed: ' + str(stats['failed']))
+    for name, reason in container_sync.Failures:
+        print('\t\t' + name + ': ' + reason)
+    if success:
+        return 0
+    return -1
+
+
+def stream_object(cloudfiles_engine, cf_container_uri, arguments, download_options, cf_output):
+    """
+    Non-interactively write an object to stdout or a file (e.g. a named pipe) without staging it on disk
+
+    Returns 0 if the object was written and matches its ETag; otherwise -1
+    """
+    cf_container, cf_object = arguments.stream_object
+    object_data = {'name': cf_object}
+    try:
+        cloudfiles_engine.StreamObject(cf_container_uri, cf_container, object_data, cf_output, download_options['digests'], download_options['io_mode'])
+    except (UserWarning, requests.exceptions.RequestException) as ex:
+        print('Unable to stream ' + cf_container + '/' + cf_object + ': ' + str(ex))
+        return -1
+    print('Streamed ' + cf_container + '/' + cf_object + ' (' + str(object_data['bytes']) + ' bytes)')
+    if 'md5' in object_data:
+        print('\tMD5: ' + object_data['md5'])
+    if 'sha1' in object_data:
+        print('\tSHA1: ' + object_data['sha1'])
+    return 0
+
+
+def usage_report(auth_engine, arguments):
+    """
+    Non-interactively report the usage of every container in every data center (or in --region)
+
+    Returns 0 if every container was reported; otherwise -1
+    """
+    regions = None
+    if arguments.region is not None:
+        regions = [arguments.region]
+    account_usage = usage.AccountUsage(auth_engine, True, arguments.network or 'public', regions)
+    success = account_usage.Run()
+    print(account_usage.ToTable(arguments.usage_sort))
+    for region, container, reason in account_usage.Failures:
+        print('\tFailed: ' + region + '/' + container + ': ' + reason)
+    print('Collected in {0:.2f} seconds'.format(account_usage.elapsed))
+    if arguments.usage_json is not None:
+        with open(arguments.usage_json, 'w') as json_file:
+            json_file.write(account_usage.ToJson(arguments.usage_sort))
+    if success:
+        return 0
+    return -1
+
+
+def browse_containers(cloudfiles_engine, cf_dc, cf_uri, user_data, download_options, listing_cache, download_queue=None):
+    """
+    Let the user browse the containers at a Cloud Files URI until they return to the previous menu
+
+    download_queue - optional rcbu.cloud.downloads.DownloadQueue objects are queued for download with
+    """
+    # Listing pages retrieved in the background ahead of the page shown
+    cf_read_ahead = user_data.get('listing-read-ahead', listing.DEFAULT_READ_AHEAD)
+    continue_container_search = True
+    # Loop over the user selecting the container
+    while continue_container_search:
+        cf_container = prompt_get_container(cloudfiles_engine, cf_uri[8:], user_data['request-limit'], listing_cache, cf_dc, cf_read_ahead)
+        if not len(cf_container):
+            continue_container_search = False
+        else:
+            print('Selected Container: ' + cf_container)
+            # Show the user the list of objects in the container
+            prompt_list_container(cloudfiles_engine, cf_uri[8:], cf_container, user_data['request-limit'], download_options, listing_cache, cf_dc, cf_read_ahead, download_queue)
 
 
 def main():
@@ -299,13 +1003,95 @@ def main():
     #           'user'
     #           'apikey'
     #           'request-limit'
+    #           'download-part-size' (optional)
+    #           'download-concurrency' (optional)
+    #           'download-resume' (optional)
+    #           'download-digests' (optional)
+    #           'download-io' (optional)
+    #           'download-workers' (optional, objects downloaded in the background at the same time)
+    #           'listing-cache' (optional, file to cache listings in; off unless set)
+    #           'listing-cache-ttl' (optional, seconds)
+    #           'listing-read-ahead' (optional, pages)
+    #           'token-cache' (optional, file to keep the token in between runs; off unless set)
+    #           'endpoint-cache' (optional, empty to disable)
+    #           'endpoint-cache-ttl' (optional, seconds)
+    #           'request-retries' (optional)
+    #           'host-concurrency' (optional)
     #       '--log-config' ti specify an INI file for configuring the Python logging system, namely
     #           for debug purposes
+    #       '--download-container' to download a container without any menus, along with:
+    #           '--region' and '--network' to select the Cloud Files URI; the fastest reachable
+    #               endpoint (preferring snet) is used for whichever is not given
+    #           '--prefix' to only download the objects under a prefix
+    #           '--target' for the local directory to download into
+    #           '--workers' for the number of objects downloaded at the same time
+    #       '--sync-container' to mirror a container into '--target', downloading only new or
+    #           changed objects; takes the same options as '--download-container' along with:
+    #           '--prune' to remove local copies of objects no longer in the container
+    #       '--stream-object' to write a single object to '--output' (stdout by default, or a file
+    #           or named pipe) as it is received, e.g. to pipe it into another program; takes
+    #           '--region' and '--network' as '--download-container' does. All other output goes
+    #           to stderr while streaming to stdout
+    #       '--query' to list the objects of a container matching a query, e.g.
+    #           "logs/*.gz size>=10M modified>=2014-01-01 type:application/*" (under '--prefix');
+    #           takes '--region' and '--network' as '--download-container' does
+    #       '--export-manifest' to write the listing of a container (under '--prefix') to the
+    #           manifest file '--output' (CONTAINER.ndjson.gz by default); '--manifest-format' is
+    #           ndjson, csv or columnar, by default taken from the file name, which also selects
+    #           the compression (.gz, .bz2 or .xz); takes '--region' and '--network' as
+    #           '--download-container' does
+    #       '--diff-manifests' to print the objects added, removed or changed between two manifests
+    #       '--search-manifest' to list the objects of a manifest matching a query as '--query' does;
+    #           neither needs to log in
+    #       '--usage-report' to print the object count and bytes used of every container in every
+    #           data center (or only in '--region'), along with:
+    #           '--usage-sort' to order the containers by region, name, objects or bytes
+    #           '--usage-json' to also write the report as JSON
+    #       '--search-regions' to search a container in every data center at the same time for
+    #           the objects matching '--pattern' (under '--prefix')
+    #       '--probe-endpoints' to print the latency of every Cloud Files endpoint
+    #       '--metrics' to write the request timings to a file on exit (and on SIGUSR1), along with:
+    #           '--metrics-format' for JSON or Prometheus text
+    #
+    #   Scripts can instead run one of the commands 'ls', 'stat', 'get' or 'du' (see rcbu.cli), e.g.
+    #       cloudfiles-viewer.py ls --user user.json --region DFW --network snet CONTAINER --prefix logs/
+    #   which are handled before any of the above is set up
     #
     argument_parse = argparse.ArgumentParser(prog='cloudfilews-viewer', description='Rackspace CloudFiles Viewer')
     argument_parse.add_argument('--user', required=True, help='Specify a text file containing the JSON data for the \'user\' and \'apikey\' values for authentication', metavar='User Auth Data', type=argparse.FileType('r'))
     argument_parse.add_argument('--log-config', type=str, required=False, help='Specify the log configuration data', metavar='Log config')
+    argument_parse.add_argument('--download-container', type=str, required=False, help='Download every object in the container without prompting', metavar='Container')
+    argument_parse.add_argument('--region', type=str, required=False, help='Data center to use with --download-container (default: the fastest)', metavar='Data center')
+    argument_parse.add_argument('--network', type=str, required=False, choices=['public', 'snet'], help='Network to use with --download-container (default: the fastest, preferring snet)')
+    argument_parse.add_argument('--prefix', type=str, required=False, default='', help='Only download the objects whose names start with the prefix', metavar='Prefix')
+    argument_parse.add_argument('--target', type=str, required=False, default=os.getcwd(), help='Local directory to download into', metavar='Directory')
+    argument_parse.add_argument('--workers', type=int, required=False, default=bulk.DEFAULT_WORKERS, help='Number of objects downloaded at the same time', metavar='Workers')
+    argument_parse.add_argument('--sync-container', type=str, required=False, help='Mirror the container into the target directory, downloading only new or changed objects', metavar='Container')
+    argument_parse.add_argument('--prune', action='store_true', help='With --sync-container, remove local copies of objects that are no longer in the container')
+    argument_parse.add_argument('--stream-object', type=str, nargs=2, required=False, help='Write an object to --output as it is received', metavar=('Container', 'Object'))
+    argument_parse.add_argument('--output', type=str, required=False, default='-', help='File or named pipe --stream-object writes to (default: stdout), or the manifest file of --export-manifest (default: Container.ndjson.gz)', metavar='Output')
+    argument_parse.add_argument('--query', type=str, nargs=2, required=False, help='List the objects of a container matching a query: name glob patterns, name:, type:, prefix:, delimiter:, marker:, end_marker:, limit:, size>N, size<N, modified>T, modified<T (also >=, <=, =)', metavar=('Container', 'Query'))
+    argument_parse.add_argument('--export-manifest', type=str, required=False, help='Write the listing of the container to the manifest file --output', metavar='Container')
+    argument_parse.add_argument('--manifest-format', type=str, required=False, choices=manifest.FORMAT_CHOICES, help='Format of the --export-manifest file (default: from the file name)')
+    argument_parse.add_argument('--diff-manifests', type=str, nargs=2, required=False, help='Print the objects added, removed or changed between two manifests', metavar=('Old', 'New'))
+    argument_parse.add_argument('--search-manifest', type=str, nargs=2, required=False, help='List the objects of a manifest matching a query (see --query)', metavar=('Manifest', 'Query'))
+    argument_parse.add_argument('--usage-report', action='store_true', help='Report the object count and bytes used of every container in every data center')
+    argument_parse.add_argument('--usage-sort', type=str, required=False, default=usage.SORT_BYTES, choices=usage.SORT_CHOICES, help='Order of the containers in the usage report')
+    argument_parse.add_argument('--usage-json', type=str, required=False, help='Also write the usage report as JSON to this file', metavar='JSON file')
+    argument_parse.add_argument('--search-regions', type=str, required=False, help='Search the container in every data center at the same time', metavar='Container')
+    argument_parse.add_argument('--pattern', type=str, required=False, default='*', help='Glob pattern the object names must match with --search-regions', metavar='Pattern')
+    argument_parse.add_argument('--probe-endpoints', action='store_true', help='Print the latency of every Cloud Files endpoint')
+    argument_parse.add_argument('--metrics', type=str, required=False, help='Write the request timings to a file on exit and on SIGUSR1', metavar='Metrics file')
+    argument_parse.add_argument('--metrics-format', type=str, required=False, default=metrics.FORMAT_JSON, choices=metrics.FORMAT_CHOICES, help='Format of the --metrics file')
     arguments = argument_parse.parse_args()
+    if arguments.sync_container is not None and arguments.download_container is not None:
+        argument_parse.error('--sync-container and --download-container are mutually exclusive')
+
+    stream_output = None
+    if arguments.stream_object is not None and arguments.output == '-':
+        # stdout carries the object; everything else, logging included, goes to stderr
+        stream_output = getattr(sys.stdout, 'buffer', sys.stdout)
+        sys.stdout = sys.stderr
 
     # log config is optional
     if arguments.log_config is not None:
@@ -322,50 +1108,148 @@ def main():
         log.addHandler(lf)
         log.setLevel(logging.DEBUG)
 
+    if arguments.metrics is not None:
+        def export_metrics(*args):
+            Command.Metrics().Export(arguments.metrics, arguments.metrics_format)
+
+        atexit.register(export_metrics)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, export_metrics)
+
+    # Manifests need Python 3 (see rcbu.cloud.manifest); fail before logging in
+    if sys.version_info[0] < 3 and (arguments.export_manifest is not None or arguments.diff_manifests is not None or arguments.search_manifest is not None):
+        print('--export-manifest, --diff-manifests and --search-manifest require Python 3')
+        return -1
+
+    # Manifests already on disk are worked on without logging in
+    if arguments.diff_manifests is not None:
+        return diff_manifests(arguments)
+    if arguments.search_manifest is not None:
+        return search_manifest(arguments)
+
     # Load the user data
     user_data = json.load(arguments.user)
+
+    # Large objects are retrieved as concurrent byte ranges when download-concurrency is above 1
+    download_options = {}
+    download_options['part_size'] = user_data.get('download-part-size', transfer.DEFAULT_PART_SIZE)
+    download_options['concurrency'] = user_data.get('download-concurrency', 1)
+    # Interrupted downloads continue where they stopped unless 'download-resume' is false
+    download_options['resume'] = user_data.get('download-resume', True)
+    # Digests computed while downloading: 'none', 'md5' (checks the ETag) or 'md5+sha1'
+    download_options['digests'] = user_data.get('download-digests', transfer.DEFAULT_DIGESTS)
+    # How downloads are moved to disk: 'stream', 'readinto' (reusable buffers), 'mmap' or 'direct' (O_DIRECT)
+    download_options['io_mode'] = user_data.get('download-io', transfer.DEFAULT_IO_MODE)
+
+    # Failed requests are retried with backoff; requests to each host adapt to its throttling
+    Command.ConfigureRetries(retries=user_data.get('request-retries', retry.DEFAULT_RETRIES), host_concurrency=user_data.get('host-concurrency', retry.DEFAULT_HOST_CONCURRENCY))
+
+    # Every API call shares one pool of keep-alive connections; size it for the downloads
+    Command.ConfigureConnectionPool(pool_size=max(command.DEFAULT_POOL_SIZE, download_options['concurrency'] * arguments.workers, usage.DEFAULT_CONCURRENCY))
+
+    # Listings are only cached on disk when 'listing-cache' is set (e.g. to ~/.cloudfiles-viewer/listings.sqlite)
+    listing_cache = None
+    listing_cache_path = user_data.get('listing-cache', '')
+    if len(listing_cache_path):
+        listing_cache = cache.ListingCache(listing_cache_path, user_data.get('listing-cache-ttl', cache.DEFAULT_TTL))
+
     print('Logging into CloudFiles...')
     print('\tUser: ' + user_data['user'])
     print('\tAPI-Key: ' + user_data['apikey'])
     # Authenticate the user
-    auth_engine = Authentication(user_data['user'], user_data['apikey'])
+    #   The token is only kept between runs when 'token-cache' is set (e.g. to ~/.cloudfiles-viewer/token.json)
+    token_cache_path = user_data.get('token-cache', '')
+    auth_engine = Authentication(user_data['user'], user_data['apikey'], token_cache_path or None)
     auth_token = auth_engine.AuthToken
     if auth_token is None:
         print('Invalid API Key or User Name')
         return -1
+    auth_engine.StartTokenRefresh()
 
     # CloudFIles Access
     cloudfiles_engine = CloudFiles(True, auth_engine)
     print('Received AuthToken: ' + auth_token)
     print('        Expires at: ' + auth_engine.AuthExpirationTime)
 
+    # Endpoint latencies are kept between runs unless 'endpoint-cache' is set to an empty path
+    endpoint_cache_path = user_data.get('endpoint-cache', regions.DEFAULT_PROBE_CACHE_PATH)
+    endpoint_probe = regions.EndpointProbe(auth_engine, True, endpoint_cache_path or None, user_data.get('endpoint-cache-ttl', regions.DEFAULT_PROBE_TTL))
+
+    if arguments.probe_endpoints:
+        return print_endpoints(endpoint_probe)
+
+    # Non-interactive cross-region search
+    if arguments.search_regions is not None:
+        return search_regions(auth_engine, arguments)
+
+    # Non-interactive usage report
+    if arguments.usage_report:
+        return usage_report(auth_engine, arguments)
+
+    # Non-interactive download of a single object to a stream
+    if arguments.stream_object is not None:
+        cf_dc, cf_uri = select_endpoint(auth_engine, endpoint_probe, arguments)
+        if not len(cf_uri):
+            return -1
+        if stream_output is not None:
+            return stream_object(cloudfiles_engine, cf_uri, arguments, download_options, stream_output)
+        with open(arguments.output, 'wb') as cf_output:
+            return stream_object(cloudfiles_engine, cf_uri, arguments, download_options, cf_output)
+
+    # Non-interactive query of a container
+    if arguments.query is not None:
+        cf_dc, cf_uri = select_endpoint(auth_engine, endpoint_probe, arguments)
+        if not len(cf_uri):
+            return -1
+        return query_container(cloudfiles_engine, cf_uri, arguments)
+
+    # Non-interactive export of a container listing
+    if arguments.export_manifest is not None:
+        cf_dc, cf_uri = select_endpoint(auth_engine, endpoint_probe, arguments)
+        if not len(cf_uri):
+            return -1
+        return export_manifest(cloudfiles_engine, cf_uri, arguments)
+
+    # Non-interactive bulk download or sync
+    if arguments.download_container is not None or arguments.sync_container is not None:
+        cf_dc, cf_uri = select_endpoint(auth_engine, endpoint_probe, arguments)
+        if not len(cf_uri):
+            return -1
+        if arguments.sync_container is not None:
+            return sync_container(cloudfiles_engine, cf_uri, arguments, download_options)
+        return download_container(cloudfiles_engine, cf_uri, arguments, download_options)
+
+    # Objects can be queued from the menus and are downloaded in the background
+    download_queue = downloads.DownloadQueue(cloudfiles_engine, user_data.get('download-workers', downloads.DEFAULT_WORKERS), download_options)
+
     # Loop over user selecting the data center
+    print('Probing the Cloud Files endpoints...')
     continue_dc_search = True
     while continue_dc_search:
-        cf_dc = prompt_get_data_centers(auth_engine)
+        cf_dc, cf_uri = prompt_get_data_centers(auth_engine, endpoint_probe)
         if not len(cf_dc):
             continue_dc_search = False
+        elif len(cf_uri):
+            print('Selected DC: ' + cf_dc)
+            print('Selected Network URI: ' + cf_uri)
+            browse_containers(cloudfiles_engine, cf_dc, cf_uri, user_data, download_options, listing_cache, download_queue)
         else:
             print('Selected DC: ' + cf_dc)
             continue_uri_search = True
             # Loop over the user selecting the network/uri
             while continue_uri_search:
-                cf_uri = prompt_get_uri(auth_engine, cf_dc)
+                cf_uri = prompt_get_uri(auth_engine, cf_dc, endpoint_probe)
                 if not len(cf_uri):
                     continue_uri_search = False
                 else:
                     print('Selected Network URI: ' + cf_uri)
-                    continue_container_search = True
-                    # Loop over the user selecting the container
-                    while continue_container_search:
-                        cf_container = prompt_get_container(cloudfiles_engine, cf_uri[8:], user_data['request-limit'])
-                        if not len(cf_container):
-                            continue_container_search = False
-                        else:
-                            print('Selected Container: ' + cf_container)
-                            # Show the user the list of objects in the container
-                            prompt_list_container(cloudfiles_engine, cf_uri[8:], cf_container, user_data['request-limit'])
+                    browse_containers(cloudfiles_engine, cf_dc, cf_uri, user_data, download_options, listing_cache, download_queue)
+
+    # The background downloads are stopped when the program exits
+    if download_queue.Pending():
+        print('Waiting for ' + str(download_queue.Pending()) + ' downloads to finish...')
+        show_download_queue(download_queue, cf_wait=True)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
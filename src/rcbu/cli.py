@@ -0,0 +1,318 @@
+"""
+Cloud Files Viewer - Scriptable Commands
+
+Non-interactive commands for scripts, cron jobs and shell loops:
+
+    ls [CONTAINER]             - list the containers, or the objects of a container
+    stat [CONTAINER [OBJECT]]  - show the metadata of the account, a container or an object
+    get CONTAINER OBJECT       - write an object to stdout or a file
+    du [CONTAINER]             - show the bytes used by every container, or by one
+
+Each command only imports the modules it uses, when it runs, and only sends the
+requests it needs: when 'token-cache' is set in the user data the token and
+service catalog come from the token cache while it holds a valid token, and the
+endpoint is taken from the service catalog when --region and --network are
+given. Data goes to stdout; errors and logging go to stderr, so the output can
+be piped into other programs.
+"""
+from __future__ import print_function
+
+import argparse
+import errno
+import json
+import logging
+import logging.config
+import os
+import sys
+
+
+COMMANDS = ('ls', 'stat', 'get', 'du')
+
+NETWORK_CHOICES = ('public', 'snet')
+
+
+def IsCommand(argv):
+    """
+    Determine whether the command line arguments (without the program name) run a scriptable command
+    """
+    return len(argv) > 0 and argv[0] in COMMANDS
+
+
+class Context(object):
+    """
+    Authentication and Cloud Files access of a command, set up on first use
+    """
+
+    def __init__(self, arguments):
+        """
+        Setup the context
+          arguments - parsed command line arguments (see BuildParser)
+        """
+        self.log = logging.getLogger(__name__)
+        self.arguments = arguments
+        self.user_data = None
+        self.authenticator = None
+        self.cloudfiles = None
+        self.uri = None
+
+    @property
+    def UserData(self):
+        """
+        Contents of the '--user' JSON file
+        """
+        if self.user_data is None:
+            try:
+                self.user_data = json.load(self.arguments.user)
+            except ValueError as ex:
+                raise UserWarning('Invalid user data: ' + str(ex))
+        return self.user_data
+
+    @property
+    def Authenticator(self):
+        """
+        rcbu.client.auth.Authentication of the user; the token is loaded from the token
+        cache (when 'token-cache' is set), and only requested from the identity service
+        when a request needs one
+        """
+        if self.authenticator is None:
+            from rcbu.client import auth
+            token_cache_path = self.UserData.get('token-cache', '')
+            self.authenticator = auth.Authentication(self.UserData['user'], self.UserData['apikey'], token_cache_path or None)
+        return self.authenticator
+
+    @property
+    def CloudFiles(self):
+        """
+        rcbu.cloud.files.CloudFiles to send the requests with
+        """
+        if self.cloudfiles is None:
+            from rcbu.cloud.files import CloudFiles
+            from rcbu.common import retry
+            from rcbu.common.command import Command
+            Command.ConfigureRetries(retries=self.UserData.get('request-retries', retry.DEFAULT_RETRIES), host_concurrency=self.UserData.get('host-concurrency', retry.DEFAULT_HOST_CONCURRENCY))
+            self.cloudfiles = CloudFiles(True, self.Authenticator)
+        return self.cloudfiles
+
+    @property
+    def Uri(self):
+        """
+        Cloud Files URI (without the scheme) of '--region' and '--network'
+
+        When either one is not given the fastest reachable endpoint is used (see
+        rcbu.cloud.regions.EndpointProbe; the probe results are kept between runs)
+
+        Raises UserWarning if there is no such endpoint
+        """
+        if self.uri is None:
+            region = self.arguments.region
+            network = self.arguments.network
+            if region is not None and network is not None:
+                for uri in self.Authenticator.GetCloudFilesUri(region):
+                    if uri['name'] == network:
+                        self.uri = uri['uri'].split('://', 1)[-1]
+                if self.uri is None:
+                    raise UserWarning('No ' + network + ' Cloud Files network found for ' + region)
+            else:
+                from rcbu.cloud import regions
+                endpoint_cache_path = self.UserData.get('endpoint-cache', regions.DEFAULT_PROBE_CACHE_PATH)
+                probe = regions.EndpointProbe(self.Authenticator, True, endpoint_cache_path or None, self.UserData.get('endpoint-cache-ttl', regions.DEFAULT_PROBE_TTL))
+                fastest = probe.Fastest(region, network)
+                if fastest is None:
+                    raise UserWarning('No reachable Cloud Files endpoint found')
+                self.uri = fastest['uri'].split('://', 1)[-1]
+            self.log.debug('using Cloud Files endpoint %s', self.uri)
+        return self.uri
+
+
+def List(context):
+    """
+    ls: print the names of the containers, or of the objects of a container
+
+    With --long the containers are printed as object count, bytes and name, and the
+    objects as bytes, last modified time, ETag and name, separated by tabs
+    """
+    arguments = context.arguments
+    if arguments.container is None:
+        for container in context.CloudFiles.IterContainers(context.Uri, prefix=arguments.prefix):
+            if arguments.long:
+                print(str(container['count']) + '\t' + str(container['bytes']) + '\t' + container['name'])
+            else:
+                print(container['name'])
+        return 0
+
+    for object_data in context.CloudFiles.IterContainerObjects(context.Uri, arguments.container, prefix=arguments.prefix, delimiter=arguments.delimiter):
+        if 'subdir' in object_data:
+            name = object_data['subdir']
+            if arguments.long:
+                name = '-\t-\t-\t' + name
+        else:
+            name = object_data['name']
+            if arguments.long:
+                name = str(object_data['bytes']) + '\t' + object_data.get('last_modified', '') + '\t' + object_data.get('hash', '') + '\t' + name
+        print(name)
+    return 0
+
+
+def Stat(context):
+    """
+    stat: print the metadata of the account, a container or an object, one 'Key: value' per line
+    """
+    arguments = context.arguments
+    if arguments.container is None:
+        metadata = context.CloudFiles.GetAccountMetadata(context.Uri)
+        if not len(metadata):
+            raise UserWarning('Unable to retrieve the account metadata')
+        print('Containers: ' + str(metadata['container-count']))
+        print('Bytes: ' + str(metadata['bytes-used']))
+    elif arguments.object is None:
+        metadata = context.CloudFiles.GetContainerMetadata(context.Uri, arguments.container)
+        if not len(metadata):
+            raise UserWarning('Unable to retrieve the metadata of ' + arguments.container)
+        print('Container: ' + arguments.container)
+        print('Objects: ' + str(metadata['object-count']))
+        print('Bytes: ' + str(metadata['bytes-used']))
+    else:
+        metadata = context.CloudFiles.GetObjectMetadata(context.Uri, arguments.container, arguments.object)
+        if not len(metadata):
+            raise UserWarning('Unable to retrieve the metadata of ' + arguments.container + '/' + arguments.object)
+        print('Container: ' + arguments.container)
+        print('Object: ' + metadata['name'])
+        print('Bytes: ' + str(metadata['bytes']))
+        print('ETag: ' + metadata['hash'])
+        print('Content-Type: ' + metadata['content_type'])
+        print('Last-Modified: ' + metadata['last_modified'])
+        for key in sorted(metadata['metadata']):
+            print('Meta-' + key + ': ' + metadata['metadata'][key])
+    return 0
+
+
+def Get(context):
+    """
+    get: write an object to stdout, or to the --output file once all of it was received
+    and matches its ETag
+    """
+    from rcbu.cloud import transfer
+    arguments = context.arguments
+    digests = context.UserData.get('download-digests', transfer.DEFAULT_DIGESTS)
+    io_mode = context.UserData.get('download-io', transfer.DEFAULT_IO_MODE)
+    object_data = {'name': arguments.object}
+    if arguments.output == '-':
+        output = getattr(sys.stdout, 'buffer', sys.stdout)
+        context.CloudFiles.StreamObject(context.Uri, arguments.container, object_data, output, digests, io_mode)
+        return 0
+
+    # A failed download never leaves a partial file under the requested name
+    partial_path = arguments.output + '.partial'
+    completed = False
+    try:
+        with open(partial_path, 'wb') as output:
+            context.CloudFiles.StreamObject(context.Uri, arguments.container, object_data, output, digests, io_mode)
+        os.rename(partial_path, arguments.output)
+        completed = True
+    finally:
+        if not completed and os.path.exists(partial_path):
+            os.remove(partial_path)
+    return 0
+
+
+def DiskUsage(context):
+    """
+    du: print the bytes used by every container, or by a container (or the objects under
+    --prefix), followed by the total; bytes and name are separated by a tab
+    """
+    from rcbu.cloud import downloads
+    arguments = context.arguments
+    if arguments.human:
+        size = downloads.FormatBytes
+    else:
+        size = str
+    if arguments.container is None:
+        total = 0
+        for container in context.CloudFiles.IterContainers(context.Uri, prefix=arguments.prefix):
+            total += int(container['bytes'])
+            print(size(container['bytes']) + '\t' + container['name'])
+        print(size(total) + '\ttotal')
+    elif not len(arguments.prefix):
+        # The container keeps the count; no need to list it
+        metadata = context.CloudFiles.GetContainerMetadata(context.Uri, arguments.container)
+        if not len(metadata):
+            raise UserWarning('Unable to retrieve the metadata of ' + arguments.container)
+        print(size(metadata['bytes-used']) + '\t' + arguments.container)
+    else:
+        total = 0
+        for object_data in context.CloudFiles.IterContainerObjects(context.Uri, arguments.container, prefix=arguments.prefix):
+            total += int(object_data.get('bytes', 0))
+        print(size(total) + '\t' + arguments.container + '/' + arguments.prefix)
+    return 0
+
+
+def BuildParser(prog=None):
+    """
+    Command line parser of the scriptable commands
+    """
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--user', required=True, help='Specify a text file containing the JSON data for the \'user\' and \'apikey\' values for authentication', metavar='User Auth Data', type=argparse.FileType('r'))
+    common.add_argument('--log-config', type=str, required=False, help='Specify the log configuration data (default: warnings and errors to stderr)', metavar='Log config')
+    common.add_argument('--region', type=str, required=False, help='Data center to use (default: the fastest)', metavar='Data center')
+    common.add_argument('--network', type=str, required=False, choices=NETWORK_CHOICES, help='Network to use (default: the fastest, preferring snet)')
+
+    parser = argparse.ArgumentParser(prog=prog, description='Scriptable Cloud Files commands')
+    commands = parser.add_subparsers(dest='command', metavar='{' + ','.join(COMMANDS) + '}')
+
+    list_command = commands.add_parser('ls', parents=[common], help='List the containers, or the objects of a container')
+    list_command.add_argument('container', nargs='?', help='Container to list the objects of')
+    list_command.add_argument('--prefix', type=str, default='', help='Only list the names starting with the prefix')
+    list_command.add_argument('--delimiter', type=str, default='', help='Roll the object names up at the delimiter into pseudo-directories')
+    list_command.add_argument('-l', '--long', action='store_true', help='Also print the sizes, times and ETags, separated by tabs')
+    list_command.set_defaults(handler=List)
+
+    stat_command = commands.add_parser('stat', parents=[common], help='Show the metadata of the account, a container or an object')
+    stat_command.add_argument('container', nargs='?')
+    stat_command.add_argument('object', nargs='?')
+    stat_command.set_defaults(handler=Stat)
+
+    get_command = commands.add_parser('get', parents=[common], help='Write an object to stdout or a file')
+    get_command.add_argument('container')
+    get_command.add_argument('object')
+    get_command.add_argument('-o', '--output', type=str, default='-', help='File to write the object to (default: stdout)')
+    get_command.set_defaults(handler=Get)
+
+    du_command = commands.add_parser('du', parents=[common], help='Show the bytes used by every container, or by a container')
+    du_command.add_argument('container', nargs='?')
+    du_command.add_argument('--prefix', type=str, default='', help='Only count the names starting with the prefix')
+    du_command.add_argument('--human', action='store_true', help='Print the sizes in KiB, MiB, ...')
+    du_command.set_defaults(handler=DiskUsage)
+    return parser
+
+
+def Main(argv, prog=None):
+    """
+    Run a scriptable command
+      argv - command line arguments without the program name, starting with the command
+
+    Returns 0 if the command succeeded; otherwise -1
+    """
+    arguments = BuildParser(prog).parse_args(argv)
+    if arguments.log_config is not None:
+        logging.config.fileConfig(arguments.log_config)
+    else:
+        lh = logging.StreamHandler(sys.stderr)
+        lh.setLevel(logging.WARNING)
+        log = logging.getLogger()
+        log.addHandler(lh)
+        log.setLevel(logging.WARNING)
+
+    import requests
+    try:
+        return arguments.handler(Context(arguments))
+    except (UserWarning, LookupError, requests.exceptions.RequestException) as ex:
+        print(arguments.command + ': ' + str(ex), file=sys.stderr)
+        return -1
+    except (IOError, OSError) as ex:
+        if ex.errno == errno.EPIPE:
+            # The reader went away (e.g. piped into head); nothing more to write
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+            return 0
+        print(arguments.command + ': ' + str(ex), file=sys.stderr)
+        return -1
@@ -2,11 +2,39 @@
 RCBU Authentication API
 """
 import json
-import requests
 import logging
 import datetime
+import calendar
+import os
+import stat
+import threading
+import time
+
+import requests
 
 from rcbu.common.command import Command
+from rcbu.common import retry
+
+
+IDENTITY_HOST = 'identity.api.rackspacecloud.com'
+# Renew the token this many seconds before it expires
+DEFAULT_REFRESH_MARGIN = 5 * 60
+# Suggested location of the token cache; the cache is only used when a path is given
+DEFAULT_TOKEN_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cloudfiles-viewer', 'token.json')
+
+
+def ParseExpirationTime(expiration_time):
+    """
+    Convert an identity expiration time stamp (UTC) to seconds since the epoch
+    """
+    #2013-12-24T14:02:26.550Z
+    for time_format in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            expirationtime = datetime.datetime.strptime(expiration_time, time_format)
+            return calendar.timegm(expirationtime.utctimetuple()) + expirationtime.microsecond / 1000000.0
+        except ValueError:
+            pass
+    raise ValueError('Unknown time format: ' + expiration_time)
 
 
 class Authentication(Command):
@@ -15,7 +43,7 @@ class Authentication(Command):
     Presently supports the RAX v1.0 API
     """
 
-    def __init__(self, username, apikey):
+    def __init__(self, username, apikey, token_cache=None, apihost=IDENTITY_HOST, sslenabled=True):
         """
         Initialize the Agent access
           sslenabled - True if using HTTPS; otherwise False
@@ -23,8 +51,9 @@ class Authentication(Command):
           apihost - server to use for API calls
           username - user for the authentication
           apikey - apikey/password for the given user
+          token_cache - optional file to keep the token and service catalog in between runs
         """
-        Command.__init__(self, True, 'identity.api.rackspacecloud.com', "/v2.0/tokens")
+        Command.__init__(self, sslenabled, apihost, "/v2.0/tokens")
         self.log = logging.getLogger(__name__)
         self.o = {}
         self.o['auth'] = {}
@@ -32,52 +61,72 @@ class Authentication(Command):
         self.o['auth']['RAX-KSKEY:apiKeyCredentials']['username'] = username
         self.o['auth']['RAX-KSKEY:apiKeyCredentials']['apiKey'] = apikey
         self.body = json.dumps(self.o)
+        self.username = username
         self.auth_data = {}
+        # Expiration time of the token in seconds since the epoch; 0 when there is no token
+        self.expires_at = 0.0
+        self.token_lock = threading.Lock()
+        self.refresh_timer = None
+        self.refresh_margin = DEFAULT_REFRESH_MARGIN
+        self.token_cache = token_cache
+        if self.token_cache is not None:
+            self.token_cache = os.path.expanduser(self.token_cache)
+            self.LoadTokenCache()
 
-    def GetToken(self, retry=5):
+    def SetAuthData(self, auth_data):
+        """
+        Replace the authentication data and its parsed expiration time
+        """
+        try:
+            expires_at = ParseExpirationTime(auth_data['access']['token']['expires'])
+        except (LookupError, ValueError) as ex:
+            self.log.error('Unable to determine token expiration: %s', str(ex))
+            expires_at = 0.0
+        self.auth_data = auth_data
+        self.expires_at = expires_at
+
+    def GetToken(self, retries=retry.DEFAULT_RETRIES):
         """
         Retrieve the Authentication Tokey
 
         Note: This may expire quickly. Tokens are valid for 6 hours but are not instance specific
+
+        Besides the retries of every request (see rcbu.common.retry), a 404 from the identity
+        service (reported while it is unavailable) is retried up to retries times with backoff
         """
         self.log.debug('host: %s', self.apihost)
         self.log.debug('body: %s', self.Body)
         self.log.debug('headers: %s', self.Headers)
         self.log.debug('uri: %s', self.Uri)
-        response = requests.post(self.Uri, headers=self.Headers, data=self.Body)
-        if response.status_code is 200:
-            self.auth_data = response.json()
+        attempt = 0
+        response = self.Request('POST', metric='identity')
+        while response.status_code == 404:
+            if attempt >= retries:
+                raise UserWarning('Identity service unavailable after ' + str(attempt + 1) + ' attempts')
+            delay = Command.RetryPolicy().Delay(attempt, response)
+            attempt += 1
+            self.log.error('server return unavailable. Trying again in {0:.2f} seconds ({1} of {2}).'.format(delay, attempt, retries))
+            time.sleep(delay)
+            response = self.Request('POST', metric='identity', retries=attempt)
+
+        if response.status_code == 200:
+            self.SetAuthData(response.json())
             self.log.info('auth token: %s', self.auth_data['access']['token']['id'])
+            self.SaveTokenCache()
             return self.auth_data['access']['token']['id']
-        elif response.status_code is 404:
-            self.log.error('server return unavailable. Trying again up to ' + str(retry) + ' times.')
-            if retry is 0:
-                assert False
-            else:
-                return self.GetToken(retry - 1)
         elif response.status_code >= 400:
             self.log.error('failed to authenticate - ' + str(response.status_code) + ': ' + response.text)
         else:
             self.log.error('failed to authenticate: ' + response.text)
-            self.auth_data = {}
+            self.SetAuthData({})
             return ''
 
-    def IsExpired(self):
+    def IsExpired(self, margin=0):
         """
-        Checks to see if the auth token has expired by comparing its expiration time stamp to the current time in utc
+        Checks to see if the auth token has expired (or expires within margin seconds)
+        by comparing its expiration time to the current time
         """
-        #2013-12-24T14:02:26.550Z
-        expirationtime = datetime.datetime.utcnow()
-        try:
-            expirationtime = datetime.datetime.strptime(self.AuthExpirationTime, "%Y-%m-%dT%H:%M:%S.%fZ")
-        except ValueError:
-            try:
-                expirationtime = datetime.datetime.strptime(self.AuthExpirationTime, "%Y-%m-%dT%H:%M:%S")
-            except ValueError:
-                self.log.error('Unknown time format: %s', self.AuthExpirationTime)
-                assert False
-        nowtime = datetime.datetime.utcnow()
-        if expirationtime > nowtime:
+        if time.time() + margin < self.expires_at:
             self.log.debug('Auth Token is still valid')
             return False
         else:
@@ -95,9 +144,11 @@ class Authentication(Command):
         """
         try:
             if self.IsExpired():
-                return self.GetToken()
-            else:
-                return self.auth_data['access']['token']['id']
+                # Only one thread re-authenticates; the others wait for its token
+                with self.token_lock:
+                    if self.IsExpired():
+                        return self.GetToken()
+            return self.auth_data['access']['token']['id']
         except LookupError:
             raise UserWarning('Unable to retrieve authentication token')
 
@@ -167,3 +218,100 @@ class Authentication(Command):
         except LookupError:
             self.log.error('Unable to retrieve DC URI for the currently authenticated user')
             return {}
+
+    def LoadTokenCache(self):
+        """
+        Load the token and service catalog from the token cache file
+
+        The cache is ignored if it belongs to another user, has expired or is
+        readable by anyone other than its owner. Returns True if it was loaded.
+        """
+        try:
+            if os.stat(self.token_cache).st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+                self.log.error('Ignoring token cache %s: it is accessible by other users', self.token_cache)
+                return False
+            with open(self.token_cache, 'r') as cache_file:
+                cached = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return False
+
+        if cached.get('username') != self.username or cached.get('identity', self.Uri) != self.Uri:
+            return False
+        self.SetAuthData(cached.get('auth_data', {}))
+        if self.IsExpired(self.refresh_margin):
+            self.SetAuthData({})
+            return False
+        self.log.debug('loaded auth token from %s', self.token_cache)
+        return True
+
+    def SaveTokenCache(self):
+        """
+        Write the token and service catalog to the token cache file, readable only by its owner
+
+        The file is written under a temporary name and then renamed over the cache, so
+        a crash while writing never leaves a corrupt cache behind
+        """
+        if self.token_cache is None:
+            return
+        temporary_path = self.token_cache + '.' + str(os.getpid()) + '.tmp'
+        try:
+            cache_dir = os.path.dirname(self.token_cache)
+            if len(cache_dir) and not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, 0o700)
+            cache_fd = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.fchmod(cache_fd, 0o600)
+            with os.fdopen(cache_fd, 'w') as cache_file:
+                json.dump({'username': self.username, 'identity': self.Uri, 'auth_data': self.auth_data}, cache_file)
+            os.rename(temporary_path, self.token_cache)
+        except (IOError, OSError) as ex:
+            self.log.error('Unable to write token cache %s: %s', self.token_cache, str(ex))
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    def StartTokenRefresh(self, margin=DEFAULT_REFRESH_MARGIN):
+        """
+        Renew the token in the background margin seconds before it expires
+
+        Long running transfers then never wait on a synchronous re-authentication.
+        """
+        self.refresh_margin = margin
+        self.__ScheduleRefresh()
+
+    def StopTokenRefresh(self):
+        """
+        Stop renewing the token in the background
+        """
+        with self.token_lock:
+            if self.refresh_timer is not None:
+                self.refresh_timer.cancel()
+                self.refresh_timer = None
+
+    def __ScheduleRefresh(self):
+        """
+        Arm the background refresh for the current token
+        """
+        with self.token_lock:
+            if self.refresh_timer is not None:
+                self.refresh_timer.cancel()
+            delay = max(0.0, self.expires_at - self.refresh_margin - time.time())
+            self.refresh_timer = threading.Timer(delay, self.__RefreshToken)
+            self.refresh_timer.daemon = True
+            self.refresh_timer.start()
+
+    def __RefreshToken(self):
+        """
+        Background refresh: renew the token and re-arm for the new one
+        """
+        with self.token_lock:
+            if self.refresh_timer is None:
+                return
+            self.log.debug('renewing auth token before it expires')
+            try:
+                self.GetToken()
+            except (UserWarning, requests.exceptions.RequestException) as ex:
+                self.log.error('Error renewing the auth token: %s', str(ex))
+        if self.IsExpired(self.refresh_margin):
+            # The renewal failed; leave it to the next AuthToken access
+            self.log.error('Unable to renew the auth token in the background')
+            return
+        self.__ScheduleRefresh()
@@ -0,0 +1,336 @@
+"""
+Rackspace Cloud Files - asyncio API
+
+Requires Python 3.6+ and aiohttp
+"""
+import asyncio
+import hashlib
+import logging
+
+import aiohttp
+from requests.compat import urlparse
+from requests.utils import quote
+
+from rcbu.common.command import Command
+from rcbu.cloud.files import CloudFiles, LISTING_PAGE_SIZE
+
+
+# Maximum number of requests in flight at the same time
+DEFAULT_CONCURRENCY = 64
+DEFAULT_CHUNK_SIZE = 2 ** 20
+
+# Connection failures and timeouts are retried, as rcbu.common.retry.RETRY_EXCEPTIONS are
+RETRY_EXCEPTIONS = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+
+class _Status(object):
+    """
+    Status and headers of an aiohttp response in the form rcbu.common.retry expects
+    """
+
+    def __init__(self, res):
+        self.status_code = res.status
+        self.headers = res.headers
+
+
+class AsyncCloudFiles(object):
+    """
+    asyncio counterpart of rcbu.cloud.files.CloudFiles
+
+    URIs are built the same way as CloudFiles and the token comes from the same
+    rcbu.client.auth.Authentication instance. Requests share one aiohttp session
+    and are limited to concurrency in flight, so thousands of listing and HEAD
+    requests can be issued from a single event loop. They are retried and admitted
+    under the retry policy and per-host limiters shared with every Command (see
+    rcbu.common.retry):
+
+        async with AsyncCloudFiles(True, auth_engine) as cloudfiles:
+            results = await cloudfiles.GetContainersMetadata(uri, names)
+    """
+
+    def __init__(self, sslenabled, authenticator, concurrency=DEFAULT_CONCURRENCY):
+        """
+        Setup the CloudFiles API Class
+          sslenabled - True if using HTTPS; otherwise False
+          authenticator - instance of rcbu.client.auth.Authentication to use
+          concurrency - maximum number of requests in flight at the same time
+        """
+        self.log = logging.getLogger(__name__)
+        self.sslenabled = sslenabled
+        self.authenticator = authenticator
+        self.concurrency = max(1, int(concurrency))
+        self.session = None
+        self.limiter = None
+        self.token_lock = None
+
+    async def Open(self):
+        """
+        Create the HTTP session; must be called from the event loop that uses it
+        """
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.concurrency)
+            headers = {'User-Agent': 'RCBU-Integration-Tests/1.0'}
+            self.session = aiohttp.ClientSession(connector=connector, headers=headers)
+            self.limiter = asyncio.Semaphore(self.concurrency)
+            self.token_lock = asyncio.Lock()
+
+    async def Close(self):
+        """
+        Close the HTTP session and its connections
+        """
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        await self.Open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.Close()
+
+    async def __Headers(self):
+        """
+        Build the request headers with a current auth token
+
+        Re-authentication is blocking so it is run outside of the event loop, by one
+        coroutine at a time; the others wait for its token
+        """
+        token = None
+        if self.authenticator.IsExpired():
+            async with self.token_lock:
+                if self.authenticator.IsExpired():
+                    token = await asyncio.get_event_loop().run_in_executor(None, lambda: self.authenticator.AuthToken)
+        if token is None:
+            token = self.authenticator.AuthToken
+        headers = {}
+        headers['X-Auth-Token'] = token
+        return headers
+
+    def __Uri(self, uri, uripath):
+        """
+        Build the URI of an API call in the same way as CloudFiles
+        """
+        return Command.BuildUri(self.sslenabled, uri, uripath)
+
+    async def __Send(self, method, request_uri, headers):
+        """
+        Issue a request as Command.SendRequest does: connection failures and retryable
+        statuses (e.g. 429 and 503) are retried with backoff, honouring Retry-After, and
+        every attempt waits for room under the limit of its API host
+
+        Returns the last response, which the caller releases; raises the last
+        connection failure once the retries are exhausted
+        """
+        retry_policy = Command.RetryPolicy()
+        limiter = Command.Limiter(urlparse(request_uri).netloc)
+        attempt = 0
+        while True:
+            wait = limiter.TryAcquire()
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = limiter.TryAcquire()
+            res = None
+            try:
+                async with self.limiter:
+                    res = await self.session.request(method, request_uri, headers=headers)
+            except RETRY_EXCEPTIONS as ex:
+                if attempt >= retry_policy.retries:
+                    raise
+                delay = retry_policy.Delay(attempt)
+                self.log.error('{0} {1} failed, retrying in {2:.2f} seconds ({3} of {4}): {5}'.format(
+                    method, request_uri, delay, attempt + 1, retry_policy.retries, str(ex)))
+            finally:
+                limiter.Release(None if res is None else _Status(res))
+            if res is not None:
+                status = _Status(res)
+                if attempt >= retry_policy.retries or not retry_policy.IsRetryable(status):
+                    return res
+                delay = retry_policy.Delay(attempt, status)
+                self.log.error('{0} {1} returned {2}, retrying in {3:.2f} seconds ({4} of {5})'.format(
+                    method, request_uri, res.status, delay, attempt + 1, retry_policy.retries))
+                res.release()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def __GetListing(self, listing_uri, description):
+        """
+        Retrieve a JSON listing, like CloudFiles: empty if the account or container
+        does not exist
+
+        Raises UserWarning if the listing could not be retrieved, so that paging never
+        silently stops early
+        """
+        headers = await self.__Headers()
+        headers['Content-Type'] = 'text/plain; charset=UTF-8'
+        self.log.debug('uri: %s', listing_uri)
+        res = await self.__Send('GET', listing_uri, headers)
+        try:
+            if res.status == 200:
+                # We have a list in JSON format
+                try:
+                    return await res.json(content_type=None)
+                except ValueError as ex:
+                    raise UserWarning('Unable to parse the list of ' + description + ': ' + str(ex))
+            elif res.status == 204:
+                # Nothing left to retrieve
+                return []
+            elif res.status == 404:
+                # The account or container does not exist
+                self.log.error('Error retrieving list of ' + description + ': (code=' + str(res.status) + ')')
+                return []
+            else:
+                # Error; returning what was listed so far would silently truncate the listing
+                self.log.error('Error retrieving list of ' + description + ': (code=' + str(res.status) + ', text="' + await res.text() + '")')
+                raise UserWarning('Unable to retrieve the list of ' + description + ' (code=' + str(res.status) + ')')
+        finally:
+            res.release()
+
+    async def GetContainers(self, uri, limit=-1, marker='', prefix='', end_marker=''):
+        """
+        List the containers for the current account (see CloudFiles.GetContainers)
+        """
+        return await self.__GetListing(self.__Uri(uri, CloudFiles.ListingOptions(limit, marker, prefix, '', end_marker)), 'containers')
+
+    async def GetContainerObjects(self, uri, container, limit=-1, marker='', prefix='', delimiter='', end_marker=''):
+        """
+        List the objects in a container (see CloudFiles.GetContainerObjects)
+        """
+        return await self.__GetListing(self.__Uri(uri, '/' + quote(container) + CloudFiles.ListingOptions(limit, marker, prefix, delimiter, end_marker)), 'objects')
+
+    async def IterContainers(self, uri, limit=LISTING_PAGE_SIZE, marker='', prefix='', end_marker=''):
+        """
+        Asynchronously iterate over every container (see CloudFiles.IterContainers)
+        """
+        if limit <= 0:
+            limit = LISTING_PAGE_SIZE
+        while True:
+            page = await self.GetContainers(uri, limit, marker, prefix, end_marker)
+            for container in page:
+                yield container
+            if len(page) < limit:
+                break
+            marker = CloudFiles.EntryName(page[-1])
+
+    async def IterContainerObjects(self, uri, container, limit=LISTING_PAGE_SIZE, marker='', prefix='', delimiter='', end_marker=''):
+        """
+        Asynchronously iterate over every object in a container (see CloudFiles.IterContainerObjects)
+        """
+        if limit <= 0:
+            limit = LISTING_PAGE_SIZE
+        while True:
+            page = await self.GetContainerObjects(uri, container, limit, marker, prefix, delimiter, end_marker)
+            for cfobject in page:
+                yield cfobject
+            if len(page) < limit:
+                break
+            marker = CloudFiles.EntryName(page[-1])
+
+    async def Head(self, uri, uripath):
+        """
+        Issue a HEAD request
+
+        Returns the response headers, or {} if there is no such account, container or
+        object; raises UserWarning on any other error
+        """
+        head_uri = self.__Uri(uri, uripath)
+        headers = await self.__Headers()
+        self.log.debug('uri: %s', head_uri)
+        res = await self.__Send('HEAD', head_uri, headers)
+        try:
+            if res.status in (200, 204):
+                return res.headers.copy()
+            self.log.error('Error retrieving ' + uripath + ': (code=' + str(res.status) + ')')
+            if res.status == 404:
+                return {}
+            raise UserWarning('Unable to retrieve ' + uripath + ' (code=' + str(res.status) + ')')
+        finally:
+            res.release()
+
+    async def GetContainerMetadata(self, uri, container):
+        """
+        Retrieve the object count and bytes used of a container (see CloudFiles.GetContainerMetadata)
+
+        Returns {} if there is no such container; raises UserWarning on any other error
+        """
+        headers = await self.Head(uri, '/' + quote(container))
+        if not len(headers):
+            return {}
+        metadata = {}
+        metadata['object-count'] = int(headers.get('X-Container-Object-Count', 0))
+        metadata['bytes-used'] = int(headers.get('X-Container-Bytes-Used', 0))
+        return metadata
+
+    async def GetContainersMetadata(self, uri, containers):
+        """
+        Retrieve the metadata of many containers concurrently
+
+        Returns a dictionary of container name to GetContainerMetadata()
+        """
+        results = await asyncio.gather(*[self.GetContainerMetadata(uri, container) for container in containers])
+        return dict(zip(containers, results))
+
+    async def GetObjectMetadata(self, uri, container, name):
+        """
+        Retrieve the headers of an object (HEAD)
+        """
+        return await self.Head(uri, '/' + quote(container) + '/' + quote(name))
+
+    @staticmethod
+    def __WriteChunk(target_file, object_chunk, hashes):
+        """
+        Write a chunk of a download and add it to the digests; run on the executor
+        """
+        target_file.write(object_chunk)
+        for object_hash in hashes:
+            object_hash.update(object_chunk)
+
+    async def DownloadObject(self, uri, container, object_data, localpath, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Stream an object to localpath (see CloudFiles.DownloadObject)
+
+        The MD5 and SHA1 of the object are stored in object_data and the MD5 is checked
+        against the ETag. Returns True; raises UserWarning on failure.
+
+        The file is opened, written and hashed on the executor, one chunk at a time
+        while the next chunk is received, so a slow disk never stalls the event loop.
+        """
+        try:
+            object_uri = self.__Uri(uri, '/' + quote(container) + '/' + quote(object_data['name']))
+        except LookupError:
+            raise UserWarning('Invalid Object Data provided.')
+        headers = await self.__Headers()
+        self.log.debug('uri: %s', object_uri)
+        md5_hash = hashlib.md5()
+        sha1_hash = hashlib.sha1()
+        res = await self.__Send('GET', object_uri, headers)
+        try:
+            if res.status == 404:
+                raise UserWarning('Cloud Files did not find the object')
+            elif res.status >= 300:
+                raise UserWarning('Cloud Files responded unexpectedly during download initiation (Code: ' + str(res.status) + ' )')
+            loop = asyncio.get_event_loop()
+            target_file = await loop.run_in_executor(None, open, localpath, 'wb')
+            pending = None
+            try:
+                async for object_chunk in res.content.iter_chunked(chunk_size):
+                    if pending is not None:
+                        await pending
+                    pending = loop.run_in_executor(None, self.__WriteChunk, target_file, object_chunk, (md5_hash, sha1_hash))
+                if pending is not None:
+                    await pending
+            finally:
+                # Never close the file under a write still running
+                if pending is not None:
+                    await asyncio.wait([pending])
+                await loop.run_in_executor(None, target_file.close)
+            is_manifest = 'X-Static-Large-Object' in res.headers or 'X-Object-Manifest' in res.headers
+            etag = res.headers.get('ETag', '').strip('"')
+        finally:
+            res.release()
+        object_data['md5'] = md5_hash.hexdigest().upper()
+        object_data['sha1'] = sha1_hash.hexdigest().upper()
+        if not is_manifest and len(etag) and etag.upper() != object_data['md5']:
+            raise UserWarning('Downloaded object does not match its ETag (expected ' + etag + ', received ' + object_data['md5'] + ')')
+        self.log.info('Object (' + object_data['name'] + ') was successfully downloaded to ' + localpath)
+        return True
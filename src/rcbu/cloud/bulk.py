@@ -0,0 +1,247 @@
+"""
+Rackspace Cloud Files - Bulk Container Downloads
+"""
+import collections
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import requests
+
+
+DEFAULT_WORKERS = 8
+
+
+def LocalPath(target_dir, name):
+    """
+    Map an object name to a path under target_dir
+
+    Returns None for names that would escape target_dir
+    """
+    target_dir = os.path.abspath(target_dir)
+    localpath = os.path.abspath(os.path.join(target_dir, *name.split('/')))
+    if not localpath.startswith(target_dir + os.sep):
+        return None
+    return localpath
+
+
+def MayBeLocalCopy(localpath, object_data):
+    """
+    Determine whether localpath could hold the object, by size only (no hashing)
+    """
+    try:
+        if os.path.getsize(localpath) != int(object_data['bytes']):
+            return False
+    except OSError:
+        return False
+    return 'hash' in object_data
+
+
+def IsLocalCopy(localpath, object_data):
+    """
+    Determine whether localpath already holds the object, by size and then ETag (MD5)
+    """
+    if not MayBeLocalCopy(localpath, object_data):
+        return False
+    md5_hash = hashlib.md5()
+    with open(localpath, 'rb') as local_file:
+        while True:
+            block = local_file.read(2 ** 20)
+            if not block:
+                break
+            md5_hash.update(block)
+    return md5_hash.hexdigest().upper() == object_data['hash'].upper()
+
+
+def IsDirectoryMarker(object_data):
+    """
+    Determine whether a listing entry is a pseudo-directory marker, which has no content of its own
+    """
+    return object_data['name'].endswith('/') or object_data.get('content_type') == 'application/directory'
+
+
+class BulkDownload(object):
+    """
+    Download every object in a container (or under a prefix) into a local directory tree
+
+    The objects are scheduled by size: most workers take the largest object left while
+    the small object workers take the smallest, so small objects fill the gaps between
+    the large ones instead of all queueing up behind them at the end.
+    """
+
+    def __init__(self, cloudfiles, uri, container, target_dir, prefix='', workers=DEFAULT_WORKERS, download_options=None, on_downloaded=None, reserved_paths=(), on_skipped=None):
+        """
+        Setup the download
+          cloudfiles - instance of rcbu.cloud.files.CloudFiles to copy the settings of
+          uri - Cloud Files URI (host and path) of the account
+          container - container to download
+          target_dir - local directory to download the objects into
+          prefix - only download objects whose names start with prefix
+          workers - number of objects downloaded at the same time
+          download_options - optional dictionary of keyword arguments for DownloadObject
+          on_downloaded - optional function called with (object_data, localpath) from the
+                          worker thread after each object is downloaded
+          reserved_paths - local paths that are never written to (e.g. a manifest kept in target_dir)
+          on_skipped - optional function called with (object_data, localpath) from the worker
+                       thread for each object whose local copy was found to be current
+        """
+        self.log = logging.getLogger(__name__)
+        self.cloudfiles = cloudfiles
+        self.uri = uri
+        self.container = container
+        self.target_dir = target_dir
+        self.prefix = prefix
+        self.workers = max(1, int(workers))
+        self.small_object_workers = max(1, self.workers // 4) if self.workers > 1 else 0
+        self.download_options = download_options or {}
+        self.on_downloaded = on_downloaded
+        self.on_skipped = on_skipped
+        self.reserved_paths = set(os.path.abspath(path) for path in reserved_paths)
+        self.lock = threading.Lock()
+        self.queue = collections.deque()
+        self.stats = {'downloaded': 0, 'skipped': 0, 'failed': 0, 'bytes': 0, 'elapsed': 0.0}
+        self.failures = []
+
+    @property
+    def Stats(self):
+        """
+        Summary of the download: objects 'downloaded', 'skipped' and 'failed',
+        'bytes' transferred, 'elapsed' seconds, 'objects-per-second' and 'bytes-per-second'
+        """
+        stats = dict(self.stats)
+        stats['objects-per-second'] = 0.0
+        stats['bytes-per-second'] = 0.0
+        if stats['elapsed'] > 0:
+            stats['objects-per-second'] = stats['downloaded'] / stats['elapsed']
+            stats['bytes-per-second'] = stats['bytes'] / stats['elapsed']
+        return stats
+
+    @property
+    def Failures(self):
+        """List of (object name, reason) for the objects that could not be downloaded"""
+        return self.failures
+
+    def Schedule(self, objects, check_local=True):
+        """
+        Queue the objects that are not already present locally, largest first
+          check_local - False to queue every object without comparing it with a local copy, or a
+                        function called with each listing entry to decide whether to compare it
+
+        Only the sizes are compared here; local files of the same size are hashed by
+        the workers, so the check runs in parallel and alongside the downloads.
+        """
+        pending = []
+        for object_data in objects:
+            name = object_data['name']
+            if IsDirectoryMarker(object_data):
+                continue
+            localpath = LocalPath(self.target_dir, name)
+            if localpath is None:
+                self.log.error('Skipping object with a name outside the target directory: ' + name)
+                self.failures.append((name, 'invalid local path'))
+                self.stats['failed'] += 1
+            elif localpath in self.reserved_paths:
+                self.log.error('Skipping object with a reserved local path: ' + name)
+                self.failures.append((name, 'reserved local path'))
+                self.stats['failed'] += 1
+            else:
+                verify = check_local(object_data) if callable(check_local) else check_local
+                verify = verify and MayBeLocalCopy(localpath, object_data)
+                pending.append((int(object_data['bytes']), localpath, object_data, verify))
+        pending.sort(key=lambda entry: entry[0], reverse=True)
+        self.queue = collections.deque(pending)
+        self.log.info('Scheduled {0} objects ({1} bytes) for download; {2} to check against a local copy first'.format(len(pending), sum(entry[0] for entry in pending), sum(1 for entry in pending if entry[3])))
+
+    def __NextObject(self, small_objects):
+        """
+        Take the next object off the queue; None when the queue is empty
+        """
+        with self.lock:
+            if not len(self.queue):
+                return None
+            if small_objects:
+                return self.queue.pop()
+            return self.queue.popleft()
+
+    def __Worker(self, small_objects):
+        """
+        Worker: download objects until the queue is empty
+        """
+        downloader = type(self.cloudfiles)(self.cloudfiles.sslenabled, self.cloudfiles.authenticator)
+        while True:
+            entry = self.__NextObject(small_objects)
+            if entry is None:
+                return
+            size, localpath, object_data, verify = entry
+            try:
+                if verify and IsLocalCopy(localpath, object_data):
+                    if self.on_skipped is not None:
+                        self.on_skipped(object_data, localpath)
+                    with self.lock:
+                        self.stats['skipped'] += 1
+                    continue
+                local_dir = os.path.dirname(localpath)
+                if not os.path.isdir(local_dir):
+                    try:
+                        os.makedirs(local_dir)
+                    except OSError:
+                        # Another worker may have created it first
+                        if not os.path.isdir(local_dir):
+                            raise
+                downloader.DownloadObject(self.uri, self.container, object_data, localpath, **self.download_options)
+                if self.on_downloaded is not None:
+                    self.on_downloaded(object_data, localpath)
+                with self.lock:
+                    self.stats['downloaded'] += 1
+                    self.stats['bytes'] += size
+            except (UserWarning, OSError, IOError, requests.exceptions.RequestException) as ex:
+                self.log.error('Unable to download ' + object_data['name'] + ': ' + str(ex))
+                with self.lock:
+                    self.stats['failed'] += 1
+                    self.failures.append((object_data['name'], str(ex)))
+            except Exception as ex:
+                # Anything else would end the worker and leave the rest of the queue unattempted
+                self.log.exception('Unexpected error downloading ' + object_data['name'])
+                with self.lock:
+                    self.stats['failed'] += 1
+                    self.failures.append((object_data['name'], str(ex) or type(ex).__name__))
+
+    def Run(self):
+        """
+        List the container and download every object that is missing or different locally
+
+        Returns True if every object was downloaded (or already present)
+        """
+        start_time = time.time()
+        self.Schedule(self.cloudfiles.IterContainerObjects(self.uri, self.container, prefix=self.prefix))
+        return self.Download(start_time)
+
+    def Download(self, start_time=None):
+        """
+        Download the scheduled objects (see Schedule)
+
+        Returns True if every object was downloaded (or already present)
+        """
+        if start_time is None:
+            start_time = time.time()
+        threads = []
+        for worker_index in range(self.workers):
+            thread = threading.Thread(target=self.__Worker, args=(worker_index < self.small_object_workers,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        # Left behind only if every worker stopped early; never report them as done
+        while len(self.queue):
+            size, localpath, object_data, verify = self.queue.popleft()
+            self.stats['failed'] += 1
+            self.failures.append((object_data['name'], 'not attempted'))
+
+        self.stats['elapsed'] = time.time() - start_time
+        stats = self.Stats
+        self.log.info('Downloaded {0} objects ({1} bytes) in {2:.2f} seconds: {3:.2f} objects/s, {4:.2f} MB/s; {5} skipped, {6} failed'.format(
+            stats['downloaded'], stats['bytes'], stats['elapsed'], stats['objects-per-second'], stats['bytes-per-second'] / 2 ** 20, stats['skipped'], stats['failed']))
+        return stats['failed'] == 0
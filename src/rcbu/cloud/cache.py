@@ -0,0 +1,326 @@
+"""
+Rackspace Cloud Files - Persistent Listing Cache
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+# Suggested location of the listing cache; the cache is only used when a path is given
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cloudfiles-viewer', 'listings.sqlite')
+# Listings older than this many seconds are evicted and re-listed
+DEFAULT_TTL = 24 * 60 * 60
+# Number of rows written to the cache per insert
+STORE_BATCH_SIZE = 1000
+
+# Container listings of an account are stored under this container name
+ACCOUNT_LISTING = ''
+
+_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS listings ('
+    '  account TEXT NOT NULL, region TEXT NOT NULL, container TEXT NOT NULL,'
+    '  entry_count INTEGER NOT NULL, bytes_used INTEGER NOT NULL, fetched_at REAL NOT NULL,'
+    '  PRIMARY KEY (account, region, container))',
+    'CREATE TABLE IF NOT EXISTS entries ('
+    '  account TEXT NOT NULL, region TEXT NOT NULL, container TEXT NOT NULL, name TEXT NOT NULL,'
+    '  bytes INTEGER, count INTEGER, hash TEXT, content_type TEXT, last_modified TEXT,'
+    '  PRIMARY KEY (account, region, container, name))',
+    # Listings being received, until they replace their cached listing
+    'CREATE TABLE IF NOT EXISTS staged_entries ('
+    '  stage TEXT NOT NULL, staged_at REAL NOT NULL, name TEXT NOT NULL,'
+    '  bytes INTEGER, count INTEGER, hash TEXT, content_type TEXT, last_modified TEXT,'
+    '  PRIMARY KEY (stage, name))',
+    # Names removed from a cached listing, until the update is applied
+    'CREATE TABLE IF NOT EXISTS staged_removals ('
+    '  stage TEXT NOT NULL, staged_at REAL NOT NULL, name TEXT NOT NULL,'
+    '  PRIMARY KEY (stage, name))'
+]
+
+_ENTRY_COLUMNS = ('name', 'bytes', 'count', 'hash', 'content_type', 'last_modified')
+
+
+class ListingCache(object):
+    """
+    On-disk (SQLite) cache of container and object listings
+
+    Listings are keyed by account, region and container. A cached listing is served
+    only while it is younger than the TTL and the container (or account) HEAD still
+    reports the object (or container) count and bytes used it was listed with.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=DEFAULT_TTL):
+        """
+        Open (or create) the cache
+          path - SQLite database file
+          ttl - maximum age in seconds of a cached listing
+        """
+        self.log = logging.getLogger(__name__)
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        cache_dir = os.path.dirname(self.path)
+        if len(cache_dir) and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock:
+            with self.db:
+                for statement in _SCHEMA:
+                    self.db.execute(statement)
+        self.Evict()
+
+    def Close(self):
+        """
+        Close the cache database
+        """
+        with self.lock:
+            self.db.close()
+
+    def Evict(self):
+        """
+        Remove every listing older than the TTL
+
+        Returns the number of listings removed
+        """
+        expired_before = time.time() - self.ttl
+        with self.lock:
+            with self.db:
+                expired = self.db.execute('SELECT account, region, container FROM listings WHERE fetched_at < ?', (expired_before,)).fetchall()
+                for key in expired:
+                    self.__Delete(key)
+                # Left behind by a process that stopped while storing a listing
+                self.db.execute('DELETE FROM staged_entries WHERE staged_at < ?', (expired_before,))
+                self.db.execute('DELETE FROM staged_removals WHERE staged_at < ?', (expired_before,))
+        if len(expired):
+            self.log.debug('evicted %d cached listings', len(expired))
+        return len(expired)
+
+    def Invalidate(self, account, region, container=ACCOUNT_LISTING):
+        """
+        Remove a single listing from the cache
+        """
+        with self.lock:
+            with self.db:
+                self.__Delete((account, region, container))
+
+    def __Delete(self, key):
+        """
+        Remove a listing and its entries; the caller holds the lock and transaction
+        """
+        self.db.execute('DELETE FROM entries WHERE account = ? AND region = ? AND container = ?', key)
+        self.db.execute('DELETE FROM listings WHERE account = ? AND region = ? AND container = ?', key)
+
+    def IsValid(self, account, region, container, entry_count, bytes_used):
+        """
+        Determine whether a cached listing may be served
+
+        entry_count and bytes_used are the values currently reported by the HEAD of the
+        container (object count) or of the account (container count)
+        """
+        with self.lock:
+            row = self.db.execute('SELECT entry_count, bytes_used, fetched_at FROM listings WHERE account = ? AND region = ? AND container = ?', (account, region, container)).fetchone()
+        if row is None:
+            return False
+        if row[2] < time.time() - self.ttl:
+            return False
+        return row[0] == entry_count and row[1] == bytes_used
+
+    def Store(self, account, region, container, entry_count, bytes_used, entries):
+        """
+        Replace a cached listing with the entries of an iterable listing
+
+        The entries are written in batches so the listing is never held in memory. The
+        batches are staged, and the lock is only held while each one is written, so
+        other threads keep reading the cache (and the previous listing) while entries
+        are received; the staged listing replaces the cached one in a single
+        transaction once all of it was received.
+        """
+        key = (account, region, container)
+        stage = uuid.uuid4().hex
+        staged_at = time.time()
+        try:
+            batch = []
+            for entry in entries:
+                batch.append((stage, staged_at) + tuple(entry.get(column) for column in _ENTRY_COLUMNS))
+                if len(batch) >= STORE_BATCH_SIZE:
+                    self.__Stage(batch)
+                    batch = []
+            self.__Stage(batch)
+            with self.lock:
+                with self.db:
+                    self.__Delete(key)
+                    self.db.execute('INSERT OR REPLACE INTO entries SELECT ?, ?, ?, ' + ', '.join(_ENTRY_COLUMNS) + ' FROM staged_entries WHERE stage = ?', key + (stage,))
+                    self.db.execute('INSERT INTO listings VALUES (?, ?, ?, ?, ?, ?)', key + (entry_count, bytes_used, time.time()))
+                    self.db.execute('DELETE FROM staged_entries WHERE stage = ?', (stage,))
+            stage = None
+        finally:
+            if stage is not None:
+                with self.lock:
+                    with self.db:
+                        self.db.execute('DELETE FROM staged_entries WHERE stage = ?', (stage,))
+
+    def Update(self, account, region, container, entry_count, bytes_used, entries):
+        """
+        Bring a cached listing up to date with the entries of an iterable listing, in name order
+
+        The listing is merged with the cached entries as it is received and only the
+        entries that were added, changed or removed are staged; they are applied to
+        the cached listing in a single transaction once all of it was received. A
+        listing that is not cached yet is stored in full.
+
+        Returns a tuple of the number of entries added or changed and the number removed
+        """
+        key = (account, region, container)
+        with self.lock:
+            base = self.db.execute('SELECT fetched_at FROM listings WHERE account = ? AND region = ? AND container = ?', key).fetchone()
+        stage = uuid.uuid4().hex
+        staged_at = time.time()
+        changed_count = 0
+        removed_count = 0
+        try:
+            changed = []
+            removed = []
+            cached = self.__Cached(key)
+            cached_row = next(cached, None)
+            for entry in entries:
+                row = tuple(entry.get(column) for column in _ENTRY_COLUMNS)
+                while cached_row is not None and cached_row[0] < row[0]:
+                    removed.append((stage, staged_at, cached_row[0]))
+                    cached_row = next(cached, None)
+                if cached_row is not None and cached_row[0] == row[0]:
+                    is_unchanged = cached_row == row
+                    cached_row = next(cached, None)
+                    if is_unchanged:
+                        continue
+                changed.append((stage, staged_at) + row)
+                if len(changed) >= STORE_BATCH_SIZE:
+                    changed_count += len(changed)
+                    self.__Stage(changed)
+                    changed = []
+                if len(removed) >= STORE_BATCH_SIZE:
+                    removed_count += len(removed)
+                    self.__StageRemovals(removed)
+                    removed = []
+            while cached_row is not None:
+                removed.append((stage, staged_at, cached_row[0]))
+                cached_row = next(cached, None)
+            changed_count += len(changed)
+            removed_count += len(removed)
+            self.__Stage(changed)
+            self.__StageRemovals(removed)
+            with self.lock:
+                with self.db:
+                    current = self.db.execute('SELECT fetched_at FROM listings WHERE account = ? AND region = ? AND container = ?', key).fetchone()
+                    if current != base:
+                        # Replaced or invalidated while listing; the differences no longer apply
+                        self.__Delete(key)
+                        raise UserWarning('The cached listing of ' + (container or region) + ' changed while it was updated')
+                    self.db.execute('INSERT OR REPLACE INTO entries SELECT ?, ?, ?, ' + ', '.join(_ENTRY_COLUMNS) + ' FROM staged_entries WHERE stage = ?', key + (stage,))
+                    self.db.execute('DELETE FROM entries WHERE account = ? AND region = ? AND container = ? AND name IN (SELECT name FROM staged_removals WHERE stage = ?)', key + (stage,))
+                    self.db.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?, ?)', key + (entry_count, bytes_used, time.time()))
+                    self.db.execute('DELETE FROM staged_entries WHERE stage = ?', (stage,))
+                    self.db.execute('DELETE FROM staged_removals WHERE stage = ?', (stage,))
+            stage = None
+        finally:
+            if stage is not None:
+                with self.lock:
+                    with self.db:
+                        self.db.execute('DELETE FROM staged_entries WHERE stage = ?', (stage,))
+                        self.db.execute('DELETE FROM staged_removals WHERE stage = ?', (stage,))
+        return (changed_count, removed_count)
+
+    def __Cached(self, key):
+        """
+        Iterate over the entry rows of a cached listing in name order
+
+        The rows are read a batch at a time and the lock is not held in between
+        """
+        marker = ''
+        while True:
+            with self.lock:
+                rows = self.db.execute('SELECT ' + ', '.join(_ENTRY_COLUMNS) + ' FROM entries WHERE account = ? AND region = ? AND container = ? AND name > ?'
+                                       ' ORDER BY name LIMIT ?', key + (marker, STORE_BATCH_SIZE)).fetchall()
+            if not len(rows):
+                return
+            for row in rows:
+                yield row
+            marker = rows[-1][0]
+
+    def __StageRemovals(self, batch):
+        """
+        Write a batch of staged removal rows in its own transaction
+        """
+        if not len(batch):
+            return
+        with self.lock:
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO staged_removals VALUES (?, ?, ?)', batch)
+
+    def __Stage(self, batch):
+        """
+        Write a batch of staged entry rows in its own transaction
+        """
+        if not len(batch):
+            return
+        with self.lock:
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO staged_entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)', batch)
+
+    def GetPage(self, account, region, container, limit, marker='', pattern=None):
+        """
+        Retrieve a page of a cached listing in the same form as a Cloud Files listing
+
+          limit - maximum number of entries to return
+          marker - only return entries whose names sort after marker
+          pattern - optional glob pattern (see sqlite GLOB) the names must match
+        """
+        query = 'SELECT ' + ', '.join(_ENTRY_COLUMNS) + ' FROM entries WHERE account = ? AND region = ? AND container = ? AND name > ?'
+        arguments = [account, region, container, marker]
+        if pattern is not None:
+            query += ' AND name GLOB ?'
+            arguments.append(pattern)
+        query += ' ORDER BY name LIMIT ?'
+        arguments.append(limit)
+        with self.lock:
+            rows = self.db.execute(query, arguments).fetchall()
+        page = []
+        for row in rows:
+            page.append(dict((column, value) for column, value in zip(_ENTRY_COLUMNS, row) if value is not None))
+        return page
+
+    def Refresh(self, cloudfiles, region, uri, container=ACCOUNT_LISTING):
+        """
+        Validate a cached listing against its HEAD and update it only if it changed (see Update)
+          cloudfiles - instance of rcbu.cloud.files.CloudFiles
+          region - data center of uri
+          uri - Cloud Files URI (host and path) of the account
+          container - container to list; ACCOUNT_LISTING for the account's containers
+
+        Returns True if the listing was retrieved again; False if the cache was current
+        """
+        account = str(cloudfiles.authenticator.AuthId)
+        if container == ACCOUNT_LISTING:
+            metadata = cloudfiles.GetAccountMetadata(uri)
+            entry_count = metadata.get('container-count')
+        else:
+            metadata = cloudfiles.GetContainerMetadata(uri, container)
+            entry_count = metadata.get('object-count')
+        if not len(metadata):
+            # Unable to validate the listing; never serve it
+            self.Invalidate(account, region, container)
+            raise UserWarning('Unable to validate the cached listing of ' + (container or region))
+
+        if self.IsValid(account, region, container, entry_count, metadata['bytes-used']):
+            self.log.debug('cached listing of %s/%s is current', region, container)
+            return False
+
+        self.log.info('Updating the cached listing of ' + (container or region) + '...')
+        if container == ACCOUNT_LISTING:
+            entries = cloudfiles.IterContainers(uri)
+        else:
+            entries = cloudfiles.IterContainerObjects(uri, container)
+        changed_count, removed_count = self.Update(account, region, container, entry_count, metadata['bytes-used'], entries)
+        self.log.debug('cached listing of %s/%s updated: %d added or changed, %d removed', region, container, changed_count, removed_count)
+        return True
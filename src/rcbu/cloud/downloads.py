@@ -0,0 +1,255 @@
+"""
+Rackspace Cloud Files - Background Download Queue
+"""
+import logging
+import os
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import requests
+
+
+DEFAULT_WORKERS = 4
+# Weight of the latest sample in the smoothed transfer rates
+RATE_SMOOTHING = 0.3
+
+STATE_QUEUED = 'queued'
+STATE_DOWNLOADING = 'downloading'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+
+
+def FormatBytes(count):
+    """
+    Format a number of bytes with a binary unit, e.g. 1.5 MiB
+    """
+    count = float(count)
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if count < 1024.0 or unit == 'TiB':
+            break
+        count /= 1024.0
+    if unit == 'B':
+        return '{0:.0f} {1}'.format(count, unit)
+    return '{0:.1f} {1}'.format(count, unit)
+
+
+def FormatDuration(seconds):
+    """
+    Format a number of seconds as H:MM:SS; '--:--' when unknown
+    """
+    if seconds is None:
+        return '--:--'
+    seconds = int(seconds)
+    return '{0}:{1:02d}:{2:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class DownloadQueue(object):
+    """
+    Download objects in the background while the caller carries on
+
+    Objects are added one at a time and downloaded by up to workers threads, each
+    with its own CloudFiles instance. Every download reports its progress as the
+    data arrives; Snapshot() turns it into per-object and total transfer rates and
+    remaining times, smoothed over the calls to it, so a display calling Snapshot()
+    at a fixed rate redraws at that rate however fast the data arrives.
+    """
+
+    def __init__(self, cloudfiles, workers=DEFAULT_WORKERS, download_options=None):
+        """
+        Setup the queue; the worker threads are started by the first Add()
+          cloudfiles - instance of rcbu.cloud.files.CloudFiles to copy the settings of
+          workers - number of objects downloaded at the same time
+          download_options - optional dictionary of keyword arguments for DownloadObject
+        """
+        self.log = logging.getLogger(__name__)
+        self.cloudfiles = cloudfiles
+        self.workers = max(1, int(workers))
+        self.download_options = download_options or {}
+        self.lock = threading.Condition()
+        self.queue = queue.Queue()
+        self.entries = []
+        self.threads = []
+
+    def Add(self, uri, container, object_data, localpath):
+        """
+        Queue an object to be downloaded to localpath
+
+        Returns the queue entry (see Snapshot)
+        """
+        entry = {}
+        entry['uri'] = uri
+        entry['container'] = container
+        entry['name'] = object_data['name']
+        entry['object'] = object_data
+        entry['localpath'] = localpath
+        entry['state'] = STATE_QUEUED
+        entry['error'] = None
+        entry['bytes-total'] = int(object_data.get('bytes', 0))
+        entry['bytes-received'] = 0
+        entry['started'] = None
+        entry['finished'] = None
+        entry['rate'] = 0.0
+        entry['sample'] = None
+        with self.lock:
+            self.entries.append(entry)
+            if len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.__Worker)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        self.queue.put(entry)
+        self.log.info('Queued ' + container + '/' + entry['name'] + ' for download to ' + localpath)
+        return entry
+
+    def __Progress(self, entry, bytes_received, bytes_total):
+        """
+        Record the progress reported by DownloadObject
+        """
+        with self.lock:
+            entry['bytes-received'] = bytes_received
+            entry['bytes-total'] = bytes_total
+
+    def __Worker(self):
+        """
+        Worker: download queued objects
+        """
+        downloader = type(self.cloudfiles)(self.cloudfiles.sslenabled, self.cloudfiles.authenticator)
+        while True:
+            entry = self.queue.get()
+            with self.lock:
+                entry['state'] = STATE_DOWNLOADING
+                entry['started'] = time.time()
+
+            def progress(bytes_received, bytes_total, entry=entry):
+                self.__Progress(entry, bytes_received, bytes_total)
+
+            try:
+                local_dir = os.path.dirname(entry['localpath'])
+                if len(local_dir) and not os.path.isdir(local_dir):
+                    os.makedirs(local_dir)
+                downloader.DownloadObject(entry['uri'], entry['container'], entry['object'], entry['localpath'], progress=progress, **self.download_options)
+                state = STATE_DONE
+                error = None
+            except (UserWarning, OSError, IOError, requests.exceptions.RequestException) as ex:
+                self.log.error('Unable to download ' + entry['name'] + ': ' + str(ex))
+                state = STATE_FAILED
+                error = str(ex)
+            except Exception as ex:
+                # Anything else would end the worker and leave the entry downloading forever
+                self.log.exception('Unexpected error downloading ' + entry['name'])
+                state = STATE_FAILED
+                error = str(ex) or type(ex).__name__
+            with self.lock:
+                entry['state'] = state
+                entry['error'] = error
+                entry['finished'] = time.time()
+                if state == STATE_DONE:
+                    entry['bytes-received'] = entry['bytes-total']
+                self.lock.notify_all()
+
+    def Pending(self):
+        """
+        Number of objects queued or being downloaded
+        """
+        with self.lock:
+            return len([entry for entry in self.entries if entry['state'] in (STATE_QUEUED, STATE_DOWNLOADING)])
+
+    def Wait(self, timeout=None):
+        """
+        Wait for every queued object to be downloaded (or to fail)
+
+        Returns True if nothing is pending any more
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.lock:
+            while len([entry for entry in self.entries if entry['state'] in (STATE_QUEUED, STATE_DOWNLOADING)]):
+                if deadline is None:
+                    self.lock.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.lock.wait(remaining)
+            return True
+
+    def Snapshot(self):
+        """
+        Progress of every object in the queue, and in total
+
+        Returns a tuple of a list of dictionaries of 'container', 'name', 'localpath',
+        'state', 'error', 'bytes-received', 'bytes-total', 'rate' (bytes per second) and
+        'eta' (seconds; None when unknown), and a dictionary of the totals: 'objects',
+        'pending', 'failed', 'bytes-received', 'bytes-total', 'rate' and 'eta'
+        """
+        now = time.time()
+        objects = []
+        totals = {'objects': 0, 'pending': 0, 'failed': 0, 'bytes-received': 0, 'bytes-total': 0, 'rate': 0.0, 'eta': None}
+        with self.lock:
+            for entry in self.entries:
+                if entry['state'] == STATE_DOWNLOADING:
+                    # Rate since the previous snapshot, smoothed
+                    if entry['sample'] is not None and now > entry['sample'][0]:
+                        rate = (entry['bytes-received'] - entry['sample'][1]) / (now - entry['sample'][0])
+                        entry['rate'] = RATE_SMOOTHING * max(0.0, rate) + (1.0 - RATE_SMOOTHING) * entry['rate']
+                    entry['sample'] = (now, entry['bytes-received'])
+                elif entry['state'] == STATE_DONE and entry['finished'] > entry['started']:
+                    entry['rate'] = entry['bytes-total'] / (entry['finished'] - entry['started'])
+                snapshot = dict((key, entry[key]) for key in ('container', 'name', 'localpath', 'state', 'error', 'bytes-received', 'bytes-total', 'rate'))
+                snapshot['eta'] = None
+                if entry['state'] == STATE_DOWNLOADING and entry['rate'] > 0:
+                    snapshot['eta'] = (entry['bytes-total'] - entry['bytes-received']) / entry['rate']
+                elif entry['state'] == STATE_DONE:
+                    snapshot['eta'] = 0.0
+                objects.append(snapshot)
+
+                totals['objects'] += 1
+                if entry['state'] == STATE_FAILED:
+                    totals['failed'] += 1
+                    continue
+                totals['bytes-received'] += entry['bytes-received']
+                totals['bytes-total'] += entry['bytes-total']
+                if entry['state'] in (STATE_QUEUED, STATE_DOWNLOADING):
+                    totals['pending'] += 1
+                if entry['state'] == STATE_DOWNLOADING:
+                    totals['rate'] += entry['rate']
+        if totals['rate'] > 0:
+            totals['eta'] = (totals['bytes-total'] - totals['bytes-received']) / totals['rate']
+        elif not totals['pending']:
+            totals['eta'] = 0.0
+        return (objects, totals)
+
+
+def FormatSnapshot(objects, totals, width=80):
+    """
+    Lines of text showing a Snapshot(): one per object and one for the totals
+    """
+    lines = []
+    for snapshot in objects:
+        if snapshot['state'] == STATE_FAILED:
+            status = 'failed: ' + (snapshot['error'] or '')
+        elif snapshot['state'] == STATE_QUEUED:
+            status = 'queued'
+        elif snapshot['state'] == STATE_DONE:
+            status = 'done {0:>10} at {1:>10}/s'.format(FormatBytes(snapshot['bytes-total']), FormatBytes(snapshot['rate']))
+        else:
+            percent = 100.0
+            if snapshot['bytes-total']:
+                percent = 100.0 * snapshot['bytes-received'] / snapshot['bytes-total']
+            status = '{0:5.1f}% {1:>10} of {2:>10} {3:>10}/s ETA {4}'.format(
+                percent, FormatBytes(snapshot['bytes-received']), FormatBytes(snapshot['bytes-total']), FormatBytes(snapshot['rate']), FormatDuration(snapshot['eta']))
+        name = snapshot['container'] + '/' + snapshot['name']
+        room = max(10, width - len(status) - 2)
+        if len(name) > room:
+            name = '...' + name[len(name) - room + 3:]
+        lines.append(name.ljust(room) + '  ' + status)
+    lines.append('Total: {0} objects, {1} pending, {2} failed; {3} of {4} at {5}/s, ETA {6}'.format(
+        totals['objects'], totals['pending'], totals['failed'], FormatBytes(totals['bytes-received']),
+        FormatBytes(totals['bytes-total']), FormatBytes(totals['rate']), FormatDuration(totals['eta'])))
+    return lines
@@ -0,0 +1,177 @@
+"""
+Rackspace Cloud Files - Compact Listing Entries
+
+Listing responses are parsed incrementally as the response body arrives
+(ParseListing) into __slots__ records instead of dictionaries. The records
+behave like the dictionaries they replace ('name' in entry, entry['bytes'],
+entry.get('hash'), entry['md5'] = ...) so they can be used interchangeably.
+"""
+import codecs
+import json
+import json.scanner
+import re
+import sys
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+try:
+    intern_string = sys.intern
+except AttributeError:
+    intern_string = intern
+
+
+# Bytes read from the response at a time while parsing a listing
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+_SEPARATORS = re.compile(r'[\s,]*')
+_WHITESPACE = re.compile(r'\s*')
+
+
+class ListingEntry(MutableMapping):
+    """
+    Compact mapping of a listing entry
+
+    The keys named in FIELDS are kept in slots; any other key is kept in a
+    dictionary that is only created when needed. Values of the keys in
+    INTERNED are interned so that repeated values share a single string.
+    """
+    __slots__ = ('extra',)
+    FIELDS = frozenset()
+    INTERNED = frozenset()
+
+    def __init__(self, values=None):
+        self.extra = None
+        if values is not None:
+            for key, value in values.items():
+                self[key] = value
+
+    @classmethod
+    def FromDict(cls, values):
+        """
+        Build an entry from a decoded JSON object; the fast path used while parsing
+        """
+        entry = cls.__new__(cls)
+        entry.extra = None
+        fields = cls.FIELDS
+        interned = cls.INTERNED
+        for key, value in values.items():
+            if key in fields:
+                if key in interned and isinstance(value, str):
+                    value = intern_string(value)
+                setattr(entry, key, value)
+            else:
+                if entry.extra is None:
+                    entry.extra = {}
+                entry.extra[key] = value
+        return entry
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self.FIELDS:
+            if key in self.INTERNED and isinstance(value, str):
+                value = intern_string(value)
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self.extra is None:
+            raise KeyError(key)
+        else:
+            del self.extra[key]
+
+    def __iter__(self):
+        for key in self.FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self.extra is not None:
+            for key in self.extra:
+                yield key
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, dict(self.items()))
+
+
+class ContainerEntry(ListingEntry):
+    """
+    Entry of an account (container) listing
+    """
+    __slots__ = ('name', 'count', 'bytes', 'last_modified')
+    FIELDS = frozenset(__slots__)
+
+
+class ObjectEntry(ListingEntry):
+    """
+    Entry of a container (object) listing; 'subdir' entries come from delimiter listings
+    """
+    __slots__ = ('name', 'bytes', 'hash', 'content_type', 'last_modified', 'subdir')
+    FIELDS = frozenset(__slots__)
+    INTERNED = frozenset(['content_type'])
+
+
+def ParseListing(chunks, entry_class=ObjectEntry):
+    """
+    Incrementally parse a JSON listing (an array of objects) into entries
+
+      chunks - iterable of the bytes of the response body, e.g. res.iter_content()
+      entry_class - ListingEntry subclass to build the entries with
+
+    Each entry is yielded as soon as its closing brace has been received, so only
+    the current entry is buffered rather than the whole response. Raises
+    ValueError if the body is not a complete JSON array of objects.
+    """
+    # The scanner decodes a single value at a position, without the per call overhead of raw_decode()
+    scan_once = json.scanner.make_scanner(json.JSONDecoder(object_hook=entry_class.FromDict))
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    position = 0
+    started = False
+    for chunk in chunks:
+        buffer = buffer[position:] + text_decoder.decode(chunk)
+        position = 0
+        while True:
+            if not started:
+                position = _WHITESPACE.match(buffer, position).end()
+                if position == len(buffer):
+                    break
+                if buffer[position] != '[':
+                    raise ValueError('Listing is not a JSON array')
+                started = True
+                position += 1
+            position = _SEPARATORS.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            if buffer[position] == ']':
+                return
+            if buffer[position] != '{':
+                raise ValueError('Listing entry is not a JSON object')
+            try:
+                entry, end = scan_once(buffer, position)
+            except (StopIteration, ValueError):
+                # The entry is not complete yet
+                break
+            position = end
+            yield entry
+    raise ValueError('Listing ended unexpectedly')
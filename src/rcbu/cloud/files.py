@@ -1,11 +1,21 @@
 """
 Rackspace Cloud Files
 """
+import email.utils
 import logging
 import requests
-import hashlib
+import time
+
+from requests.utils import quote
 
 from rcbu.common.command import Command
+from rcbu.cloud import entries
+from rcbu.cloud import listing
+from rcbu.cloud import transfer
+
+
+# Largest page size Cloud Files supports for a listing
+LISTING_PAGE_SIZE = 10000
 
 
 class CloudFiles(Command):
@@ -24,109 +34,526 @@ class CloudFiles(Command):
         self.auth = authenticator
         self.log = logging.getLogger(__name__)
 
-    def GetContainers(self, uri, limit=-1, marker=''):
+    @staticmethod
+    def ListingOptions(limit=-1, marker='', prefix='', delimiter='', end_marker=''):
         """
-        List all containers for the current account
+        Build the URI query string for a container or object listing
         """
-        self.apihost = uri
         urioptions = '?format=json'
-        if not limit is -1:
+        if limit != -1:
             urioptions += '&limit=%d' % limit
         if len(marker):
-            urioptions += '&marker=%s' % marker
+            urioptions += '&marker=%s' % quote(marker, safe='')
+        if len(end_marker):
+            urioptions += '&end_marker=%s' % quote(end_marker, safe='')
+        if len(prefix):
+            urioptions += '&prefix=%s' % quote(prefix, safe='')
+        if len(delimiter):
+            urioptions += '&delimiter=%s' % quote(delimiter, safe='')
+        return urioptions
+
+    @staticmethod
+    def EntryName(entry):
+        """
+        Retrieve the name of a listing entry
+
+        Listings using a delimiter return 'subdir' entries in place of objects
+        """
+        if 'subdir' in entry:
+            return entry['subdir']
+        return entry['name']
+
+    def __StreamListing(self, description, metric, entry_class):
+        """
+        Iterate over the entries of the listing request prepared in self.Uri/self.Headers
+        as they are parsed from the response (see rcbu.cloud.entries.ParseListing)
+        """
+        self.log.debug('uri: %s', self.Uri)
+        self.log.debug('headers: %s', self.Headers)
+        # The request is only sent once iteration starts; keep it independent of later calls
+        return self.__ParseListingResponse(self.Uri, dict(self.Headers), description, metric, entry_class)
+
+    def __ParseListingResponse(self, uri, headers, description, metric, entry_class):
+        """
+        Send a listing request and yield its entries as they are received
+        """
+        res = self.Request('GET', metric=metric, uri=uri, headers=headers, stream=True)
+        received = [0]
+
+        def chunks():
+            for chunk in res.iter_content(chunk_size=entries.DEFAULT_CHUNK_SIZE):
+                received[0] += len(chunk)
+                yield chunk
+
+        try:
+            if res.status_code == 200:
+                # We have a list in JSON format
+                try:
+                    for entry in entries.ParseListing(chunks(), entry_class):
+                        yield entry
+                except ValueError as ex:
+                    # Malformed or cut off; like any other listing error
+                    self.log.error('Error parsing list of ' + description + ': ' + str(ex))
+                    raise UserWarning('Unable to parse the list of ' + description + ': ' + str(ex))
+            elif res.status_code == 204:
+                # Nothing left to retrieve
+                pass
+            elif res.status_code == 404:
+                # The account or container does not exist
+                self.log.error('Error retrieving list of ' + description + ': (code=' + str(res.status_code) + ')')
+            else:
+                # Error; returning what was listed so far would silently truncate the listing
+                self.log.error('Error retrieving list of ' + description + ': (code=' + str(res.status_code) + ', text=\"' + res.text + '\")')
+                raise UserWarning('Unable to retrieve the list of ' + description + ' (code=' + str(res.status_code) + ')')
+        finally:
+            res.close()
+            Command.FinishRequest(res, received[0])
+
+    def StreamContainers(self, uri, limit=-1, marker='', prefix='', end_marker=''):
+        """
+        Iterate over a single page of containers for the current account as it is received
+
+        The containers are rcbu.cloud.entries.ContainerEntry records
+        """
+        self.apihost = uri
+        urioptions = self.ListingOptions(limit, marker, prefix, '', end_marker)
         self.ReInit(self.sslenabled, urioptions)
         self.headers['X-Auth-Token'] = self.authenticator.AuthToken
         self.headers['Content-Type'] = 'text/plain; charset=UTF-8'
-        self.log.debug('uri: %s', self.Uri)
-        self.log.debug('headers: %s', self.Headers)
-        res = requests.get(self.Uri, headers=self.Headers)
-        if res.status_code == 200:
-            # We have a list in JSON format
-            return res.json()
-        elif res.status_code == 204:
-            # Nothing left to retrieve
+        return self.__StreamListing('containers', 'account-listing', entries.ContainerEntry)
+
+    def StreamContainerObjects(self, uri, container, limit=-1, marker='', prefix='', delimiter='', end_marker=''):
+        """
+        Iterate over a single page of objects in a container as it is received
+
+        The objects are rcbu.cloud.entries.ObjectEntry records
+        """
+        self.apihost = uri
+        urioptions = '/' + container + self.ListingOptions(limit, marker, prefix, delimiter, end_marker)
+        self.ReInit(self.sslenabled, urioptions)
+        self.headers['X-Auth-Token'] = self.authenticator.AuthToken
+        self.headers['Content-Type'] = 'text/plain; charset=UTF-8'
+        return self.__StreamListing('objects', 'container-listing', entries.ObjectEntry)
+
+    def GetContainers(self, uri, limit=-1, marker='', prefix='', end_marker=''):
+        """
+        List all containers for the current account
+
+        Raises UserWarning if the listing could not be retrieved
+        """
+        page = list(self.StreamContainers(uri, limit, marker, prefix, end_marker))
+        if not len(page):
+            return {}
+        return page
+
+    def GetContainerObjects(self, uri, container, limit=-1, marker='', prefix='', delimiter='', end_marker=''):
+        """
+        List the objects in a container under the current account
+
+        Raises UserWarning if the listing could not be retrieved
+        """
+        page = list(self.StreamContainerObjects(uri, container, limit, marker, prefix, delimiter, end_marker))
+        if not len(page):
             return {}
+        return page
+
+    def IterContainers(self, uri, limit=LISTING_PAGE_SIZE, marker='', prefix='', end_marker=''):
+        """
+        Iterate over every container for the current account
+
+        Pages of up to limit containers are retrieved lazily, following the marker,
+        and the containers are yielded one at a time as they are received; a limit
+        of -1 (or 0) pages at LISTING_PAGE_SIZE
+        """
+        if limit <= 0:
+            limit = LISTING_PAGE_SIZE
+        while True:
+            count = 0
+            for container in self.StreamContainers(uri, limit, marker, prefix, end_marker):
+                count += 1
+                marker = self.EntryName(container)
+                yield container
+            if count < limit:
+                break
+
+    def IterContainerObjectPages(self, uri, container, limit=LISTING_PAGE_SIZE, marker='', prefix='', delimiter='', end_marker=''):
+        """
+        Iterate over the pages of a container listing
+
+        Pages of up to limit objects are retrieved lazily, following the marker; a
+        limit of -1 (or 0) pages at LISTING_PAGE_SIZE
+        """
+        if limit <= 0:
+            limit = LISTING_PAGE_SIZE
+        while True:
+            page = self.GetContainerObjects(uri, container, limit, marker, prefix, delimiter, end_marker)
+            if len(page):
+                yield page
+            if len(page) < limit:
+                break
+            marker = self.EntryName(page[-1])
+
+    def IterContainerObjects(self, uri, container, limit=LISTING_PAGE_SIZE, marker='', prefix='', delimiter='', end_marker=''):
+        """
+        Iterate over every object in a container
+
+        Pages of up to limit objects are retrieved lazily, following the marker,
+        and the objects (or 'subdir' entries when using a delimiter) are yielded
+        one at a time as they are received; a limit of -1 (or 0) pages at
+        LISTING_PAGE_SIZE
+        """
+        if limit <= 0:
+            limit = LISTING_PAGE_SIZE
+        while True:
+            count = 0
+            for cfobject in self.StreamContainerObjects(uri, container, limit, marker, prefix, delimiter, end_marker):
+                count += 1
+                marker = self.EntryName(cfobject)
+                yield cfobject
+            if count < limit:
+                break
+
+    def IterContainerObjectsParallel(self, uri, container, prefix='', split_points=None, delimiter='', concurrency=listing.DEFAULT_CONCURRENCY, limit=LISTING_PAGE_SIZE, max_buffered_pages=listing.DEFAULT_BUFFERED_PAGES):
+        """
+        Iterate over every object in a container, listing independent ranges of the keyspace in parallel
+
+        The keyspace is split either at split_points (marker/end_marker intervals; defaults
+        to the prefix followed by each alphanumeric character) or, when a delimiter is given,
+        into the 'subdir' prefixes found by a delimiter listing. The objects are yielded
+        as a single name-sorted stream. See rcbu.cloud.listing.ParallelListing
+        """
+        parallel_listing = listing.ParallelListing(self, uri, container, prefix, concurrency, limit, max_buffered_pages)
+        if len(delimiter):
+            parallel_listing.SplitByDelimiter(delimiter)
+        else:
+            parallel_listing.SplitByMarkers(split_points)
+        for cfobject in parallel_listing:
+            yield cfobject
+
+    def GetAccountMetadata(self, uri):
+        """
+        Retrieve the container count and bytes used of the current account (HEAD)
+
+        Returns a dictionary of 'container-count' and 'bytes-used', or {} on error
+        """
+        self.apihost = uri
+        self.ReInit(self.sslenabled, '')
+        self.headers['X-Auth-Token'] = self.authenticator.AuthToken
+        self.log.debug('uri: %s', self.Uri)
+        res = self.Request('HEAD', metric='account-metadata')
+        if res.status_code in (200, 204):
+            metadata = {}
+            metadata['container-count'] = int(res.headers.get('X-Account-Container-Count', 0))
+            metadata['bytes-used'] = int(res.headers.get('X-Account-Bytes-Used', 0))
+            return metadata
         else:
-            # Error
-            self.log.error('Error retrieving list of containers: (code=' + str(res.status_code) + ', text=\"' + res.text + '\")')
+            self.log.error('Error retrieving account metadata: (code=' + str(res.status_code) + ')')
             return {}
 
-    def GetContainerObjects(self, uri, container, limit=-1, marker=''):
+    def GetContainerMetadata(self, uri, container):
         """
-        List the objects in a container under the current account
+        Retrieve the object count and bytes used of a container (HEAD)
+
+        Returns a dictionary of 'object-count' and 'bytes-used', or {} on error
         """
         self.apihost = uri
-        urioptions = '/' + container + '?format=json'
-        if not limit is -1:
-            urioptions += '&limit=%d' % limit
-        if len(marker):
-            urioptions += '&marker=%s' % marker
-        self.ReInit(self.sslenabled, urioptions)
+        self.ReInit(self.sslenabled, '/' + container)
         self.headers['X-Auth-Token'] = self.authenticator.AuthToken
-        self.headers['Content-Type'] = 'text/plain; charset=UTF-8'
         self.log.debug('uri: %s', self.Uri)
-        self.log.debug('headers: %s', self.Headers)
-        res = requests.get(self.Uri, headers=self.Headers)
-        if res.status_code == 200:
-            # We have a list in JSON format
-            return res.json()
-        elif res.status_code == 204:
-            # Nothing left to retrieve
+        res = self.Request('HEAD', metric='container-metadata')
+        if res.status_code in (200, 204):
+            metadata = {}
+            metadata['object-count'] = int(res.headers.get('X-Container-Object-Count', 0))
+            metadata['bytes-used'] = int(res.headers.get('X-Container-Bytes-Used', 0))
+            return metadata
+        else:
+            self.log.error('Error retrieving container metadata: (code=' + str(res.status_code) + ')')
             return {}
+
+    def GetObjectMetadata(self, uri, container, object_name):
+        """
+        Retrieve the size, ETag, content type, modification time and custom metadata of an object (HEAD)
+
+        Returns a dictionary shaped like an object listing entry ('name', 'bytes', 'hash',
+        'content_type' and 'last_modified') along with 'metadata' (the X-Object-Meta-*
+        headers, without the prefix), or {} on error
+        """
+        self.apihost = uri
+        self.ReInit(self.sslenabled, '/' + container + '/' + object_name)
+        self.headers['X-Auth-Token'] = self.authenticator.AuthToken
+        self.log.debug('uri: %s', self.Uri)
+        res = self.Request('HEAD', metric='object-metadata')
+        if res.status_code in (200, 204):
+            metadata = {}
+            metadata['name'] = object_name
+            metadata['bytes'] = int(res.headers.get('Content-Length', 0))
+            metadata['hash'] = res.headers.get('ETag', '').strip('"')
+            metadata['content_type'] = res.headers.get('Content-Type', '')
+            metadata['last_modified'] = ''
+            last_modified = email.utils.parsedate_tz(res.headers.get('Last-Modified', ''))
+            if last_modified is not None:
+                # Same form as the listings
+                metadata['last_modified'] = time.strftime('%Y-%m-%dT%H:%M:%S.000000', time.gmtime(email.utils.mktime_tz(last_modified)))
+            metadata['metadata'] = {}
+            for header, value in res.headers.items():
+                if header.lower().startswith('x-object-meta-'):
+                    metadata['metadata'][header[len('x-object-meta-'):]] = value
+            return metadata
         else:
-            # Error
-            self.log.error('Error retrieving list of containers: (code=' + str(res.status_code) + ', text=\"' + res.text + '\")')
+            self.log.error('Error retrieving object metadata: (code=' + str(res.status_code) + ')')
             return {}
 
-    def DownloadObject(self, uri, container, object_data,  localpath):
+    def DownloadObject(self, uri, container, object_data,  localpath, part_size=transfer.DEFAULT_PART_SIZE, concurrency=1, resume=False, digests=transfer.DEFAULT_DIGESTS, io_mode=transfer.DEFAULT_IO_MODE, progress=None):
         """
         Download the object
+
+        When concurrency is greater than 1 objects larger than part_size are retrieved
+        as concurrent ranged GETs (see rcbu.cloud.transfer.RangedDownload)
+
+        An interrupted download is retried with backoff (see rcbu.common.retry). When resume
+        is True the progress is kept in a journal next to localpath (see
+        rcbu.cloud.transfer.DownloadJournal); the download is then retried from where it
+        stopped, and a later call continues it in the same way; otherwise it starts over
+
+        digests selects the digests computed (see rcbu.cloud.transfer.DIGEST_CHOICES) and
+        stored in object_data; the ETag is only checked when the MD5 is computed
+
+        io_mode selects how the body is moved to disk (see rcbu.cloud.transfer.IO_CHOICES); by
+        default the target is preallocated and the connection is read into reusable buffers
+
+        progress is an optional callable given the number of bytes of the object on disk
+        or received so far and the size of the object, called from the receiving thread(s)
+        as the data arrives; the progress is then no longer logged
         """
         self.apihost = uri
         try:
             self.ReInit(self.sslenabled, '/' + container + '/' + object_data['name'])
-            self.headers['X-Auth-Token'] = self.authenticator.AuthToken
-            self.log.debug('uri: %s', self.Uri)
-            self.log.debug('headers: %s', self.Headers)
+            # Digests of any earlier download are replaced by the selected ones
+            object_data.pop('md5', None)
+            object_data.pop('sha1', None)
+            journal = None
+            if resume:
+                journal = transfer.DownloadJournal(localpath, self.Uri, object_data.get('bytes'), object_data.get('hash'))
+            if concurrency > 1 and int(object_data.get('bytes', 0)) > part_size:
+                return self.__DownloadObjectRanged(object_data, localpath, part_size, concurrency, journal, digests, io_mode, progress)
+
+            attempt = 0
+            while True:
+                try:
+                    return self.__DownloadObjectStream(object_data, localpath, journal, digests, attempt, io_mode, progress)
+                except requests.exceptions.RequestException as ex:
+                    if attempt >= transfer.DEFAULT_RETRIES:
+                        raise
+                    delay = Command.RetryPolicy().Delay(attempt)
+                    attempt += 1
+                    self.log.error('Download interrupted, retrying in {0:.2f} seconds ({1} of {2}): {3}'.format(delay, attempt, transfer.DEFAULT_RETRIES, str(ex)))
+                    time.sleep(delay)
+        except LookupError:
+            raise UserWarning('Invalid Object Data provided.')
+
+    def __DownloadObjectStream(self, object_data, localpath, journal, digests, attempt=0, io_mode=transfer.DEFAULT_IO_MODE, object_progress=None):
+        """
+        Download the object at self.Uri as a single stream, continuing from the journal if any
+
+        Writing and hashing run on a separate thread (see rcbu.cloud.transfer.ReceiveBody)
+        """
+        hashes = transfer.NewHashes(digests)
+        offset = 0
+        if journal is not None and journal.Load() and 0 in journal.Completed:
+            # Rebuild the running hashes from the bytes already on disk
+            offset = journal.Completed[0][0]
+            transfer.HashFile(localpath, length=offset, hashes=hashes)
+
+        self.headers = {}
+        self.headers['X-Auth-Token'] = self.authenticator.AuthToken
+        if offset:
+            self.headers['Range'] = 'bytes={0}-'.format(offset)
+        self.log.debug('uri: %s', self.Uri)
+        self.log.debug('headers: %s', self.Headers)
+        try:
+            res = self.Request('GET', metric='object-download', retries=attempt, stream=True)
+        except requests.exceptions.SSLError as ex:
+            self.log.error('Request SSLError: {0}'.format(str(ex)))
+            res = self.Request('GET', metric='object-download', retries=attempt + 1, stream=True, verify=False)
+
+        if res.status_code >= 300:
+            Command.FinishRequest(res, 0)
+        if res.status_code == 404:
+            raise UserWarning('Cloud Files did not find the object')
+
+        elif res.status_code >= 300:
+            raise UserWarning('Cloud Files responded unexpecteduing during download initiation (Code: ' + str(res.status_code) + ' )')
+        else:
+            if offset and res.status_code != 206:
+                # The range was not honoured; start over
+                offset = 0
+                hashes = transfer.NewHashes(digests)
+            if journal is not None and not offset:
+                journal.Start()
+
+            meter = {}
+            meter['bytes-total'] = int(res.headers['Content-Length'])
+            meter['bytes-received'] = 0
+            meter['bar-count'] = 50
+            meter['bars-completed'] = 0
+            meter['block-size'] = transfer.BlockSize(meter['bytes-total'])
+            self.log.info('Downloading object: {0} bytes...'.format(meter['bytes-total']))
+            if object_progress is None:
+                self.log.info('[' + ' ' * meter['bar-count'] + ']')
+            else:
+                object_progress(offset, offset + meter['bytes-total'])
+
+            # Journal progress is recorded by the writer once the data is on disk
+            def checkpoint(bytes_written):
+                journal.Record(0, offset + bytes_written)
+
+            def progress(bytes_received):
+                meter['bytes-received'] = bytes_received
+                if object_progress is not None:
+                    object_progress(offset + bytes_received, offset + meter['bytes-total'])
+                    return
+                bars = meter['bytes-received'] * meter['bar-count'] // max(1, meter['bytes-total'])
+                if bars > meter['bars-completed']:
+                    meter['bars-completed'] = min(bars, meter['bar-count'])
+                    self.log.info('[' + '-' * meter['bars-completed'] + ' ' * (meter['bar-count'] - meter['bars-completed']) + ']')
+
+            start_time = time.time()
             try:
-                res = requests.get(self.Uri, headers=self.Headers)
-            except request.exceptions.SSLError as ex:
-                self.log.error('Request SSLError: {0}'.format(str(ex)))
-                res = requests.get(self.Uri, headers=self.Headers, verify=False)
+                transfer.ReceiveBody(res, localpath, offset, meter['bytes-total'], hashes, io_mode, meter['block-size'],
+                                     checkpoint if journal is not None else None, max(1, meter['bytes-total'] // meter['bar-count']), progress)
+            finally:
+                res.close()
+                Command.FinishRequest(res, meter['bytes-received'])
+            elapsed = time.time() - start_time
+            if elapsed > 0:
+                object_data['download-rate'] = meter['bytes-received'] / elapsed
+            transfer.StoreDigests(object_data, hashes)
+            self.__VerifyETag(object_data, res.headers, journal)
+            self.log.info('VaultDB (' + object_data['name'] + ') was successfully downloaded to ' + localpath)
+            return True
+
+    def StreamObject(self, uri, container, object_data, output, digests=transfer.DEFAULT_DIGESTS, io_mode=transfer.DEFAULT_IO_MODE, max_buffered=transfer.DEFAULT_PIPELINE_DEPTH):
+        """
+        Write the object to a writable binary stream (e.g. sys.stdout.buffer, a pipe or a socket
+        file) instead of a local file, so it can be fed straight into another program
+
+          output - file object whose write() writes all of the data given to it
+          digests - digests computed on the way and stored in object_data (see rcbu.cloud.transfer.DIGEST_CHOICES)
+          io_mode - how the body is read (see rcbu.cloud.transfer.PipeBody)
+          max_buffered - number of buffers that may wait for output; a slow reader of
+                         output slows the download down instead of growing the memory used
+
+        An interrupted stream is continued with a ranged GET from where it stopped, so
+        the output is never repeated. Raises UserWarning if the object can not be streamed
+        or does not match its ETag (after it was written to output).
+        """
+        self.apihost = uri
+        try:
+            self.ReInit(self.sslenabled, '/' + container + '/' + object_data['name'])
+        except LookupError:
+            raise UserWarning('Invalid Object Data provided.')
+        object_data.pop('md5', None)
+        object_data.pop('sha1', None)
+        hashes = transfer.NewHashes(digests)
+        meter = {'bytes-received': 0, 'etag': None}
+        start_time = time.time()
+        pipeline = transfer.WritePipeline(output, hashes, max_buffered)
+        try:
+            attempt = 0
+            while True:
+                try:
+                    headers = self.__StreamObjectBody(pipeline, meter, attempt, io_mode)
+                    break
+                except requests.exceptions.RequestException as ex:
+                    if attempt >= transfer.DEFAULT_RETRIES:
+                        raise
+                    delay = Command.RetryPolicy().Delay(attempt)
+                    attempt += 1
+                    self.log.error('Stream interrupted after {0} bytes, continuing in {1:.2f} seconds ({2} of {3}): {4}'.format(
+                        meter['bytes-received'], delay, attempt, transfer.DEFAULT_RETRIES, str(ex)))
+                    time.sleep(delay)
+        finally:
+            pipeline.Close()
+        try:
+            output.flush()
+        except (IOError, OSError) as ex:
+            raise UserWarning('Unable to write the download: ' + str(ex))
 
+        elapsed = time.time() - start_time
+        object_data['bytes'] = meter['bytes-received']
+        if elapsed > 0:
+            object_data['download-rate'] = meter['bytes-received'] / elapsed
+        transfer.StoreDigests(object_data, hashes)
+        self.__VerifyETag(object_data, headers, None)
+        self.log.info('VaultDB (' + object_data['name'] + ') was successfully streamed ({0} bytes)'.format(meter['bytes-received']))
+        return True
+
+    def __StreamObjectBody(self, pipeline, meter, attempt, io_mode):
+        """
+        Queue the body of the object at self.Uri to the pipeline, from meter['bytes-received'] on
+
+        Returns the response headers
+        """
+        offset = meter['bytes-received']
+        self.headers = {}
+        self.headers['X-Auth-Token'] = self.authenticator.AuthToken
+        if offset:
+            self.headers['Range'] = 'bytes={0}-'.format(offset)
+        self.log.debug('uri: %s', self.Uri)
+        self.log.debug('headers: %s', self.Headers)
+        res = self.Request('GET', metric='object-stream', retries=attempt, stream=True)
+        try:
             if res.status_code == 404:
                 raise UserWarning('Cloud Files did not find the object')
-
             elif res.status_code >= 300:
                 raise UserWarning('Cloud Files responded unexpecteduing during download initiation (Code: ' + str(res.status_code) + ' )')
-            else: 
-                meter = {}
-                meter['bytes-remaining'] = int(res.headers['Content-Length'])
-                meter['bar-count'] = 50
-                meter['bytes-per-bar'] = meter['bytes-remaining'] // meter['bar-count']
-                meter['block-size'] = min(2 ** 12, meter['bytes-per-bar'])
-                meter['chunks-per-bar'] = meter['bytes-per-bar'] // meter['block-size']
-                meter['chunks'] = 0
-                meter['bars-remaining'] = meter['bar-count']
-                meter['bars-completed'] = 0
-                self.log.info('Downloading object: {0} bytes...'.format(meter['bytes-remaining']))
-                self.log.info('[' + ' ' * meter['bar-count'] + ']')
-                md5_hash = hashlib.md5()
-                sha1_hash = hashlib.sha1()
-                with open(localpath, 'wb') as target_file:
-                    for object_chunk in res.iter_content(chunk_size=meter['block-size']):
-                        target_file.write(object_chunk)
-                        md5_hash.update(object_chunk)
-                        sha1_hash.update(object_chunk)
-                        meter['chunks'] += 1
-                        if meter['chunks'] == meter['chunks-per-bar']:
-                            meter['chunks'] = 0
-                            meter['bars-completed'] += 1
-                            meter['bars-remaining'] -= 1
-                            self.log.info('[' + '-' * meter['bars-completed'] + ' ' * meter['bars-remaining'] + ']')
-                object_data['md5'] = md5_hash.hexdigest().upper()
-                object_data['sha1'] = sha1_hash.hexdigest().upper()
-                self.log.info('VaultDB (' + object_data['name'] + ') was successfully downloaded to ' + localpath)
-                return True
-        except LookupError:
-            raise UserWarning('Invalid Object Data provided.')
+            etag = res.headers.get('ETag')
+            if offset and (res.status_code != 206 or etag != meter['etag']):
+                # Whatever was written to the output can not be taken back
+                raise UserWarning('Unable to continue the stream: the range was not honoured or the object changed')
+            meter['etag'] = etag
+
+            def progress(bytes_received):
+                meter['bytes-received'] = offset + bytes_received
+
+            transfer.PipeBody(res, pipeline, io_mode, transfer.BlockSize(int(res.headers.get('Content-Length', 0))), progress)
+            return res.headers
+        finally:
+            res.close()
+            Command.FinishRequest(res, meter['bytes-received'] - offset)
+
+    def __VerifyETag(self, object_data, headers, journal):
+        """
+        Compare the MD5 of the downloaded object with its ETag
+
+        The journal, if any, is removed either way as the download can not be resumed further
+        """
+        if journal is not None:
+            journal.Remove()
+        if 'md5' not in object_data:
+            # Verification was not selected
+            return
+        if 'X-Static-Large-Object' in headers or 'X-Object-Manifest' in headers:
+            # Large Object manifests report an ETag that is not the MD5 of the body
+            return
+        etag = headers.get('ETag', object_data.get('hash', '')).strip('"')
+        if len(etag) and etag.upper() != object_data['md5']:
+            raise UserWarning('Downloaded object does not match its ETag (expected ' + etag + ', received ' + object_data['md5'] + ')')
+
+    def __DownloadObjectRanged(self, object_data, localpath, part_size, concurrency, journal, digests, io_mode, progress):
+        """
+        Download the object at self.Uri as concurrent byte ranges
+        """
+        self.log.debug('uri: %s', self.Uri)
+        downloader = transfer.RangedDownload(self.authenticator, self.Uri, int(object_data['bytes']), localpath, part_size, concurrency, journal=journal, io_mode=io_mode, progress=progress)
+        downloader.Run()
+        transfer.StoreDigests(object_data, transfer.HashFile(localpath, digests))
+        object_data['download-rate'] = downloader.Throughput
+        headers = {}
+        if downloader.is_manifest:
+            headers['X-Static-Large-Object'] = 'True'
+        if downloader.etag:
+            headers['ETag'] = downloader.etag
+        self.__VerifyETag(object_data, headers, journal)
+        self.log.info('VaultDB (' + object_data['name'] + ') was successfully downloaded to ' + localpath)
+        return True
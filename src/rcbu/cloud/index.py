@@ -0,0 +1,411 @@
+"""
+Rackspace Cloud Files - Compact Object Index
+
+Keeps the listing of a container in columns rather than as one dictionary per
+object so that millions of objects can be searched, sorted and summarized in
+memory:
+
+    names - one string of '\\x00' separated names, with an array of offsets
+    sizes - array of sizes in bytes
+    mtimes - array of last modified times in seconds since the epoch
+    hashes - 16 bytes per object (the binary MD5 of the ETag)
+    content types - array of codes into a table of the distinct content types
+
+Name searches run as a single regular expression (or substring) scan over the
+names string instead of a Python loop over the objects.
+"""
+import array
+import bisect
+import binascii
+import calendar
+import datetime
+import heapq
+import logging
+import re
+import time
+
+from rcbu.cloud.entries import ObjectEntry
+
+
+_SEPARATOR = '\x00'
+_NO_HASH = b'\x00' * 16
+# Number of names joined into the names string at a time while building
+_NAME_BATCH = 65536
+
+SORT_NAME = 'name'
+SORT_SIZE = 'size'
+SORT_DATE = 'date'
+SORT_CHOICES = (SORT_NAME, SORT_SIZE, SORT_DATE)
+
+
+def GlobToRegex(pattern):
+    """
+    Translate a glob pattern (*, ? and [...]) into a regular expression matching
+    a whole name, and the separator before it, within the '\\x00' separated names string
+
+    Starting with the literal separator rather than a look-behind lets the regular
+    expression engine skip ahead to the next name.
+    """
+    regex = []
+    index = 0
+    while index < len(pattern):
+        character = pattern[index]
+        index += 1
+        if character == '*':
+            regex.append('[^\\x00]*')
+        elif character == '?':
+            regex.append('[^\\x00]')
+        elif character == '[':
+            end = index
+            if end < len(pattern) and pattern[end] in '!^':
+                end += 1
+            if end < len(pattern) and pattern[end] == ']':
+                end += 1
+            end = pattern.find(']', end)
+            if end < 0:
+                regex.append('\\[')
+            else:
+                members = pattern[index:end].replace('\\', '\\\\')
+                index = end + 1
+                if members[0] in '!^':
+                    regex.append('[^\\x00' + members[1:] + ']')
+                else:
+                    regex.append('[' + members + ']')
+        else:
+            regex.append(re.escape(character))
+    return re.compile('\\x00' + ''.join(regex) + '(?=\\x00)')
+
+
+def ParseLastModified(last_modified, day_cache):
+    """
+    Convert a listing time stamp (UTC, e.g. 2014-01-01T00:00:00.000000) to seconds since the epoch
+
+      day_cache - dictionary memoizing the epoch of each date
+    """
+    try:
+        date = last_modified[:10]
+        day = day_cache.get(date)
+        if day is None:
+            day = day_cache[date] = calendar.timegm((int(date[0:4]), int(date[5:7]), int(date[8:10]), 0, 0, 0))
+        return day + int(last_modified[11:13]) * 3600 + int(last_modified[14:16]) * 60 + float(last_modified[17:])
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def FormatLastModified(mtime):
+    """
+    Convert seconds since the epoch back to the listing time stamp format
+    """
+    return datetime.datetime.utcfromtimestamp(mtime).strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+
+class _Names(object):
+    """
+    Read-only sequence view of the names in an ObjectIndex, for bisect
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, position):
+        return self.index.Name(position)
+
+
+class ObjectIndex(object):
+    """
+    Column-oriented index of the objects in a container
+    """
+
+    def __init__(self):
+        self.log = logging.getLogger(__name__)
+        self.name_chunks = [_SEPARATOR]
+        self.pending_names = []
+        self.name_length = 1
+        self.names = None
+        self.offsets = array.array('L')
+        self.sizes = array.array('q')
+        self.mtimes = array.array('d')
+        self.hashes = bytearray()
+        self.content_type_codes = array.array('L')
+        self.content_types = []
+        self.content_type_lookup = {}
+        self.day_cache = {}
+        # Listings arrive in name order; prefix usage relies on it
+        self.ordered = True
+        self.last_name = None
+        self.sort_cache = {}
+
+    def __len__(self):
+        return len(self.sizes)
+
+    @classmethod
+    def FromListing(cls, objects):
+        """
+        Build an index from an iterable of listing entries (e.g. CloudFiles.IterContainerObjects)
+        """
+        index = cls()
+        start_time = time.time()
+        index.Extend(objects)
+        index.log.info('Indexed {0} objects in {1:.2f} seconds'.format(len(index), time.time() - start_time))
+        return index
+
+    def Add(self, object_data):
+        """
+        Add a single listing entry; 'subdir' entries are ignored
+        """
+        if 'subdir' in object_data:
+            return
+        name = object_data['name']
+        if self.ordered and self.last_name is not None and name <= self.last_name:
+            self.ordered = False
+        self.last_name = name
+        self.offsets.append(self.name_length)
+        self.pending_names.append(name)
+        self.name_length += len(name) + 1
+        if len(self.pending_names) >= _NAME_BATCH:
+            self.__FlushNames()
+
+        self.sizes.append(int(object_data.get('bytes', 0)))
+        self.mtimes.append(ParseLastModified(object_data.get('last_modified'), self.day_cache))
+        try:
+            self.hashes.extend(binascii.unhexlify(object_data.get('hash', '')))
+        except (TypeError, ValueError):
+            self.hashes.extend(_NO_HASH)
+        if len(self.hashes) % 16:
+            # Not an MD5; keep the column aligned
+            del self.hashes[len(self.hashes) - len(self.hashes) % 16:]
+            self.hashes.extend(_NO_HASH)
+        content_type = object_data.get('content_type', '')
+        code = self.content_type_lookup.get(content_type)
+        if code is None:
+            code = self.content_type_lookup[content_type] = len(self.content_types)
+            self.content_types.append(content_type)
+        self.content_type_codes.append(code)
+        self.names = None
+        self.sort_cache = {}
+
+    def Extend(self, objects):
+        """
+        Add every listing entry of an iterable
+        """
+        for object_data in objects:
+            self.Add(object_data)
+        self.__FlushNames()
+
+    def ExtendColumns(self, names, sizes, mtimes, hashes, content_type_codes, content_types):
+        """
+        Add objects given column by column (e.g. a block of an rcbu.cloud.manifest columnar manifest)
+          names - list of names
+          sizes, mtimes - arrays of sizes and last modified times (seconds since the epoch)
+          hashes - 16 bytes (binary MD5) per object
+          content_type_codes - array of codes into content_types
+          content_types - list of content types
+        """
+        if not len(names):
+            return
+        if self.ordered and (self.last_name is not None and names[0] <= self.last_name or any(names[position] >= names[position + 1] for position in range(len(names) - 1))):
+            self.ordered = False
+        self.last_name = names[len(names) - 1]
+        self.__FlushNames()
+        offset = self.name_length
+        offsets = array.array('L', [0] * len(names))
+        for position, name in enumerate(names):
+            offsets[position] = offset
+            offset += len(name) + 1
+        self.offsets.extend(offsets)
+        self.name_chunks.append(_SEPARATOR.join(names) + _SEPARATOR)
+        self.name_length = offset
+        self.sizes.extend(sizes)
+        self.mtimes.extend(mtimes)
+        self.hashes.extend(hashes)
+        # Map the codes of the block onto the content types of the index
+        mapping = []
+        for content_type in content_types:
+            code = self.content_type_lookup.get(content_type)
+            if code is None:
+                code = self.content_type_lookup[content_type] = len(self.content_types)
+                self.content_types.append(content_type)
+            mapping.append(code)
+        self.content_type_codes.extend(array.array('L', [mapping[code] for code in content_type_codes]))
+        self.names = None
+        self.sort_cache = {}
+
+    def __FlushNames(self):
+        """
+        Move the names added since the last flush into the names string chunks
+        """
+        if len(self.pending_names):
+            self.name_chunks.append(_SEPARATOR.join(self.pending_names) + _SEPARATOR)
+            self.pending_names = []
+            self.names = None
+
+    def __Names(self):
+        """
+        The '\\x00' separated names string
+        """
+        if self.names is None:
+            self.__FlushNames()
+            self.names = ''.join(self.name_chunks)
+            self.name_chunks = [self.names]
+        return self.names
+
+    def Name(self, position):
+        """
+        Name of the object at a position in the index
+        """
+        names = self.__Names()
+        start = self.offsets[position]
+        return names[start:names.index(_SEPARATOR, start)]
+
+    def Entry(self, position):
+        """
+        Listing entry (rcbu.cloud.entries.ObjectEntry) of the object at a position in the index
+        """
+        entry = ObjectEntry()
+        entry['name'] = self.Name(position)
+        entry['bytes'] = self.sizes[position]
+        entry['last_modified'] = FormatLastModified(self.mtimes[position])
+        object_hash = bytes(self.hashes[position * 16:position * 16 + 16])
+        if object_hash != _NO_HASH:
+            entry['hash'] = binascii.hexlify(object_hash).decode('ascii')
+        entry['content_type'] = self.content_types[self.content_type_codes[position]]
+        return entry
+
+    def __Position(self, offset):
+        """
+        Position of the object whose name contains the names string offset
+        """
+        return bisect.bisect_right(self.offsets, offset) - 1
+
+    def Search(self, pattern):
+        """
+        Find the objects whose names match a glob pattern (when it contains *, ? or [)
+        or otherwise contain pattern as a substring
+
+        Returns the positions of the matching objects in index order
+        """
+        names = self.__Names()
+        matches = array.array('L')
+        if any(character in pattern for character in '*?['):
+            for match in GlobToRegex(pattern).finditer(names):
+                matches.append(self.__Position(match.start() + 1))
+            return matches
+        if not len(pattern):
+            return array.array('L', range(len(self)))
+        offset = names.find(pattern)
+        while offset >= 0:
+            position = self.__Position(offset)
+            matches.append(position)
+            # Continue after the end of the matching name
+            offset = names.find(pattern, names.index(_SEPARATOR, offset + len(pattern)))
+        return matches
+
+    def Sorted(self, key=SORT_NAME, reverse=False, positions=None):
+        """
+        Order objects by name, size or date (see SORT_CHOICES)
+          positions - positions to order; defaults to every object
+
+        Returns a list of positions. The full ordering of each key is computed once and
+        kept, so ordering a search result or the whole index again is fast.
+        """
+        if key not in SORT_CHOICES:
+            raise UserWarning('Unknown sort key: ' + key)
+        order = self.sort_cache.get(key)
+        if order is None:
+            if key == SORT_NAME:
+                if self.ordered:
+                    order = array.array('L', range(len(self)))
+                else:
+                    order = array.array('L', sorted(range(len(self)), key=self.Name))
+            elif key == SORT_SIZE:
+                order = array.array('L', sorted(range(len(self)), key=self.sizes.__getitem__))
+            else:
+                order = array.array('L', sorted(range(len(self)), key=self.mtimes.__getitem__))
+            self.sort_cache[key] = order
+        if positions is None:
+            result = list(order)
+        else:
+            selected = set(positions)
+            result = [position for position in order if position in selected]
+        if reverse:
+            result.reverse()
+        return result
+
+    def Largest(self, count=10, positions=None):
+        """
+        Positions of the count largest objects, largest first
+        """
+        if positions is None:
+            positions = range(len(self))
+        return heapq.nlargest(count, positions, key=self.sizes.__getitem__)
+
+    def Stats(self, positions=None):
+        """
+        Aggregate statistics: 'objects', 'bytes', 'largest', 'smallest', 'oldest' and
+        'newest' (times in seconds since the epoch), of every object or of positions
+        """
+        if positions is None:
+            sizes = self.sizes
+            mtimes = self.mtimes
+        else:
+            sizes = [self.sizes[position] for position in positions]
+            mtimes = [self.mtimes[position] for position in positions]
+        stats = {'objects': len(sizes), 'bytes': 0, 'largest': 0, 'smallest': 0, 'oldest': 0.0, 'newest': 0.0}
+        if len(sizes):
+            stats['bytes'] = sum(sizes)
+            stats['largest'] = max(sizes)
+            stats['smallest'] = min(sizes)
+            stats['oldest'] = min(mtimes)
+            stats['newest'] = max(mtimes)
+        return stats
+
+    def PrefixUsage(self, delimiter='/', prefix=''):
+        """
+        Object count and bytes used under each pseudo-directory directly below prefix
+
+        Returns a list of (pseudo-directory, object count, bytes) in name order; objects
+        directly under prefix are reported under prefix itself
+
+        Objects sharing a pseudo-directory are contiguous in name order, so each one is
+        found with a binary search and summed as a slice of the sizes column.
+        """
+        if not self.ordered:
+            # Build a name ordered copy to summarize
+            ordered = ObjectIndex()
+            ordered.Extend(self.Entry(position) for position in self.Sorted(SORT_NAME))
+            return ordered.PrefixUsage(delimiter, prefix)
+        names = _Names(self)
+        position = bisect.bisect_left(names, prefix)
+        end = len(names)
+        if len(prefix):
+            end = bisect.bisect_left(names, prefix[:-1] + chr(ord(prefix[-1]) + 1), position)
+        # Finds the next name below prefix that is inside a pseudo-directory
+        next_directory = None
+        if len(delimiter):
+            next_directory = re.compile('\\x00' + re.escape(prefix) + '(?:(?!' + re.escape(delimiter) + ')[^\\x00])*' + re.escape(delimiter))
+        usage = []
+        while position < end:
+            name = names[position]
+            separator = name.find(delimiter, len(prefix)) if len(delimiter) else -1
+            if separator < 0:
+                # Objects directly under the prefix, up to the next pseudo-directory
+                group = prefix
+                upper = end
+                if next_directory is not None:
+                    match = next_directory.search(self.__Names(), self.offsets[position] - 1)
+                    if match is not None:
+                        upper = min(end, self.__Position(match.start() + 1))
+            else:
+                group = name[:separator + len(delimiter)]
+                # Every name starting with the group sorts below the group with its last character incremented
+                upper = bisect.bisect_left(names, group[:-1] + chr(ord(group[-1]) + 1), position, end)
+            group_sizes = self.sizes[position:upper]
+            if len(usage) and usage[-1][0] == group:
+                usage[-1] = (group, usage[-1][1] + len(group_sizes), usage[-1][2] + sum(group_sizes))
+            else:
+                usage.append((group, len(group_sizes), sum(group_sizes)))
+            position = upper
+        return usage
@@ -0,0 +1,284 @@
+"""
+Rackspace Cloud Files - Parallel Container Listings
+"""
+import heapq
+import logging
+import string
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from concurrent import futures
+
+
+DEFAULT_CONCURRENCY = 8
+# Pages each range of a ParallelListing may retrieve ahead of the merge
+DEFAULT_BUFFERED_PAGES = 2
+# Pages retrieved ahead of the page being read by a PagedListing
+DEFAULT_READ_AHEAD = 2
+# Pages a PagedListing keeps, including the ones retrieved ahead
+DEFAULT_MAX_PAGES = 32
+# Default split points are the listing prefix followed by each of these characters
+DEFAULT_SPLIT_CHARACTERS = string.digits + string.ascii_uppercase + string.ascii_lowercase
+
+# Marks the end of a range in its page queue
+_END_OF_RANGE = None
+
+
+class ParallelListing(object):
+    """
+    List a container as a set of independent keyspace ranges retrieved concurrently
+
+    Every range is paged with its own marker on a worker thread; the ranges are
+    then merged back into a single name-sorted stream of objects by iterating
+    over the ParallelListing.
+    """
+
+    def __init__(self, cloudfiles, uri, container, prefix='', concurrency=DEFAULT_CONCURRENCY, limit=10000, max_buffered_pages=DEFAULT_BUFFERED_PAGES):
+        """
+        Setup the listing
+          cloudfiles - instance of rcbu.cloud.files.CloudFiles to copy the settings of
+          uri - Cloud Files URI (host and path) of the account
+          container - container to list
+          prefix - only list objects whose names start with prefix
+          concurrency - maximum number of ranges listed at the same time
+          limit - page size of each listing request
+          max_buffered_pages - pages each range may retrieve ahead of the merge; 0 is unbounded, which
+                               lets every range hold its whole share of the container in memory
+        """
+        self.log = logging.getLogger(__name__)
+        self.cloudfiles = cloudfiles
+        self.uri = uri
+        self.container = container
+        self.prefix = prefix
+        self.concurrency = max(1, int(concurrency))
+        self.limit = limit
+        self.max_buffered_pages = max_buffered_pages
+        self.ranges = []
+        self.entries = []
+
+    def SplitByMarkers(self, split_points=None):
+        """
+        Split the keyspace into marker/end_marker intervals at the given split points
+
+        Both the marker and the end_marker are exclusive, so an object named exactly
+        after a split point is found by a separate single entry listing.
+        """
+        if split_points is None:
+            split_points = [self.prefix + character for character in DEFAULT_SPLIT_CHARACTERS]
+        points = sorted(set([point for point in split_points if point.startswith(self.prefix) and point > self.prefix]))
+
+        self.ranges = []
+        lower = ''
+        for point in points:
+            self.ranges.append({'prefix': self.prefix, 'marker': lower, 'end_marker': point})
+            self.ranges.append({'prefix': point, 'exact': point})
+            lower = point
+        self.ranges.append({'prefix': self.prefix, 'marker': lower, 'end_marker': ''})
+        self.entries = []
+        self.log.debug('split listing of %s into %d ranges', self.container, len(self.ranges))
+
+    def SplitByDelimiter(self, delimiter):
+        """
+        Split the keyspace into the pseudo-directories found by a delimiter listing
+
+        Objects at the top level are taken directly from the delimiter listing.
+        """
+        self.ranges = []
+        self.entries = []
+        for entry in self.cloudfiles.IterContainerObjects(self.uri, self.container, self.limit, '', self.prefix, delimiter):
+            if 'subdir' in entry:
+                self.ranges.append({'prefix': entry['subdir'], 'marker': '', 'end_marker': ''})
+            else:
+                self.entries.append(entry)
+        self.log.debug('split listing of %s into %d ranges', self.container, len(self.ranges))
+
+    def __ListRange(self, key_range, pages, stop):
+        """
+        Worker: page through a single range, queueing each page for the merge
+        """
+        lister = type(self.cloudfiles)(self.cloudfiles.sslenabled, self.cloudfiles.authenticator)
+        try:
+            if 'exact' in key_range:
+                # A split point: it is either an object itself or the lowest name starting with it
+                page = lister.GetContainerObjects(self.uri, self.container, 1, '', key_range['exact'])
+                source = [[entry for entry in page if entry['name'] == key_range['exact']]]
+            else:
+                source = lister.IterContainerObjectPages(self.uri, self.container, self.limit, key_range['marker'], key_range['prefix'], '', key_range['end_marker'])
+            for page in source:
+                if not self.__Put(pages, page, stop):
+                    return
+        except Exception as ex:
+            self.__Put(pages, ex, stop)
+            return
+        self.__Put(pages, _END_OF_RANGE, stop)
+
+    @staticmethod
+    def __Put(pages, item, stop):
+        """
+        Queue an item for the merge unless the merge was abandoned
+        """
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    @staticmethod
+    def __Drain(queues):
+        """
+        Yield the entries of every range, one range after the other, decorated for the merge
+
+        The ranges are disjoint and in name order so they only need to be concatenated.
+        """
+        for range_index, pages in enumerate(queues):
+            while True:
+                page = pages.get()
+                if page is _END_OF_RANGE:
+                    break
+                if isinstance(page, Exception):
+                    raise UserWarning('Unable to list range {0}: {1}'.format(range_index, str(page)))
+                for entry in page:
+                    yield (entry['name'], range_index, entry)
+
+    def __iter__(self):
+        """
+        Iterate over every object in the listed ranges in name order
+        """
+        stop = threading.Event()
+        queues = [queue.Queue(self.max_buffered_pages) for dummy in self.ranges]
+        executor = futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            # Ranges are started in order so the range being drained is always running
+            for key_range, pages in zip(self.ranges, queues):
+                executor.submit(self.__ListRange, key_range, pages, stop)
+
+            # Objects found directly by a delimiter listing fall between the ranges
+            entries = ((entry['name'], -1, entry) for entry in self.entries)
+            for dummy_name, dummy_index, entry in heapq.merge(self.__Drain(queues), entries):
+                yield entry
+        finally:
+            stop.set()
+            executor.shutdown(wait=False)
+
+
+class PagedListing(object):
+    """
+    Page through a listing one page at a time, retrieving the next pages in the background
+
+    While a page is being read the following read_ahead pages are retrieved on a
+    background thread (each page needs the last name of the one before it as its
+    marker, so they are retrieved one after the other). Up to max_pages pages are
+    kept, so going back to an earlier page is served without a request; when there
+    are more, the pages farthest from the one being read are dropped. The marker of
+    every page is kept, so a dropped page can always be retrieved again.
+    """
+
+    def __init__(self, fetch, limit, read_ahead=DEFAULT_READ_AHEAD, max_pages=DEFAULT_MAX_PAGES):
+        """
+        Setup the pages
+          fetch - callable(limit, marker) returning a page (list of entries with a 'name');
+                  it is only ever called from the background thread
+          limit - number of entries per page
+          read_ahead - number of pages retrieved ahead of the page being read
+          max_pages - number of pages kept; at least read_ahead + 1
+        """
+        self.log = logging.getLogger(__name__)
+        self.fetch = fetch
+        self.limit = limit
+        self.read_ahead = max(0, int(read_ahead))
+        self.max_pages = max(self.read_ahead + 1, int(max_pages))
+        self.lock = threading.Lock()
+        # Marker of every page found so far; markers[n] retrieves page n
+        self.markers = ['']
+        self.pages = {}
+        self.current = 0
+        self.closed = False
+        self.executor = futures.ThreadPoolExecutor(max_workers=1)
+
+    def __Fetch(self, number):
+        """
+        Background thread: retrieve a page and continue reading ahead
+        """
+        page = self.fetch(self.limit, self.markers[number])
+        with self.lock:
+            if len(page) == self.limit and len(self.markers) == number + 1:
+                self.markers.append(page[len(page) - 1]['name'])
+            self.__ReadAhead()
+        return page
+
+    def __Request(self, number):
+        """
+        Future of a page, scheduling its retrieval if it is not kept; the caller holds the lock
+        """
+        page = self.pages.get(number)
+        if page is None and not self.closed:
+            page = self.pages[number] = self.executor.submit(self.__Fetch, number)
+        return page
+
+    def __ReadAhead(self):
+        """
+        Schedule the pages after the current one whose markers are known; the caller holds the lock
+        """
+        for number in range(self.current + 1, min(self.current + 1 + self.read_ahead, len(self.markers))):
+            self.__Request(number)
+        # Drop the retrieved pages farthest from the current one
+        while len(self.pages) > self.max_pages:
+            done = [number for number, page in self.pages.items() if page.done() and number != self.current]
+            if not len(done):
+                break
+            del self.pages[max(done, key=lambda number: abs(number - self.current))]
+
+    def Page(self, number):
+        """
+        Retrieve a page (0 is the first), waiting for it if it is not retrieved yet
+
+        Only pages up to the one after the last full page read can be requested (see
+        HasNext). Raises whatever fetch raised for the page; it is retried on the next call.
+        """
+        with self.lock:
+            if number < 0 or number >= len(self.markers):
+                raise IndexError('Page {0} is not known yet'.format(number))
+            self.current = number
+            page = self.__Request(number)
+            self.__ReadAhead()
+        if page is None:
+            raise UserWarning('The listing is closed')
+        try:
+            return page.result()
+        except Exception:
+            with self.lock:
+                if self.pages.get(number) is page:
+                    del self.pages[number]
+            raise
+
+    def HasNext(self, number):
+        """
+        Determine whether there may be a page after a retrieved page
+        """
+        with self.lock:
+            return number + 1 < len(self.markers)
+
+    def IsReady(self, number):
+        """
+        Determine whether a page is already retrieved
+        """
+        with self.lock:
+            page = self.pages.get(number)
+            return page is not None and page.done()
+
+    def Close(self):
+        """
+        Stop retrieving pages
+        """
+        with self.lock:
+            self.closed = True
+            for page in self.pages.values():
+                page.cancel()
+            self.pages = {}
+        self.executor.shutdown(wait=False)
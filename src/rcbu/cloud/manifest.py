@@ -0,0 +1,461 @@
+"""
+Rackspace Cloud Files - Container Manifests
+
+A manifest is the listing of a container saved to a file, so it can be searched,
+compared with another manifest or loaded into an rcbu.cloud.index.ObjectIndex
+without listing the container again. Manifests are written as the listing is
+received and read back one block of entries at a time, so memory use does not
+grow with the number of objects.
+
+Formats:
+
+    ndjson - one JSON object per line
+    csv - name, bytes, hash, last_modified and content_type columns with a header row
+    columnar - blocks of up to BLOCK_ENTRIES entries stored column by column (names,
+               sizes, times, binary MD5s and content type codes) and compressed with
+               zlib; the most compact format, and the fastest to load
+
+ndjson and csv manifests are compressed according to the file name (.gz, .bz2
+or .xz); columnar manifests are always compressed.
+
+Manifests require Python 3; on Python 2 they raise UserWarning.
+"""
+import array
+import binascii
+import bz2
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import struct
+import sys
+import time
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+from rcbu.cloud import index
+from rcbu.cloud.entries import ObjectEntry
+
+
+FORMAT_NDJSON = 'ndjson'
+FORMAT_CSV = 'csv'
+FORMAT_COLUMNAR = 'columnar'
+FORMAT_CHOICES = (FORMAT_NDJSON, FORMAT_CSV, FORMAT_COLUMNAR)
+
+# Entries per block of a columnar manifest
+BLOCK_ENTRIES = 65536
+
+CSV_FIELDS = ('name', 'bytes', 'hash', 'last_modified', 'content_type')
+
+# Differences reported by Diff
+CHANGE_ADDED = 'added'
+CHANGE_REMOVED = 'removed'
+CHANGE_CHANGED = 'changed'
+
+_MAGIC = b'CFMANIF1'
+_NO_HASH = b'\x00' * 16
+# Listing time stamps have microseconds; the columnar format keeps them as doubles
+_TIME_TOLERANCE = 0.00001
+
+# Extensions of the formats, after any compression extension
+_FORMAT_EXTENSIONS = {'.ndjson': FORMAT_NDJSON, '.jsonl': FORMAT_NDJSON, '.json': FORMAT_NDJSON, '.csv': FORMAT_CSV, '.cfm': FORMAT_COLUMNAR}
+
+
+def _RequirePython3():
+    """
+    Raise UserWarning on Python 2, whose text, csv and array I/O the manifests do not support
+    """
+    if sys.version_info[0] < 3:
+        raise UserWarning('Manifests require Python 3')
+
+
+def _OpenCompressed(path, mode, name=None):
+    """
+    Open a file in binary mode, compressed according to the extension of its name (defaults to path)
+    """
+    extension = os.path.splitext(name or path)[1].lower()
+    if extension == '.gz':
+        return gzip.open(path, mode)
+    if extension == '.bz2':
+        return bz2.BZ2File(path, mode)
+    if extension == '.xz':
+        if lzma is None:
+            raise UserWarning('xz compression is not available')
+        return lzma.LZMAFile(path, mode)
+    return open(path, mode)
+
+
+def FormatOf(path):
+    """
+    Determine the format of a manifest from its contents or, for a new file, its name
+    """
+    try:
+        with open(path, 'rb') as manifest_file:
+            if manifest_file.read(len(_MAGIC)) == _MAGIC:
+                return FORMAT_COLUMNAR
+    except (IOError, OSError):
+        pass
+    name = path.lower()
+    for compression in ('.gz', '.bz2', '.xz'):
+        if name.endswith(compression):
+            name = name[:-len(compression)]
+    return _FORMAT_EXTENSIONS.get(os.path.splitext(name)[1], FORMAT_NDJSON)
+
+
+def _Columns(array_type, data):
+    """
+    Array of little-endian values stored in a columnar block
+    """
+    column = array.array(array_type)
+    column.frombytes(data)
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column
+
+
+def _ColumnBytes(column):
+    """
+    Little-endian bytes of an array for a columnar block
+    """
+    if sys.byteorder != 'little':
+        column = array.array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+class ManifestWriter(object):
+    """
+    Write listing entries to a manifest as they are received
+    """
+
+    def __init__(self, path, manifest_format=None, metadata=None):
+        """
+        Create the manifest
+          path - manifest file
+          manifest_format - one of FORMAT_CHOICES; defaults to the one of the file name (see FormatOf)
+          metadata - optional dictionary stored in the header of a columnar manifest
+        """
+        _RequirePython3()
+        self.log = logging.getLogger(__name__)
+        self.path = path
+        self.format = manifest_format or FormatOf(path)
+        if self.format not in FORMAT_CHOICES:
+            raise UserWarning('Unknown manifest format: ' + str(self.format))
+        self.count = 0
+        self.bytes = 0
+        self.block = []
+        self.content_type_codes = {}
+        # Written to a temporary file so an interrupted export never leaves a truncated manifest
+        self.temporary_path = path + '.partial'
+        if self.format == FORMAT_COLUMNAR:
+            self.file = open(self.temporary_path, 'wb')
+            header = json.dumps(metadata or {}).encode('utf-8')
+            self.file.write(_MAGIC + struct.pack('<I', len(header)) + header)
+        else:
+            self.file = _OpenCompressed(self.temporary_path, 'wb', path)
+            self.text = io.TextIOWrapper(self.file, encoding='utf-8', newline='')
+            if self.format == FORMAT_CSV:
+                self.csv = csv.writer(self.text)
+                self.csv.writerow(CSV_FIELDS)
+
+    def Write(self, entry):
+        """
+        Add a listing entry; 'subdir' entries are ignored
+        """
+        if 'subdir' in entry:
+            return
+        self.count += 1
+        self.bytes += int(entry.get('bytes', 0))
+        if self.format == FORMAT_NDJSON:
+            self.text.write(json.dumps(dict((key, entry[key]) for key in CSV_FIELDS if key in entry), sort_keys=True) + '\n')
+        elif self.format == FORMAT_CSV:
+            self.csv.writerow([entry.get(key, '') for key in CSV_FIELDS])
+        else:
+            self.block.append(entry)
+            if len(self.block) >= BLOCK_ENTRIES:
+                self.__WriteBlock()
+
+    def __WriteBlock(self):
+        """
+        Compress and write the pending entries of a columnar manifest as one block
+        """
+        day_cache = {}
+        names = []
+        sizes = array.array('q')
+        mtimes = array.array('d')
+        hashes = bytearray()
+        codes = array.array('I')
+        new_content_types = []
+        for entry in self.block:
+            names.append(entry['name'])
+            sizes.append(int(entry.get('bytes', 0)))
+            mtimes.append(index.ParseLastModified(entry.get('last_modified'), day_cache))
+            try:
+                object_hash = binascii.unhexlify(entry.get('hash', ''))
+            except (TypeError, ValueError):
+                object_hash = _NO_HASH
+            hashes.extend(object_hash if len(object_hash) == 16 else _NO_HASH)
+            content_type = entry.get('content_type', '')
+            code = self.content_type_codes.get(content_type)
+            if code is None:
+                code = self.content_type_codes[content_type] = len(self.content_type_codes)
+                new_content_types.append(content_type)
+            codes.append(code)
+        name_bytes = '\x00'.join(names).encode('utf-8')
+        content_type_bytes = json.dumps(new_content_types).encode('utf-8')
+        payload = b''.join([struct.pack('<III', len(self.block), len(name_bytes), len(content_type_bytes)), name_bytes, content_type_bytes,
+                            _ColumnBytes(sizes), _ColumnBytes(mtimes), bytes(hashes), _ColumnBytes(codes)])
+        compressed = zlib.compress(payload, 6)
+        self.file.write(struct.pack('<I', len(compressed)) + compressed)
+        self.block = []
+
+    def Close(self):
+        """
+        Finish the manifest
+
+        Returns a dictionary of the 'objects' and 'bytes' written
+        """
+        if self.format == FORMAT_COLUMNAR:
+            if len(self.block):
+                self.__WriteBlock()
+            # An empty block marks the end, so a truncated manifest is detected
+            self.file.write(struct.pack('<I', 0))
+            self.file.close()
+        else:
+            self.text.close()
+        os.rename(self.temporary_path, self.path)
+        self.log.info('Wrote {0} entries ({1} bytes of objects) to {2}'.format(self.count, self.bytes, self.path))
+        return {'objects': self.count, 'bytes': self.bytes}
+
+    def Abort(self):
+        """
+        Discard the manifest
+        """
+        try:
+            if self.format == FORMAT_COLUMNAR:
+                self.file.close()
+            else:
+                self.text.close()
+        finally:
+            os.remove(self.temporary_path)
+
+
+def _ReadColumnarBlocks(manifest_file):
+    """
+    Yield the columns of every block of a columnar manifest positioned after its header
+
+    Each block is a tuple of the names, sizes, mtimes, hashes and content type codes,
+    along with the content type table as it stands after the block
+    """
+    content_types = []
+    while True:
+        length = manifest_file.read(4)
+        if len(length) < 4:
+            raise UserWarning('Manifest is truncated')
+        length = struct.unpack('<I', length)[0]
+        if not length:
+            return
+        compressed = manifest_file.read(length)
+        if len(compressed) < length:
+            raise UserWarning('Manifest is truncated')
+        try:
+            payload = zlib.decompress(compressed)
+        except zlib.error as ex:
+            raise UserWarning('Manifest is corrupted: ' + str(ex))
+        count, name_length, content_type_length = struct.unpack_from('<III', payload)
+        position = 12
+        names = payload[position:position + name_length].decode('utf-8').split('\x00') if count else []
+        position += name_length
+        content_types.extend(json.loads(payload[position:position + content_type_length].decode('utf-8')))
+        position += content_type_length
+        sizes = _Columns('q', payload[position:position + count * 8])
+        position += count * 8
+        mtimes = _Columns('d', payload[position:position + count * 8])
+        position += count * 8
+        hashes = payload[position:position + count * 16]
+        position += count * 16
+        codes = _Columns('I', payload[position:position + count * 4])
+        yield (names, sizes, mtimes, hashes, codes, content_types)
+
+
+def _OpenColumnar(path):
+    """
+    Open a columnar manifest; returns the file positioned after the header and the metadata
+    """
+    _RequirePython3()
+    manifest_file = open(path, 'rb')
+    try:
+        if manifest_file.read(len(_MAGIC)) != _MAGIC:
+            raise UserWarning(path + ' is not a columnar manifest')
+        length = struct.unpack('<I', manifest_file.read(4))[0]
+        metadata = json.loads(manifest_file.read(length).decode('utf-8'))
+    except (struct.error, ValueError):
+        manifest_file.close()
+        raise UserWarning(path + ' is not a valid manifest')
+    except UserWarning:
+        manifest_file.close()
+        raise
+    return (manifest_file, metadata)
+
+
+def ReadMetadata(path):
+    """
+    Metadata stored in the header of a columnar manifest; empty for the other formats
+    """
+    if FormatOf(path) != FORMAT_COLUMNAR:
+        return {}
+    manifest_file, metadata = _OpenColumnar(path)
+    manifest_file.close()
+    return metadata
+
+
+def ReadManifest(path):
+    """
+    Iterate over the entries (rcbu.cloud.entries.ObjectEntry) of a manifest, in the order they were written
+
+    Raises UserWarning if the manifest is not valid
+    """
+    _RequirePython3()
+    manifest_format = FormatOf(path)
+    if manifest_format == FORMAT_COLUMNAR:
+        manifest_file, dummy = _OpenColumnar(path)
+        with manifest_file:
+            for names, sizes, mtimes, hashes, codes, content_types in _ReadColumnarBlocks(manifest_file):
+                for position, name in enumerate(names):
+                    entry = ObjectEntry()
+                    entry['name'] = name
+                    entry['bytes'] = sizes[position]
+                    entry['last_modified'] = index.FormatLastModified(mtimes[position])
+                    object_hash = hashes[position * 16:position * 16 + 16]
+                    if object_hash != _NO_HASH:
+                        entry['hash'] = binascii.hexlify(object_hash).decode('ascii')
+                    entry['content_type'] = content_types[codes[position]]
+                    yield entry
+        return
+
+    with _OpenCompressed(path, 'rb') as manifest_file:
+        text = io.TextIOWrapper(manifest_file, encoding='utf-8', newline='')
+        try:
+            if manifest_format == FORMAT_CSV:
+                reader = csv.reader(text)
+                if tuple(next(reader, ())) != CSV_FIELDS:
+                    raise UserWarning(path + ' is not a CSV manifest')
+                for row in reader:
+                    entry = ObjectEntry(dict(zip(CSV_FIELDS, row)))
+                    entry['bytes'] = int(entry['bytes'] or 0)
+                    yield entry
+            else:
+                for line in text:
+                    if len(line.strip()):
+                        yield ObjectEntry.FromDict(json.loads(line))
+        except (ValueError, EOFError, IOError) as ex:
+            raise UserWarning('Unable to read ' + path + ': ' + str(ex))
+
+
+def LoadIndex(path):
+    """
+    Load a manifest into an rcbu.cloud.index.ObjectIndex
+
+    Columnar manifests are loaded a column at a time without building an entry per object
+    """
+    start_time = time.time()
+    if FormatOf(path) != FORMAT_COLUMNAR:
+        object_index = index.ObjectIndex.FromListing(ReadManifest(path))
+    else:
+        object_index = index.ObjectIndex()
+        manifest_file, dummy = _OpenColumnar(path)
+        with manifest_file:
+            for names, sizes, mtimes, hashes, codes, content_types in _ReadColumnarBlocks(manifest_file):
+                object_index.ExtendColumns(names, sizes, mtimes, hashes, codes, content_types)
+    logging.getLogger(__name__).info('Loaded {0} objects from {1} in {2:.2f} seconds'.format(len(object_index), path, time.time() - start_time))
+    return object_index
+
+
+def ExportContainer(cloudfiles, uri, container, path, manifest_format=None, prefix=''):
+    """
+    Write the listing of a container (or of the objects under a prefix) to a manifest
+      cloudfiles - instance of rcbu.cloud.files.CloudFiles to list with
+      uri - Cloud Files URI (host and path) of the account
+
+    Returns a dictionary of the 'objects' and 'bytes' written and the 'elapsed' seconds
+    """
+    start_time = time.time()
+    metadata = {'container': container, 'prefix': prefix, 'uri': uri, 'time': start_time}
+    writer = ManifestWriter(path, manifest_format, metadata)
+    completed = False
+    try:
+        for entry in cloudfiles.IterContainerObjects(uri, container, prefix=prefix):
+            writer.Write(entry)
+        completed = True
+    finally:
+        if not completed:
+            writer.Abort()
+    stats = writer.Close()
+    stats['elapsed'] = time.time() - start_time
+    return stats
+
+
+def _IsChanged(old_entry, new_entry):
+    """
+    Determine whether two manifest entries of the same name differ
+    """
+    if int(old_entry.get('bytes', 0)) != int(new_entry.get('bytes', 0)):
+        return True
+    if old_entry.get('hash', '').lower() != new_entry.get('hash', '').lower():
+        return True
+    day_cache = {}
+    return abs(index.ParseLastModified(old_entry.get('last_modified'), day_cache) - index.ParseLastModified(new_entry.get('last_modified'), day_cache)) > _TIME_TOLERANCE
+
+
+def Diff(old_path, new_path):
+    """
+    Compare two manifests of a container, each in name order (as written from a listing)
+
+    Yields (CHANGE_ADDED, None, entry), (CHANGE_REMOVED, entry, None) and
+    (CHANGE_CHANGED, old entry, new entry) in name order; the manifests are merged
+    as they are read, so any number of objects can be compared
+    """
+    old_entries = ReadManifest(old_path)
+    new_entries = ReadManifest(new_path)
+    old_entry = next(old_entries, None)
+    new_entry = next(new_entries, None)
+    while old_entry is not None or new_entry is not None:
+        if new_entry is None or (old_entry is not None and old_entry['name'] < new_entry['name']):
+            yield (CHANGE_REMOVED, old_entry, None)
+            old_entry = next(old_entries, None)
+        elif old_entry is None or new_entry['name'] < old_entry['name']:
+            yield (CHANGE_ADDED, None, new_entry)
+            new_entry = next(new_entries, None)
+        else:
+            if _IsChanged(old_entry, new_entry):
+                yield (CHANGE_CHANGED, old_entry, new_entry)
+            old_entry = next(old_entries, None)
+            new_entry = next(new_entries, None)
+
+
+def Search(path, object_query):
+    """
+    Iterate over the entries of a manifest matching an rcbu.cloud.query.ObjectQuery
+
+    The listing options of the query (prefix, marker, end_marker) are applied as filters;
+    a delimiter is not supported
+    """
+    options = object_query.ServerOptions()
+    if options is None:
+        return
+    matched = 0
+    for entry in ReadManifest(path):
+        name = entry['name']
+        if not name.startswith(options['prefix']) or (len(options['marker']) and name <= options['marker']) or (len(options['end_marker']) and name >= options['end_marker']):
+            continue
+        if object_query.Matches(entry):
+            matched += 1
+            yield entry
+            if object_query.limit is not None and matched >= object_query.limit:
+                return
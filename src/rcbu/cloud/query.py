@@ -0,0 +1,289 @@
+"""
+Rackspace Cloud Files - Object Queries
+
+A query selects the objects of a container by name, size, modification time and
+content type. As much of it as Cloud Files can evaluate is sent with the listing
+requests (prefix, delimiter, marker and end_marker, including the literal start
+of the name patterns), so only the objects that may match are transferred; the
+other predicates are applied to the listing as it is parsed.
+
+Queries can also be written as text (see ObjectQuery.Parse), e.g.
+
+    logs/*.gz size>=10M modified>=2014-01-01 type:application/*
+"""
+import calendar
+import fnmatch
+import logging
+import os
+import re
+import shlex
+import time
+
+from rcbu.cloud import index
+
+
+# Multipliers of the size suffixes; binary, as the viewer reports sizes
+_SIZE_UNITS = {'': 1, 'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+_SIZE = re.compile(r'^(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?$', re.IGNORECASE)
+_COMPARISON = re.compile(r'^(size|modified)(>=|<=|>|<|=)(.+)$')
+# Smallest step between two listing time stamps
+_TIME_STEP = 0.000001
+
+
+def ParseSize(value):
+    """
+    Convert a size such as 1048576, 512K, 1.5M or 2GiB to a number of bytes
+
+    Raises UserWarning if the size is not valid
+    """
+    match = _SIZE.match(str(value).strip())
+    if match is None:
+        raise UserWarning('Invalid size: ' + str(value))
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
+
+def ParseTime(value):
+    """
+    Convert a UTC date or time (2014-01-01, 2014-01-01T12:00 or a listing time stamp)
+    to seconds since the epoch
+
+    Raises UserWarning if the time is not valid
+    """
+    for time_format in ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return float(calendar.timegm(time.strptime(value, time_format)))
+        except ValueError:
+            pass
+    try:
+        return float(calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S'))) + float('0' + value[19:])
+    except ValueError:
+        raise UserWarning('Invalid time: ' + value)
+
+
+def PatternBounds(pattern):
+    """
+    Names a glob pattern can match, as a tuple of the prefix they all start with
+    and the end_marker they all sort below (a NULL string when there is no bound
+    other than the prefix)
+    """
+    position = 0
+    while position < len(pattern) and pattern[position] not in '*?[':
+        position += 1
+    prefix = pattern[:position]
+    end_marker = ''
+    if position < len(pattern) and pattern[position] == '[':
+        # A character class right after the prefix bounds the next character
+        end = pattern.find(']', position + 2)
+        members = pattern[position + 1:end]
+        if end > 0 and len(members) and members[0] not in '!^':
+            characters = []
+            member = 0
+            while member < len(members):
+                if member + 2 < len(members) and members[member + 1] == '-':
+                    characters.append(members[member + 2])
+                    member += 3
+                else:
+                    characters.append(members[member])
+                    member += 1
+            end_marker = prefix + chr(ord(max(characters)) + 1)
+    return (prefix, end_marker)
+
+
+class ObjectQuery(object):
+    """
+    Selection of the objects of a container
+    """
+
+    def __init__(self, patterns=None, prefix='', delimiter='', marker='', end_marker='', min_size=None, max_size=None,
+                 modified_after=None, modified_before=None, content_types=None, limit=None):
+        """
+        Setup the query; every criterion given must hold
+          patterns - glob patterns (fnmatch, case sensitive) of which the name must match one
+          prefix - the names start with prefix
+          delimiter - roll the names below prefix up at the delimiter into 'subdir' entries
+          marker - the names sort after marker
+          end_marker - the names sort before end_marker
+          min_size, max_size - inclusive bounds of the size in bytes
+          modified_after - earliest modification time (inclusive), in seconds since the epoch
+          modified_before - latest modification time (exclusive), in seconds since the epoch
+          content_types - glob patterns of which the content type must match one
+          limit - stop after this many matches
+
+        'subdir' entries only have a name; they are matched by the patterns alone.
+        """
+        self.log = logging.getLogger(__name__)
+        self.patterns = list(patterns or [])
+        self.prefix = prefix
+        self.delimiter = delimiter
+        self.marker = marker
+        self.end_marker = end_marker
+        self.min_size = min_size
+        self.max_size = max_size
+        self.modified_after = modified_after
+        self.modified_before = modified_before
+        self.content_types = list(content_types or [])
+        self.limit = limit
+        self.stats = {'listed': 0, 'matched': 0, 'bytes': 0, 'elapsed': 0.0}
+        self.day_cache = {}
+
+    @classmethod
+    def Parse(cls, text):
+        """
+        Build a query from text: whitespace separated terms (quoted as in a shell when
+        they contain spaces) of
+
+          PATTERN or name:PATTERN  - the name matches the glob pattern (any of them if repeated)
+          type:PATTERN             - the content type matches the glob pattern (any of them if repeated)
+          prefix:TEXT, delimiter:TEXT, marker:TEXT, end_marker:TEXT - listing options
+          size>N, size>=N, size<N, size<=N, size=N - N in bytes, or with a K, M, G or T suffix
+          modified>T, modified>=T, modified<T, modified<=T, modified=T - T a UTC date or time
+          limit:N                  - stop after N matches
+
+        Raises UserWarning if the text is not a valid query
+        """
+        query = cls()
+        try:
+            terms = shlex.split(text)
+        except ValueError as ex:
+            raise UserWarning('Invalid query: ' + str(ex))
+        for term in terms:
+            comparison = _COMPARISON.match(term)
+            if comparison is not None:
+                query.__AddComparison(comparison.group(1), comparison.group(2), comparison.group(3))
+                continue
+            key, separator, value = term.partition(':')
+            if not len(separator) or key not in ('name', 'type', 'prefix', 'delimiter', 'marker', 'end_marker', 'limit'):
+                query.patterns.append(term)
+            elif key == 'name':
+                query.patterns.append(value)
+            elif key == 'type':
+                query.content_types.append(value)
+            elif key == 'limit':
+                try:
+                    query.limit = int(value)
+                except ValueError:
+                    raise UserWarning('Invalid limit: ' + value)
+            else:
+                setattr(query, key, value)
+        return query
+
+    def __AddComparison(self, field, operator, value):
+        """
+        Narrow the size or modification time bounds by a comparison
+        """
+        if field == 'size':
+            value = ParseSize(value)
+            step = 1
+        else:
+            value = ParseTime(value)
+            step = _TIME_STEP
+        lower = None
+        upper = None
+        if operator in ('>', '>=', '='):
+            lower = value + step if operator == '>' else value
+        if operator in ('<', '<=', '='):
+            upper = value - step if operator == '<' else value
+        if field == 'size':
+            if lower is not None:
+                self.min_size = lower if self.min_size is None else max(self.min_size, lower)
+            if upper is not None:
+                self.max_size = upper if self.max_size is None else min(self.max_size, upper)
+        else:
+            # modified_before is exclusive
+            if upper is not None:
+                upper += step
+            if lower is not None:
+                self.modified_after = lower if self.modified_after is None else max(self.modified_after, lower)
+            if upper is not None:
+                self.modified_before = upper if self.modified_before is None else min(self.modified_before, upper)
+
+    @property
+    def Stats(self):
+        """
+        Summary of the last Run(): entries 'listed' (transferred), 'matched', 'bytes' matched
+        and 'elapsed' seconds
+        """
+        return dict(self.stats)
+
+    def ServerOptions(self):
+        """
+        Listing options that let Cloud Files skip what can not match
+
+        Returns a dictionary of 'prefix', 'delimiter', 'marker' and 'end_marker', or None
+        if nothing can match
+        """
+        prefix = self.prefix
+        end_marker = self.end_marker
+        if len(self.patterns):
+            bounds = [PatternBounds(pattern) for pattern in self.patterns]
+            pattern_prefix = os.path.commonprefix([pattern_prefix for pattern_prefix, dummy in bounds])
+            if pattern_prefix.startswith(prefix):
+                prefix = pattern_prefix
+            elif not prefix.startswith(pattern_prefix):
+                # The patterns and the prefix exclude each other
+                return None
+            # Only bounded when every pattern is
+            pattern_end_markers = [pattern_end_marker for dummy, pattern_end_marker in bounds]
+            if all(len(pattern_end_marker) for pattern_end_marker in pattern_end_markers):
+                pattern_end_marker = max(pattern_end_markers)
+                if not len(end_marker) or pattern_end_marker < end_marker:
+                    end_marker = pattern_end_marker
+        if self.max_size is not None and self.min_size is not None and self.max_size < self.min_size:
+            return None
+        if len(end_marker) and end_marker <= self.marker:
+            return None
+        return {'prefix': prefix, 'delimiter': self.delimiter, 'marker': self.marker, 'end_marker': end_marker}
+
+    def Matches(self, entry):
+        """
+        Determine whether a listing entry satisfies the query
+        """
+        if 'subdir' in entry:
+            return not len(self.patterns) or any(fnmatch.fnmatchcase(entry['subdir'], pattern) for pattern in self.patterns)
+        if len(self.patterns) and not any(fnmatch.fnmatchcase(entry['name'], pattern) for pattern in self.patterns):
+            return False
+        if self.min_size is not None or self.max_size is not None:
+            size = int(entry.get('bytes', 0))
+            if self.min_size is not None and size < self.min_size:
+                return False
+            if self.max_size is not None and size > self.max_size:
+                return False
+        if self.modified_after is not None or self.modified_before is not None:
+            modified = index.ParseLastModified(entry.get('last_modified'), self.day_cache)
+            if self.modified_after is not None and modified < self.modified_after:
+                return False
+            if self.modified_before is not None and modified >= self.modified_before:
+                return False
+        if len(self.content_types) and not any(fnmatch.fnmatchcase(entry.get('content_type', ''), pattern) for pattern in self.content_types):
+            return False
+        return True
+
+    def Run(self, cloudfiles, uri, container):
+        """
+        Iterate over the matching entries of a container as the listing is received
+          cloudfiles - instance of rcbu.cloud.files.CloudFiles to list with
+          uri - Cloud Files URI (host and path) of the account
+
+        The listing stops as soon as limit entries matched; Stats is up to date once the iteration ends
+        """
+        self.stats = {'listed': 0, 'matched': 0, 'bytes': 0, 'elapsed': 0.0}
+        start_time = time.time()
+        options = self.ServerOptions()
+        try:
+            if options is None or self.limit is not None and self.limit <= 0:
+                return
+            self.log.debug('query of %s sent as %s', container, options)
+            for entry in cloudfiles.IterContainerObjects(uri, container, marker=options['marker'], prefix=options['prefix'],
+                                                         delimiter=options['delimiter'], end_marker=options['end_marker']):
+                self.stats['listed'] += 1
+                if not self.Matches(entry):
+                    continue
+                self.stats['matched'] += 1
+                self.stats['bytes'] += int(entry.get('bytes', 0))
+                yield entry
+                if self.limit is not None and self.stats['matched'] >= self.limit:
+                    break
+        finally:
+            self.stats['elapsed'] = time.time() - start_time
+            self.log.info('Query of {0}: {1} of {2} listed entries matched in {3:.2f} seconds'.format(
+                container, self.stats['matched'], self.stats['listed'], self.stats['elapsed']))
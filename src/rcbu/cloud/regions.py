@@ -0,0 +1,270 @@
+"""
+Rackspace Cloud Files - Endpoint Selection and Cross-Region Operations
+"""
+import fnmatch
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+import requests
+from concurrent import futures
+from requests.compat import urlparse
+
+from rcbu.common.command import Command
+from rcbu.common import retry
+from rcbu.cloud.files import CloudFiles
+
+
+DEFAULT_PROBE_TIMEOUT = 5.0
+# Probe results are reused for this many seconds
+DEFAULT_PROBE_TTL = 60 * 60
+DEFAULT_PROBE_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cloudfiles-viewer', 'endpoints.json')
+DEFAULT_CONCURRENCY = 16
+
+# The service network is only reachable from inside a data center, where it is
+# also the cheapest and usually the fastest way in
+PREFERRED_NETWORK = 'snet'
+
+
+class EndpointProbe(object):
+    """
+    Measure how quickly every Cloud Files endpoint in the service catalog responds
+
+    Every endpoint (each network of each data center) is probed at the same time:
+    a TCP connection is timed first, so unreachable endpoints fail within the
+    timeout, then a one entry account listing is timed over the shared session.
+    The results are kept for ttl seconds, and in cache_path between runs.
+    """
+
+    def __init__(self, authenticator, sslenabled=True, cache_path=None, ttl=DEFAULT_PROBE_TTL, timeout=DEFAULT_PROBE_TIMEOUT):
+        """
+        Setup the probe
+          authenticator - instance of rcbu.client.auth.Authentication to use
+          sslenabled - True if using HTTPS; otherwise False
+          cache_path - optional file to keep the results in between runs
+          ttl - seconds the results are reused for
+          timeout - seconds to wait on each endpoint before it is considered unreachable
+        """
+        self.log = logging.getLogger(__name__)
+        self.authenticator = authenticator
+        self.sslenabled = sslenabled
+        self.cache_path = cache_path
+        if self.cache_path is not None:
+            self.cache_path = os.path.expanduser(self.cache_path)
+        self.ttl = ttl
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.results = None
+        self.probed_at = 0.0
+
+    def __Endpoints(self, regions):
+        """
+        List of (region, network, URI) of every endpoint in the service catalog
+        """
+        if regions is None:
+            regions = self.authenticator.GetCloudFilesDataCenters()
+        endpoints = []
+        for region in regions:
+            for uri in self.authenticator.GetCloudFilesUri(region):
+                endpoints.append((region, uri['name'], uri['uri']))
+        return endpoints
+
+    def __ProbeEndpoint(self, region, network, uri):
+        """
+        Worker: time a connection to and a small request of a single endpoint
+        """
+        result = {'region': region, 'network': network, 'uri': uri, 'connect': None, 'latency': None, 'error': None}
+        # The catalog URIs are always HTTPS; follow the scheme the client is using
+        request_uri = Command.BuildUri(self.sslenabled, uri.split('://', 1)[-1], '')
+        location = urlparse(request_uri)
+        port = location.port or (443 if self.sslenabled else 80)
+        try:
+            start_time = time.time()
+            connection = socket.create_connection((location.hostname, port), self.timeout)
+            result['connect'] = time.time() - start_time
+            connection.close()
+
+            headers = {'X-Auth-Token': self.authenticator.AuthToken}
+            start_time = time.time()
+            # A slow or failing endpoint is what is being measured; never retry it
+            res = Command.SendRequest('GET', request_uri + CloudFiles.ListingOptions(limit=1), 'endpoint-probe', retry_policy=retry.NO_RETRY, headers=headers, timeout=self.timeout)
+            if res.status_code not in (200, 204):
+                raise UserWarning('HTTP ' + str(res.status_code))
+            result['latency'] = time.time() - start_time
+        except (socket.error, UserWarning, requests.exceptions.RequestException) as ex:
+            self.log.debug('Endpoint ' + region + ' ' + network + ' is unreachable: ' + str(ex))
+            result['error'] = str(ex)
+        return result
+
+    def __LoadCache(self):
+        """
+        Load the results of an earlier run; returns True if they are still fresh
+        """
+        if self.cache_path is None:
+            return False
+        try:
+            with open(self.cache_path, 'r') as cache_file:
+                cached = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return False
+        if cached.get('identity') != self.authenticator.Uri or cached.get('username') != self.authenticator.username:
+            return False
+        if time.time() - cached.get('time', 0.0) > self.ttl:
+            return False
+        self.results = cached.get('results', [])
+        self.probed_at = cached['time']
+        return True
+
+    def __SaveCache(self):
+        """
+        Write the results for later runs
+        """
+        if self.cache_path is None:
+            return
+        try:
+            cache_dir = os.path.dirname(self.cache_path)
+            if len(cache_dir) and not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, 0o700)
+            with open(self.cache_path, 'w') as cache_file:
+                json.dump({'username': self.authenticator.username, 'identity': self.authenticator.Uri, 'time': self.probed_at, 'results': self.results}, cache_file)
+        except (IOError, OSError) as ex:
+            self.log.error('Unable to write endpoint cache ' + self.cache_path + ': ' + str(ex))
+
+    def Probe(self, refresh=False):
+        """
+        Probe every endpoint, or reuse the results of a recent probe unless refresh is True
+
+        Returns a list of dictionaries of 'region', 'network', 'uri', 'connect' and
+        'latency' (seconds; None when unreachable) and 'error', fastest first
+        """
+        with self.lock:
+            if not refresh and self.results is not None and time.time() - self.probed_at <= self.ttl:
+                return self.results
+            if not refresh and self.__LoadCache():
+                return self.results
+
+            endpoints = self.__Endpoints(None)
+            results = []
+            if len(endpoints):
+                with futures.ThreadPoolExecutor(max_workers=len(endpoints)) as executor:
+                    probes = [executor.submit(self.__ProbeEndpoint, region, network, uri) for region, network, uri in endpoints]
+                    results = [probe.result() for probe in probes]
+            # Reachable endpoints first, fastest first
+            results.sort(key=lambda result: (result['latency'] is None, result['latency'] or 0.0))
+            self.results = results
+            self.probed_at = time.time()
+            self.__SaveCache()
+            for result in results:
+                if result['latency'] is None:
+                    self.log.info('Endpoint ' + result['region'] + ' ' + result['network'] + ': unreachable')
+                else:
+                    self.log.info('Endpoint {0} {1}: {2:.1f} ms'.format(result['region'], result['network'], result['latency'] * 1000.0))
+            return self.results
+
+    def Fastest(self, region=None, network=None, prefer_network=PREFERRED_NETWORK):
+        """
+        Lowest latency reachable endpoint
+          region - only consider the endpoints of this data center
+          network - only consider endpoints of this network ('public' or 'snet')
+          prefer_network - network chosen whenever one of its endpoints is reachable
+
+        Returns a probe result (see Probe) or None if no endpoint is reachable
+        """
+        candidates = [result for result in self.Probe()
+                      if result['latency'] is not None and (region is None or result['region'] == region) and (network is None or result['network'] == network)]
+        if not len(candidates):
+            return None
+        preferred = [result for result in candidates if result['network'] == prefer_network]
+        if len(preferred):
+            return preferred[0]
+        return candidates[0]
+
+
+class MultiRegion(object):
+    """
+    Run the same operation against every data center at the same time
+    """
+
+    def __init__(self, authenticator, sslenabled=True, network='public', regions=None, concurrency=DEFAULT_CONCURRENCY):
+        """
+        Setup the cross-region operations
+          authenticator - instance of rcbu.client.auth.Authentication to use
+          sslenabled - True if using HTTPS; otherwise False
+          network - Cloud Files network to use: 'public' or 'snet'
+          regions - data centers to use; defaults to every one in the service catalog
+          concurrency - maximum number of data centers worked on at the same time
+        """
+        self.log = logging.getLogger(__name__)
+        self.authenticator = authenticator
+        self.sslenabled = sslenabled
+        self.network = network
+        self.regions = regions
+        self.concurrency = max(1, int(concurrency))
+
+    def Map(self, operation):
+        """
+        Call operation(cloudfiles, region, uri) for every data center in parallel
+          operation - callable; each call gets its own rcbu.cloud.files.CloudFiles and
+                      the URI (without the scheme) of the data center
+
+        Returns a tuple of a dictionary of region to the result of the operation and a
+        dictionary of region to the reason the operation failed there
+        """
+        regions = self.regions
+        if regions is None:
+            regions = self.authenticator.GetCloudFilesDataCenters()
+        results = {}
+        failures = {}
+        calls = {}
+        with futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for region in regions:
+                uri = None
+                for endpoint in self.authenticator.GetCloudFilesUri(region):
+                    if endpoint['name'] == self.network:
+                        uri = endpoint['uri'].split('://', 1)[-1]
+                if uri is None:
+                    failures[region] = 'no ' + self.network + ' endpoint'
+                    continue
+                cloudfiles = CloudFiles(self.sslenabled, self.authenticator)
+                calls[executor.submit(operation, cloudfiles, region, uri)] = region
+            for call in futures.as_completed(calls):
+                region = calls[call]
+                try:
+                    results[region] = call.result()
+                except (UserWarning, ValueError, requests.exceptions.RequestException) as ex:
+                    self.log.error('Operation failed in ' + region + ': ' + str(ex))
+                    failures[region] = str(ex)
+        return (results, failures)
+
+    def FindContainer(self, container):
+        """
+        Metadata of a container in every data center that has it
+
+        Returns a tuple of a dictionary of region to the container metadata (see
+        CloudFiles.GetContainerMetadata) and a dictionary of failures (see Map)
+        """
+        results, failures = self.Map(lambda cloudfiles, region, uri: cloudfiles.GetContainerMetadata(uri, container))
+        found = {}
+        for region, metadata in results.items():
+            if len(metadata):
+                found[region] = metadata
+        return (found, failures)
+
+    def SearchContainer(self, container, pattern='*', prefix=''):
+        """
+        Objects of a container whose names match a glob pattern, in every data center
+
+        Only the objects under prefix are listed; each listing is filtered as it is
+        received. Returns a tuple of a dictionary of region to the list of matching
+        listing entries and a dictionary of failures (see Map)
+        """
+        def search(cloudfiles, region, uri):
+            matches = []
+            for object_data in cloudfiles.IterContainerObjects(uri, container, prefix=prefix):
+                if fnmatch.fnmatchcase(object_data['name'], pattern):
+                    matches.append(object_data)
+            return matches
+        return self.Map(search)
@@ -0,0 +1,305 @@
+"""
+Rackspace Cloud Files - Local Mirror of a Container
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from rcbu.cloud import bulk
+
+
+# The manifest is kept in the mirrored directory under this name
+MANIFEST_NAME = '.cloudfiles-sync.sqlite'
+
+# Files SQLite keeps next to the manifest
+_MANIFEST_SUFFIXES = ('', '-wal', '-shm', '-journal')
+
+_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS objects ('
+    '  container TEXT NOT NULL, name TEXT NOT NULL,'
+    '  bytes INTEGER, hash TEXT, last_modified TEXT,'
+    '  local_size INTEGER, local_mtime REAL,'
+    '  PRIMARY KEY (container, name))'
+]
+
+# Marks the end of a listing in the merge
+_END = None
+
+
+class SyncManifest(object):
+    """
+    On-disk (SQLite) record of the objects mirrored into a directory
+
+    Each object is recorded with the listing data it was downloaded for (bytes, hash
+    and last_modified) and the size and modification time of the local file written,
+    so a later sync can tell both remote and local changes apart without reading
+    the local files.
+    """
+
+    def __init__(self, path):
+        """
+        Open (or create) the manifest
+          path - SQLite database file
+        """
+        self.log = logging.getLogger(__name__)
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock:
+            # Every download is committed on its own; avoid a full sync per commit
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            with self.db:
+                for statement in _SCHEMA:
+                    self.db.execute(statement)
+
+    def Close(self):
+        """
+        Close the manifest database
+        """
+        with self.lock:
+            self.db.close()
+
+    def Iter(self, container, prefix=''):
+        """
+        Iterate over the recorded objects of a container whose names start with prefix, in name order
+
+        Yields dictionaries of 'name', 'bytes', 'hash', 'last_modified', 'local_size' and 'local_mtime'
+        """
+        # SQLite compares TEXT as UTF-8 bytes, the same order as the Cloud Files listing
+        with self.lock:
+            cursor = self.db.execute('SELECT name, bytes, hash, last_modified, local_size, local_mtime FROM objects'
+                                     ' WHERE container = ? AND substr(name, 1, ?) = ? ORDER BY name', (container, len(prefix), prefix))
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(1000)
+            if not len(rows):
+                break
+            for row in rows:
+                yield dict(zip(('name', 'bytes', 'hash', 'last_modified', 'local_size', 'local_mtime'), row))
+
+    def Record(self, container, object_data, localpath):
+        """
+        Record an object as mirrored to localpath
+        """
+        local_stat = os.stat(localpath)
+        row = (container, object_data['name'], int(object_data.get('bytes', 0)), object_data.get('hash'), object_data.get('last_modified'), local_stat.st_size, local_stat.st_mtime)
+        with self.lock:
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO objects (container, name, bytes, hash, last_modified, local_size, local_mtime) VALUES (?, ?, ?, ?, ?, ?, ?)', row)
+
+    def Remove(self, container, name):
+        """
+        Forget an object
+        """
+        with self.lock:
+            with self.db:
+                self.db.execute('DELETE FROM objects WHERE container = ? AND name = ?', (container, name))
+
+
+def IsUnchanged(object_data, recorded, localpath):
+    """
+    Determine whether a recorded object is still mirrored as listed
+
+      object_data - current listing entry
+      recorded - manifest entry (see SyncManifest.Iter)
+      localpath - local file of the object
+    """
+    for key in ('bytes', 'hash', 'last_modified'):
+        if object_data.get(key) != recorded[key]:
+            return False
+    try:
+        local_stat = os.stat(localpath)
+    except OSError:
+        return False
+    return local_stat.st_size == recorded['local_size'] and local_stat.st_mtime == recorded['local_mtime']
+
+
+class ContainerSync(object):
+    """
+    Keep a local directory a mirror of a container (or of the objects under a prefix)
+
+    The container listing is merged with the manifest of the previous sync (both are
+    in name order) so only new and changed objects are downloaded. Objects no longer
+    in the container are reported, and removed locally when pruning. Only files the
+    manifest knows about are ever pruned.
+    """
+
+    def __init__(self, cloudfiles, uri, container, target_dir, prefix='', workers=bulk.DEFAULT_WORKERS, download_options=None, prune=False, manifest_path=None):
+        """
+        Setup the sync
+          cloudfiles - instance of rcbu.cloud.files.CloudFiles to copy the settings of
+          uri - Cloud Files URI (host and path) of the account
+          container - container to mirror
+          target_dir - local directory to mirror into
+          prefix - only mirror objects whose names start with prefix
+          workers - number of objects downloaded at the same time
+          download_options - optional dictionary of keyword arguments for DownloadObject
+          prune - True to remove local copies of objects that are no longer in the container
+          manifest_path - manifest file; defaults to MANIFEST_NAME in target_dir
+
+        The manifest files are reserved: an object mapping onto one of them is reported
+        as failed, and they are never adopted or pruned.
+        """
+        self.log = logging.getLogger(__name__)
+        self.cloudfiles = cloudfiles
+        self.uri = uri
+        self.container = container
+        self.target_dir = target_dir
+        self.prefix = prefix
+        self.prune = prune
+        if not os.path.isdir(self.target_dir):
+            os.makedirs(self.target_dir)
+        manifest_path = os.path.abspath(manifest_path or os.path.join(self.target_dir, MANIFEST_NAME))
+        self.reserved_paths = set(manifest_path + suffix for suffix in _MANIFEST_SUFFIXES)
+        self.manifest = SyncManifest(manifest_path)
+        self.downloader = bulk.BulkDownload(cloudfiles, uri, container, target_dir, prefix, workers, download_options, self.__Downloaded, self.reserved_paths, self.__Adopted)
+        self.lock = threading.Lock()
+        # Names of the new objects whose local files may already be current (see Plan)
+        self.candidates = set()
+        self.stats = {'new': 0, 'changed': 0, 'unchanged': 0, 'adopted': 0, 'removed': 0, 'pruned': 0}
+
+    @property
+    def Stats(self):
+        """
+        Summary of the sync: objects 'new', 'changed', 'unchanged', 'adopted' (already present
+        locally but not yet in the manifest, as found by the download workers), 'removed'
+        and 'pruned', along with the
+        download statistics (see rcbu.cloud.bulk.BulkDownload.Stats)
+        """
+        stats = self.downloader.Stats
+        stats.update(self.stats)
+        return stats
+
+    @property
+    def Failures(self):
+        """List of (object name, reason) for the objects that could not be downloaded"""
+        return self.downloader.Failures
+
+    def __Downloaded(self, object_data, localpath):
+        """
+        Record a downloaded object in the manifest
+        """
+        self.manifest.Record(self.container, object_data, localpath)
+
+    def __Adopted(self, object_data, localpath):
+        """
+        Record an object whose local file was already current in the manifest
+        """
+        self.manifest.Record(self.container, object_data, localpath)
+        with self.lock:
+            self.stats['adopted'] += 1
+
+    def __IsCandidate(self, object_data):
+        """
+        Determine whether the local file of a scheduled object is to be checked before downloading it
+        """
+        return object_data['name'] in self.candidates
+
+    def __Merge(self):
+        """
+        Pair the listing with the manifest by name
+
+        Yields (listing entry, manifest entry) with None for whichever side lacks the name
+        """
+        remote = iter(self.cloudfiles.IterContainerObjects(self.uri, self.container, prefix=self.prefix))
+        local = self.manifest.Iter(self.container, self.prefix)
+        object_data = next(remote, _END)
+        recorded = next(local, _END)
+        while object_data is not _END or recorded is not _END:
+            if recorded is _END or (object_data is not _END and object_data['name'] < recorded['name']):
+                yield (object_data, None)
+                object_data = next(remote, _END)
+            elif object_data is _END or recorded['name'] < object_data['name']:
+                yield (None, recorded)
+                recorded = next(local, _END)
+            else:
+                yield (object_data, recorded)
+                object_data = next(remote, _END)
+                recorded = next(local, _END)
+
+    def Plan(self):
+        """
+        Compare the listing with the manifest
+
+        Returns a tuple of the listing entries to download and the names of the
+        recorded objects that are no longer in the container
+
+        New objects whose local file has the listed size are only added to the
+        candidates; the download workers hash them and adopt the ones already
+        current instead of downloading them.
+        """
+        pending = []
+        removed = []
+        for object_data, recorded in self.__Merge():
+            if object_data is None:
+                removed.append(recorded['name'])
+                continue
+            if bulk.IsDirectoryMarker(object_data):
+                continue
+            localpath = bulk.LocalPath(self.target_dir, object_data['name'])
+            if localpath in self.reserved_paths:
+                # Left to the downloader, which reports it as failed
+                pending.append(object_data)
+            elif recorded is None:
+                if localpath is not None and bulk.MayBeLocalCopy(localpath, object_data):
+                    # Possibly mirrored already (e.g. by a bulk download)
+                    self.candidates.add(object_data['name'])
+                else:
+                    self.stats['new'] += 1
+                pending.append(object_data)
+            elif localpath is not None and IsUnchanged(object_data, recorded, localpath):
+                self.stats['unchanged'] += 1
+            else:
+                self.stats['changed'] += 1
+                pending.append(object_data)
+        self.stats['removed'] = len(removed)
+        return (pending, removed)
+
+    def __Prune(self, name):
+        """
+        Remove the local copy of an object that is no longer in the container
+        """
+        localpath = bulk.LocalPath(self.target_dir, name)
+        if localpath is not None and localpath not in self.reserved_paths:
+            try:
+                os.remove(localpath)
+            except OSError as ex:
+                if os.path.exists(localpath):
+                    self.log.error('Unable to remove ' + localpath + ': ' + str(ex))
+                    return
+            # Remove the directories left empty, up to the target directory
+            local_dir = os.path.dirname(localpath)
+            target_dir = os.path.abspath(self.target_dir)
+            while local_dir != target_dir:
+                try:
+                    os.rmdir(local_dir)
+                except OSError:
+                    break
+                local_dir = os.path.dirname(local_dir)
+        self.manifest.Remove(self.container, name)
+        self.stats['pruned'] += 1
+
+    def Run(self):
+        """
+        Bring the local mirror up to date
+
+        Returns True if every new or changed object was downloaded
+        """
+        start_time = time.time()
+        try:
+            pending, removed = self.Plan()
+            self.log.info('Sync of {0}: {1} new, {2} changed, {3} unchanged, {4} removed, {5} to check against a local copy'.format(
+                self.container, self.stats['new'], self.stats['changed'], self.stats['unchanged'], self.stats['removed'], len(self.candidates)))
+            self.downloader.Schedule(pending, check_local=self.__IsCandidate)
+            success = self.downloader.Download(start_time)
+            # The candidates that were not adopted were downloaded (or failed) as new objects
+            self.stats['new'] += len(self.candidates) - self.stats['adopted']
+            if self.prune:
+                for name in removed:
+                    self.__Prune(name)
+            return success
+        finally:
+            self.manifest.Close()
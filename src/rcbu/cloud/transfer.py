@@ -0,0 +1,959 @@
+"""
+Rackspace Cloud Files - Parallel Ranged Downloads
+"""
+import functools
+import json
+import logging
+import mmap
+import os
+import socket
+import threading
+import time
+import hashlib
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import http.client as http_client
+except ImportError:
+    import httplib as http_client
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import requests
+from concurrent import futures
+
+from rcbu.common.command import Command
+
+
+# Objects smaller than a single part are never split
+DEFAULT_PART_SIZE = 64 * 2 ** 20
+DEFAULT_CONCURRENCY = 4
+DEFAULT_RETRIES = 3
+# Resumable downloads keep their journal next to the target file with this suffix
+JOURNAL_SUFFIX = '.journal'
+
+# Digests computed while downloading; the MD5 is what the ETag is checked against
+DIGEST_NONE = 'none'
+DIGEST_MD5 = 'md5'
+DIGEST_MD5_SHA1 = 'md5+sha1'
+DIGEST_CHOICES = (DIGEST_NONE, DIGEST_MD5, DIGEST_MD5_SHA1)
+DEFAULT_DIGESTS = DIGEST_MD5_SHA1
+
+# Bounds of the read buffer size chosen for an object
+MIN_BLOCK_SIZE = 2 ** 16
+MAX_BLOCK_SIZE = 2 ** 22
+# Number of received buffers that may wait for the writer thread
+DEFAULT_PIPELINE_DEPTH = 16
+
+# How the body of a download is moved to disk:
+#   stream - chunks from requests' iter_content() written one by one
+#   readinto - the connection is read into reusable buffers written by the writer thread
+#   mmap - the connection is read straight into a memory-mapped view of the target
+#   direct - as readinto, with the target opened O_DIRECT (bypassing the page cache)
+# The target is preallocated for all but stream; anything else falls back to stream
+# when the body can not be read directly (e.g. a Content-Encoding is applied), or
+# where os.pwrite and memoryview.release are not available (Python 2)
+IO_STREAM = 'stream'
+IO_READINTO = 'readinto'
+IO_MMAP = 'mmap'
+IO_DIRECT = 'direct'
+IO_CHOICES = (IO_STREAM, IO_READINTO, IO_MMAP, IO_DIRECT)
+DEFAULT_IO_MODE = IO_READINTO
+# Whether the modes other than stream can be used here
+_HAS_BUFFER_IO = hasattr(os, 'pwrite') and hasattr(memoryview, 'release')
+# Size of the memory-mapped windows of the target, and of the page cache dropped behind a download
+MMAP_WINDOW = 64 * 2 ** 20
+
+
+def SupportedIoMode(io_mode):
+    """
+    The I/O mode to use in place of io_mode: IO_STREAM where the other modes are not supported
+    """
+    if io_mode not in IO_CHOICES:
+        raise UserWarning('Unknown I/O mode: ' + str(io_mode))
+    if not _HAS_BUFFER_IO:
+        return IO_STREAM
+    return io_mode
+
+
+def NewHashes(digests=DEFAULT_DIGESTS):
+    """
+    Create the hashlib objects for a digest selection (one of DIGEST_CHOICES)
+
+    Returns a dictionary of digest name ('md5', 'sha1') to hash object
+    """
+    if digests not in DIGEST_CHOICES:
+        raise UserWarning('Unknown digest selection: ' + str(digests))
+    hashes = {}
+    if digests != DIGEST_NONE:
+        hashes['md5'] = hashlib.md5()
+    if digests == DIGEST_MD5_SHA1:
+        hashes['sha1'] = hashlib.sha1()
+    return hashes
+
+
+def StoreDigests(object_data, hashes):
+    """
+    Store the upper-case hex digests of the hashes in the object data ('md5', 'sha1')
+    """
+    for name, digest in hashes.items():
+        object_data[name] = digest.hexdigest().upper()
+
+
+def BlockSize(size):
+    """
+    Choose the read buffer size for a transfer of size bytes
+
+    Roughly 1/64th of the transfer, as a power of two between MIN_BLOCK_SIZE and MAX_BLOCK_SIZE
+    """
+    block_size = MIN_BLOCK_SIZE
+    while block_size < MAX_BLOCK_SIZE and block_size * 64 < size:
+        block_size *= 2
+    return block_size
+
+
+def Preallocate(fd, size):
+    """
+    Reserve the disk space of a file of size bytes (posix_fallocate)
+
+    Falls back to setting the size (a sparse file) where fallocate is not available
+    Returns True if the space is reserved, so writing it can not fail on a full disk
+    """
+    if hasattr(os, 'posix_fallocate') and size > 0:
+        try:
+            os.posix_fallocate(fd, 0, size)
+            if os.fstat(fd).st_size > size:
+                os.ftruncate(fd, size)
+            return True
+        except OSError:
+            pass
+    os.ftruncate(fd, size)
+    return False
+
+
+def Advise(fd, offset, length, advice):
+    """
+    Give the kernel a posix_fadvise hint ('SEQUENTIAL', 'DONTNEED', ...) where supported
+
+    A length of 0 extends the hint to the end of the file
+    """
+    if not hasattr(os, 'posix_fadvise') or length < 0:
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, getattr(os, 'POSIX_FADV_' + advice))
+    except (AttributeError, OSError):
+        pass
+
+
+def OpenDirect(localpath, flags):
+    """
+    Open a file bypassing the page cache (O_DIRECT)
+
+    Returns the file descriptor, or None if O_DIRECT is not supported here
+    """
+    if not hasattr(os, 'O_DIRECT') or fcntl is None:
+        return None
+    try:
+        return os.open(localpath, flags | os.O_DIRECT, 0o666)
+    except OSError:
+        return None
+
+
+def AllocateBuffer(size):
+    """
+    Allocate a page-aligned buffer (an anonymous memory map), as O_DIRECT requires
+    """
+    return mmap.mmap(-1, size)
+
+
+class DescriptorFile(object):
+    """
+    File-like writer for a file descriptor, possibly opened with O_DIRECT
+
+    O_DIRECT needs writes that are a multiple of the page size from page-aligned
+    buffers; the final, partial block is written after switching O_DIRECT off.
+    """
+
+    def __init__(self, fd, direct=False):
+        self.fd = fd
+        self.direct = direct
+
+    def write(self, data):
+        if self.direct and len(data) % mmap.PAGESIZE:
+            fcntl.fcntl(self.fd, fcntl.F_SETFL, fcntl.fcntl(self.fd, fcntl.F_GETFL) & ~os.O_DIRECT)
+            self.direct = False
+        view = memoryview(data)
+        written = 0
+        while written < len(view):
+            written += os.write(self.fd, view[written:])
+        view.release()
+        return written
+
+    def flush(self):
+        pass
+
+    def fileno(self):
+        return self.fd
+
+
+class BodyReader(object):
+    """
+    Read a streamed response body into caller supplied buffers
+
+    The body is read straight from the connection with readinto(), so no bytes
+    object is allocated per read. Connection failures are raised as
+    requests.exceptions.RequestException like the rest of requests does.
+    """
+
+    def __init__(self, res, length):
+        """
+          res - response of a request made with stream=True
+          length - number of body bytes expected (the Content-Length)
+        """
+        self.res = res
+        self.remaining = length
+        # urllib3 would read (and allocate) on its own; the connection itself reads in place
+        self.fp = getattr(res.raw, '_fp', None)
+        if not hasattr(self.fp, 'readinto'):
+            self.fp = None
+
+    @staticmethod
+    def IsSupported(res):
+        """
+        Determine whether a response body can be read in place (it is sent as is, with a length)
+        """
+        return res.headers.get('Content-Encoding', 'identity') == 'identity' and 'Content-Length' in res.headers
+
+    @property
+    def Remaining(self):
+        """Number of body bytes not read yet"""
+        return self.remaining
+
+    def ReadInto(self, view):
+        """
+        Fill view with the next bytes of the body, or as much of it as the body has left
+
+        Returns the number of bytes read
+        """
+        total = 0
+        wanted = min(len(view), self.remaining)
+        while total < wanted:
+            try:
+                if self.fp is not None:
+                    count = self.fp.readinto(view[total:wanted])
+                else:
+                    data = self.res.raw.read(wanted - total)
+                    count = len(data)
+                    view[total:total + count] = data
+            except (http_client.HTTPException, socket.error) as ex:
+                raise requests.exceptions.ConnectionError(ex)
+            if not count:
+                raise requests.exceptions.ChunkedEncodingError('Response ended prematurely ({0} bytes missing)'.format(self.remaining - total))
+            total += count
+        self.remaining -= total
+        if not self.remaining and self.fp is not None:
+            # urllib3 did not see the body being read; hand the connection back for reuse
+            self.res.raw.release_conn()
+        return total
+
+
+class BufferPool(object):
+    """
+    Fixed set of page-aligned buffers reused for every read of a download
+    """
+
+    def __init__(self, count, size):
+        self.size = size
+        self.free = queue.Queue()
+        for _ in range(max(1, count)):
+            self.free.put(AllocateBuffer(size))
+
+    def Get(self):
+        """
+        Take a buffer; blocks until one is returned
+        """
+        return self.free.get()
+
+    def Put(self, buffer):
+        """
+        Return a buffer for reuse
+        """
+        self.free.put(buffer)
+
+
+class WritePipeline(object):
+    """
+    Write and hash received data on a separate thread
+
+    The receiving thread only queues the buffers it reads from the network; a
+    writer thread writes them to the target file and updates the hashes. hashlib
+    and file writes release the GIL for large buffers, so receiving, writing and
+    hashing overlap. The queue is bounded to limit the memory held in flight.
+    """
+
+    def __init__(self, target_file, hashes, max_buffered=DEFAULT_PIPELINE_DEPTH, checkpoint=None, checkpoint_bytes=0):
+        """
+        Start the writer thread
+          target_file - file object positioned where the data is to be written; None when the
+                        data is already in place (e.g. read into a memory-mapped target) and
+                        only has to be hashed
+          hashes - dictionary of hash objects to update (see NewHashes)
+          max_buffered - number of buffers that may wait for the writer thread
+          checkpoint - optional callable given the number of bytes written (and flushed)
+          checkpoint_bytes - call checkpoint each time this many more bytes were written
+        """
+        self.target_file = target_file
+        self.hashes = hashes
+        self.depth = max(1, max_buffered)
+        self.queue = queue.Queue(self.depth)
+        self.checkpoint = checkpoint
+        self.checkpoint_bytes = checkpoint_bytes
+        self.bytes_written = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.__Writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def Depth(self):
+        """Number of buffers that may wait for the writer thread"""
+        return self.depth
+
+    @property
+    def BytesWritten(self):
+        """Number of bytes written to the target file so far"""
+        return self.bytes_written
+
+    def Write(self, data, release=None):
+        """
+        Queue data to be written and hashed; blocks while the queue is full
+          release - optional callable called once the data is no longer used (e.g. to reuse its buffer)
+        """
+        if self.error is not None:
+            raise UserWarning('Unable to write the download: ' + str(self.error))
+        self.queue.put((data, release))
+
+    def Release(self, release):
+        """
+        Queue a call of release once all the data queued so far has been written
+        """
+        self.queue.put((None, release))
+
+    def Close(self):
+        """
+        Wait for the queued data to be written
+
+        Raises UserWarning if any of it could not be written
+        """
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise UserWarning('Unable to write the download: ' + str(self.error))
+
+    def __Writer(self):
+        """
+        Writer thread: write and hash queued data until Close()
+        """
+        next_checkpoint = self.checkpoint_bytes
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            data, release = item
+            try:
+                if self.error is not None or data is None:
+                    # Keep draining so the receiving thread never blocks
+                    continue
+                if self.target_file is not None:
+                    self.target_file.write(data)
+                for digest in self.hashes.values():
+                    digest.update(data)
+                self.bytes_written += len(data)
+                if self.checkpoint is not None and self.bytes_written >= next_checkpoint:
+                    if self.target_file is not None:
+                        self.target_file.flush()
+                    self.checkpoint(self.bytes_written)
+                    next_checkpoint = self.bytes_written + self.checkpoint_bytes
+            except (IOError, OSError, ValueError) as ex:
+                self.error = ex
+            finally:
+                if isinstance(data, memoryview):
+                    # Views of a memory map must be gone before it can be unmapped
+                    data.release()
+                if release is not None:
+                    release()
+
+
+def _Unmap(window, view):
+    """
+    Unmap a window of a memory-mapped target once the writer thread is done with it
+    """
+    view.release()
+    try:
+        window.close()
+    except BufferError:
+        # Still referenced; unmapped once the last reference is gone
+        pass
+
+
+class _DropBehind(object):
+    """
+    Drop the cached pages of a download a window behind the data being received
+
+    Only pages already written back are dropped, so the hint never forces I/O;
+    a multi-GB download then does not push everything else out of the page cache.
+    """
+
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.dropped = offset - offset % MMAP_WINDOW
+
+    def Advance(self, position):
+        while position - self.dropped >= 2 * MMAP_WINDOW:
+            Advise(self.fd, self.dropped, MMAP_WINDOW, 'DONTNEED')
+            self.dropped += MMAP_WINDOW
+
+
+def ReceiveBody(res, localpath, offset, length, hashes, io_mode=DEFAULT_IO_MODE, block_size=MIN_BLOCK_SIZE, checkpoint=None, checkpoint_bytes=0, progress=None):
+    """
+    Write the body of a streamed response to localpath, starting at offset, hashing it on the way
+      res - response of a request made with stream=True
+      length - number of body bytes (the Content-Length)
+      hashes - dictionary of hash objects to update (see NewHashes)
+      io_mode - how the body is moved to disk (see IO_CHOICES)
+      block_size - number of bytes read at a time
+      checkpoint - optional callable given the number of bytes written (see WritePipeline)
+      checkpoint_bytes - call checkpoint each time this many more bytes were written
+      progress - optional callable given the number of bytes received so far
+
+    The file is cut (or extended) to offset + length. Returns the number of bytes received
+    """
+    io_mode = SupportedIoMode(io_mode)
+    if io_mode != IO_STREAM and not BodyReader.IsSupported(res):
+        io_mode = IO_STREAM
+    if io_mode == IO_STREAM:
+        return _ReceiveStream(res, localpath, offset, hashes, block_size, checkpoint, checkpoint_bytes, progress)
+
+    fd = None
+    if io_mode == IO_DIRECT and not offset % mmap.PAGESIZE:
+        fd = OpenDirect(localpath, os.O_RDWR | os.O_CREAT)
+    if fd is None:
+        fd = os.open(localpath, os.O_RDWR | os.O_CREAT, 0o666)
+        if io_mode == IO_DIRECT:
+            io_mode = IO_READINTO
+    try:
+        reserved = Preallocate(fd, offset + length)
+        if io_mode == IO_MMAP and not reserved:
+            # Writing through a map into a sparse file on a full disk crashes the process (SIGBUS)
+            io_mode = IO_READINTO
+        if io_mode == IO_MMAP:
+            return _ReceiveMapped(res, fd, offset, length, hashes, block_size, checkpoint, checkpoint_bytes, progress)
+        return _ReceiveBuffered(res, fd, offset, hashes, block_size, checkpoint, checkpoint_bytes, progress, io_mode == IO_DIRECT)
+    finally:
+        os.close(fd)
+
+
+def PipeBody(res, pipeline, io_mode=DEFAULT_IO_MODE, block_size=MIN_BLOCK_SIZE, progress=None):
+    """
+    Queue the body of a streamed response to a WritePipeline
+      res - response of a request made with stream=True
+      pipeline - WritePipeline writing (and hashing) the body
+      io_mode - IO_STREAM to queue the chunks of iter_content(); otherwise the connection
+                is read into a pool of reusable buffers (when the body can be read in place)
+      block_size - number of bytes read at a time
+      progress - optional callable given the number of bytes received so far
+
+    At most the pipeline depth of buffers is held in flight, so a slow writer
+    slows down the receiving (and the sender) rather than growing the memory used.
+    Returns the number of bytes received
+    """
+    received = 0
+    if SupportedIoMode(io_mode) == IO_STREAM or not BodyReader.IsSupported(res):
+        for object_chunk in res.iter_content(chunk_size=block_size):
+            pipeline.Write(object_chunk)
+            received += len(object_chunk)
+            if progress is not None:
+                progress(received)
+        return received
+
+    reader = BodyReader(res, int(res.headers['Content-Length']))
+    pool = BufferPool(min(pipeline.Depth + 2, (reader.Remaining + block_size - 1) // block_size), block_size)
+    while reader.Remaining:
+        buffer = pool.Get()
+        count = reader.ReadInto(memoryview(buffer))
+        pipeline.Write(memoryview(buffer)[:count], functools.partial(pool.Put, buffer))
+        received += count
+        if progress is not None:
+            progress(received)
+    return received
+
+
+def _ReceiveStream(res, localpath, offset, hashes, block_size, checkpoint, checkpoint_bytes, progress):
+    """
+    ReceiveBody: chunks from iter_content() written by the writer thread
+    """
+    with open(localpath, 'r+b' if offset else 'wb') as target_file:
+        target_file.seek(offset)
+        target_file.truncate()
+        pipeline = WritePipeline(target_file, hashes, checkpoint=checkpoint, checkpoint_bytes=checkpoint_bytes)
+        try:
+            return PipeBody(res, pipeline, IO_STREAM, block_size, progress)
+        finally:
+            pipeline.Close()
+
+
+def _ReceiveBuffered(res, fd, offset, hashes, block_size, checkpoint, checkpoint_bytes, progress, direct):
+    """
+    ReceiveBody: the connection is read into a pool of reusable buffers written by the writer thread
+    """
+    drop_behind = None
+    if not direct:
+        drop_behind = _DropBehind(fd, offset)
+
+    def received(count):
+        if progress is not None:
+            progress(count)
+        if drop_behind is not None:
+            drop_behind.Advance(offset + count)
+
+    os.lseek(fd, offset, os.SEEK_SET)
+    pipeline = WritePipeline(DescriptorFile(fd, direct), hashes, checkpoint=checkpoint, checkpoint_bytes=checkpoint_bytes)
+    try:
+        return PipeBody(res, pipeline, IO_READINTO, block_size, received)
+    finally:
+        pipeline.Close()
+
+
+def _ReceiveMapped(res, fd, offset, length, hashes, block_size, checkpoint, checkpoint_bytes, progress):
+    """
+    ReceiveBody: the connection is read straight into memory-mapped windows of the target;
+    the writer thread only hashes
+    """
+    reader = BodyReader(res, length)
+    drop_behind = _DropBehind(fd, offset)
+    pipeline = WritePipeline(None, hashes, checkpoint=checkpoint, checkpoint_bytes=checkpoint_bytes)
+    position = offset
+    end = offset + length
+    try:
+        while reader.Remaining:
+            window_start = position - position % mmap.ALLOCATIONGRANULARITY
+            window_length = min(MMAP_WINDOW, end - window_start)
+            window = mmap.mmap(fd, window_length, offset=window_start)
+            view = memoryview(window)
+            try:
+                while position < window_start + window_length:
+                    start = position - window_start
+                    block = view[start:min(start + block_size, window_length)]
+                    position += reader.ReadInto(block)
+                    pipeline.Write(block)
+                    block = None
+                    if progress is not None:
+                        progress(position - offset)
+            finally:
+                pipeline.Release(functools.partial(_Unmap, window, view))
+            drop_behind.Advance(position)
+    finally:
+        pipeline.Close()
+    return position - offset
+
+
+class DownloadJournal(object):
+    """
+    Sidecar journal recording which byte ranges of a download are already on disk
+
+    hashlib objects cannot be saved and restored, so in place of the running hash
+    state the journal keeps the MD5 of each completed range (when known). A resumed
+    download checks those ranges against the file before trusting them and rebuilds
+    the running hash of a sequential download from the bytes already on disk.
+    """
+
+    def __init__(self, localpath, uri, size, etag):
+        """
+        Setup the journal of a download
+          localpath - file the object is downloaded to
+          uri - full URI of the object
+          size - size of the object in bytes
+          etag - ETag (MD5) of the object; a changed object invalidates the journal
+        """
+        self.log = logging.getLogger(__name__)
+        self.path = localpath + JOURNAL_SUFFIX
+        self.localpath = localpath
+        self.lock = threading.Lock()
+        self.download = {'uri': uri, 'size': size, 'etag': etag}
+        self.part_size = None
+        self.completed = {}
+
+    @property
+    def Completed(self):
+        """Dictionary of offset to (length, md5) of the ranges already on disk"""
+        return self.completed
+
+    def Load(self, part_size=None):
+        """
+        Load the journal left by an earlier attempt at the same download
+
+        Returns True if there is progress to resume
+        """
+        self.part_size = part_size
+        self.completed = {}
+        try:
+            with open(self.path, 'r') as journal_file:
+                journal = json.load(journal_file)
+            local_size = os.path.getsize(self.localpath)
+        except (IOError, OSError, ValueError):
+            return False
+
+        if journal.get('download') != self.download or journal.get('part_size') != part_size:
+            self.log.info('Ignoring journal {0} of a different download'.format(self.path))
+            return False
+        for offset, length, digest in journal.get('completed', []):
+            if offset + length <= local_size:
+                self.completed[offset] = (length, digest)
+        if len(self.completed):
+            self.log.info('Resuming download: {0} of {1} bytes already on disk'.format(sum(length for length, dummy in self.completed.values()), self.download['size']))
+        return len(self.completed) > 0
+
+    def Start(self, part_size=None):
+        """
+        Begin a new journal for a download starting from byte zero
+        """
+        with self.lock:
+            self.part_size = part_size
+            self.completed = {}
+            self.__Write()
+
+    def Record(self, offset, length, digest=None):
+        """
+        Record that length bytes at offset are on disk, with their MD5 (hex) if known
+        """
+        with self.lock:
+            self.completed[offset] = (length, digest)
+            self.__Write()
+
+    def Remove(self):
+        """
+        Remove the journal once the download is complete (or can not be resumed)
+        """
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def __Write(self):
+        """
+        Replace the journal on disk; the caller holds the lock
+        """
+        journal = {}
+        journal['download'] = self.download
+        journal['part_size'] = self.part_size
+        journal['completed'] = [[offset, length, digest] for offset, (length, digest) in sorted(self.completed.items())]
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as journal_file:
+            json.dump(journal, journal_file)
+        os.rename(temporary_path, self.path)
+
+
+class RangedDownload(object):
+    """
+    Download an object by splitting it into byte ranges that are fetched concurrently
+
+    Each range is written at its own offset in a target file that is preallocated
+    to the full object size, so the ranges may complete in any order. A range that
+    fails is retried on its own without disturbing the other ranges.
+    """
+
+    def __init__(self, authenticator, uri, size, localpath, part_size=DEFAULT_PART_SIZE, concurrency=DEFAULT_CONCURRENCY, retries=DEFAULT_RETRIES, journal=None, io_mode=DEFAULT_IO_MODE, progress=None):
+        """
+        Setup the download
+          authenticator - instance of rcbu.client.auth.Authentication supplying the token
+          uri - full URI of the object
+          size - size of the object in bytes
+          localpath - file to write the object to
+          part_size - number of bytes requested by each ranged GET
+          concurrency - maximum number of ranges in flight at the same time
+          retries - number of times a single range is retried before the download fails
+          journal - optional DownloadJournal making the download resumable
+          io_mode - how each range is moved to disk (see IO_CHOICES); the ranges are read
+                    into reusable buffers written with pwrite for IO_READINTO and IO_DIRECT
+                    (the page cache is not bypassed), or into a memory-mapped view for IO_MMAP;
+                    IO_STREAM is used where these are not supported (see SupportedIoMode)
+          progress - optional callable given the number of bytes on disk or received so far
+                     and the size, called from the worker threads as the data arrives
+        """
+        io_mode = SupportedIoMode(io_mode)
+        self.log = logging.getLogger(__name__)
+        self.authenticator = authenticator
+        self.uri = uri
+        self.size = size
+        self.localpath = localpath
+        self.part_size = max(1, int(part_size))
+        self.concurrency = max(1, int(concurrency))
+        self.retries = max(0, int(retries))
+        self.lock = threading.Lock()
+        self.bytes_completed = 0
+        # Bytes retrieved by this run, excluding ranges resumed from the journal
+        self.bytes_transferred = 0
+        self.parts_completed = 0
+        self.elapsed = 0.0
+        # Large Object manifests report an ETag that is not the MD5 of the body
+        self.is_manifest = False
+        self.etag = None
+        self.journal = journal
+        self.io_mode = io_mode
+        # Target file descriptor shared by the ranges, and whether its space is reserved
+        self.fd = None
+        self.reserved = False
+        # Each worker thread reuses its own read buffer
+        self.local = threading.local()
+        self.progress = progress
+        # Bytes of each range received so far, and of all of them
+        self.part_received = {}
+        self.bytes_received = 0
+
+    @property
+    def Parts(self):
+        """List of (offset, length) byte ranges making up the object"""
+        return [(offset, min(self.part_size, self.size - offset)) for offset in range(0, self.size, self.part_size)]
+
+    @property
+    def Throughput(self):
+        """Aggregate throughput of the download in bytes per second"""
+        if self.elapsed > 0:
+            return self.bytes_transferred / self.elapsed
+        return 0.0
+
+    def __Progress(self, offset, received):
+        """
+        Report the number of bytes of the range at offset received so far
+        """
+        if self.progress is None:
+            return
+        with self.lock:
+            # A range that is retried starts over at 0
+            self.bytes_received += received - self.part_received.get(offset, 0)
+            self.part_received[offset] = received
+            bytes_received = self.bytes_received
+        self.progress(bytes_received, self.size)
+
+    def __FetchPart(self, offset, length, attempt=0):
+        """
+        Retrieve a single byte range and write it at its offset in the target file
+        """
+        self.__Progress(offset, 0)
+        last_offset = offset + length - 1
+        headers = {}
+        headers['X-Auth-Token'] = self.authenticator.AuthToken
+        headers['Range'] = 'bytes={0}-{1}'.format(offset, last_offset)
+        res = Command.SendRequest('GET', self.uri, 'object-range', attempt, headers=headers, stream=True)
+        received = 0
+        try:
+            if res.status_code != 206:
+                raise UserWarning('Cloud Files responded unexpectedly to range {0}-{1} (Code: {2})'.format(offset, last_offset, res.status_code))
+            if 'X-Static-Large-Object' in res.headers or 'X-Object-Manifest' in res.headers:
+                self.is_manifest = True
+            self.etag = res.headers.get('ETag', '').strip('"')
+
+            part_hash = None
+            if self.journal is not None:
+                part_hash = hashlib.md5()
+            if self.io_mode == IO_STREAM or not BodyReader.IsSupported(res):
+                with open(self.localpath, 'r+b') as target_file:
+                    target_file.seek(offset)
+                    for object_chunk in res.iter_content(chunk_size=BlockSize(length)):
+                        target_file.write(object_chunk)
+                        if part_hash is not None:
+                            part_hash.update(object_chunk)
+                        received += len(object_chunk)
+                        self.__Progress(offset, received)
+            elif self.io_mode == IO_MMAP and self.reserved:
+                received = self.__ReceiveMapped(BodyReader(res, length), offset, length, part_hash)
+            else:
+                received = self.__ReceiveBuffered(BodyReader(res, length), offset, length, part_hash)
+
+            if received != length:
+                raise UserWarning('Range {0}-{1} was truncated ({2} of {3} bytes)'.format(offset, last_offset, received, length))
+        finally:
+            res.close()
+            Command.FinishRequest(res, received)
+
+        if self.journal is not None:
+            self.journal.Record(offset, length, part_hash.hexdigest())
+        with self.lock:
+            self.bytes_transferred += length
+        return length
+
+    def __ReceiveBuffered(self, reader, offset, length, part_hash):
+        """
+        Read a range into the reusable buffer of the current thread and write it at its offset
+        """
+        block_size = BlockSize(length)
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None or len(buffer) != block_size:
+            buffer = self.local.buffer = AllocateBuffer(block_size)
+        view = memoryview(buffer)
+        received = 0
+        try:
+            while reader.Remaining:
+                count = reader.ReadInto(view)
+                block = view[:count]
+                written = 0
+                while written < count:
+                    written += os.pwrite(self.fd, block[written:], offset + received + written)
+                if part_hash is not None:
+                    part_hash.update(block)
+                block.release()
+                received += count
+                self.__Progress(offset, received)
+        finally:
+            view.release()
+        return received
+
+    def __ReceiveMapped(self, reader, offset, length, part_hash):
+        """
+        Read a range straight into a memory-mapped view of its place in the target
+        """
+        window_start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        window = mmap.mmap(self.fd, offset + length - window_start, offset=window_start)
+        view = memoryview(window)
+        block_size = BlockSize(length)
+        position = offset - window_start
+        try:
+            while reader.Remaining:
+                block = view[position:position + block_size]
+                count = reader.ReadInto(block)
+                if part_hash is not None:
+                    part_hash.update(block[:count])
+                block.release()
+                position += count
+                self.__Progress(offset, position - (offset - window_start))
+        finally:
+            _Unmap(window, view)
+        return position - (offset - window_start)
+
+    def __IsPartOnDisk(self, offset, length):
+        """
+        Determine whether a range recorded by the journal is intact in the target file
+        """
+        if self.journal is None or offset not in self.journal.Completed:
+            return False
+        recorded_length, recorded_digest = self.journal.Completed[offset]
+        if recorded_length != length or recorded_digest is None:
+            return False
+        part_hash = hashlib.md5()
+        with open(self.localpath, 'rb') as source_file:
+            source_file.seek(offset)
+            remaining = length
+            while remaining > 0:
+                block = source_file.read(min(remaining, 2 ** 20))
+                if not block:
+                    return False
+                part_hash.update(block)
+                remaining -= len(block)
+        return part_hash.hexdigest() == recorded_digest
+
+    def __DownloadPart(self, offset, length):
+        """
+        Retrieve a single byte range, retrying it on its own on failure
+        """
+        attempt = 0
+        while not self.__IsPartOnDisk(offset, length):
+            try:
+                self.__FetchPart(offset, length, attempt)
+                break
+            except (UserWarning, requests.exceptions.RequestException) as ex:
+                if attempt >= self.retries:
+                    self.log.error('Range at offset {0} failed after {1} attempts: {2}'.format(offset, attempt + 1, str(ex)))
+                    raise
+                delay = Command.RetryPolicy().Delay(attempt)
+                attempt += 1
+                self.log.error('Range at offset {0} failed, retrying in {1:.2f} seconds ({2} of {3}): {4}'.format(offset, delay, attempt, self.retries, str(ex)))
+                time.sleep(delay)
+
+        # Ranges resumed from the journal count as received
+        self.__Progress(offset, length)
+        with self.lock:
+            self.bytes_completed += length
+            self.parts_completed += 1
+            self.log.info('Downloaded part {0} of {1} ({2} of {3} bytes)'.format(self.parts_completed, len(self.Parts), self.bytes_completed, self.size))
+        return length
+
+    def Run(self):
+        """
+        Download all the ranges
+
+        Returns True on success; raises UserWarning if any range could not be retrieved
+        """
+        parts = self.Parts
+        self.log.info('Downloading object: {0} bytes in {1} parts using {2} connections...'.format(self.size, len(parts), self.concurrency))
+
+        # Preallocate the target so every range can be written in place
+        if self.journal is not None and self.journal.Load(self.part_size):
+            self.fd = os.open(self.localpath, os.O_RDWR | os.O_CREAT, 0o666)
+        else:
+            self.fd = os.open(self.localpath, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+            if self.journal is not None:
+                self.journal.Start(self.part_size)
+        try:
+            # A range written through a map into a sparse file on a full disk crashes the process (SIGBUS)
+            self.reserved = Preallocate(self.fd, self.size)
+            return self.__Run(parts)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
+    def __Run(self, parts):
+        """
+        Download the ranges into the open target
+        """
+        start_time = time.time()
+        with futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pending = [executor.submit(self.__DownloadPart, offset, length) for offset, length in parts]
+            try:
+                for part in futures.as_completed(pending):
+                    part.result()
+            except (UserWarning, requests.exceptions.RequestException):
+                for part in pending:
+                    part.cancel()
+                raise UserWarning('Unable to download ' + self.uri)
+            finally:
+                self.elapsed = time.time() - start_time
+
+        self.log.info('Downloaded {0} bytes in {1:.2f} seconds ({2:.2f} MB/s)'.format(self.bytes_transferred, self.elapsed, self.Throughput / 2 ** 20))
+        return True
+
+
+def HashFile(localpath, digests=DEFAULT_DIGESTS, length=None, hashes=None, block_size=MAX_BLOCK_SIZE):
+    """
+    Hash a local file, or only its first length bytes
+
+    hashes - optional dictionary of hash objects to continue (see NewHashes);
+             otherwise new ones are created for digests
+
+    Returns the dictionary of hash objects
+    """
+    if hashes is None:
+        hashes = NewHashes(digests)
+    if not len(hashes):
+        return hashes
+    # One buffer is read into over and over rather than allocating a block per read
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    with open(localpath, 'rb', buffering=0) as source_file:
+        Advise(source_file.fileno(), 0, 0 if length is None else length, 'SEQUENTIAL')
+        remaining = length
+        while remaining is None or remaining > 0:
+            count = source_file.readinto(view if remaining is None else view[:min(remaining, block_size)])
+            if not count:
+                break
+            for digest in hashes.values():
+                digest.update(view[:count])
+            if remaining is not None:
+                remaining -= count
+    return hashes
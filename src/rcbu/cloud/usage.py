@@ -0,0 +1,210 @@
+"""
+Rackspace Cloud Files - Account Usage Report
+"""
+import json
+import logging
+import threading
+import time
+
+import requests
+from concurrent import futures
+
+from rcbu.cloud.files import CloudFiles
+
+
+DEFAULT_CONCURRENCY = 32
+
+SORT_REGION = 'region'
+SORT_NAME = 'name'
+SORT_OBJECTS = 'objects'
+SORT_BYTES = 'bytes'
+SORT_CHOICES = (SORT_REGION, SORT_NAME, SORT_OBJECTS, SORT_BYTES)
+
+_SORT_KEYS = {
+    SORT_REGION: lambda entry: (entry['region'], entry['container']),
+    SORT_NAME: lambda entry: (entry['container'], entry['region']),
+    SORT_OBJECTS: lambda entry: entry['object-count'],
+    SORT_BYTES: lambda entry: entry['bytes-used']
+}
+
+
+class AccountUsage(object):
+    """
+    Object count and bytes used of every container in every region of an account
+
+    The containers of all the regions are listed concurrently and then each one is
+    sent a HEAD request, up to concurrency at a time, so the report takes about as
+    long as the slowest few requests rather than the sum of all of them.
+    """
+
+    def __init__(self, authenticator, sslenabled=True, network='public', regions=None, concurrency=DEFAULT_CONCURRENCY):
+        """
+        Setup the report
+          authenticator - instance of rcbu.client.auth.Authentication to use
+          sslenabled - True if using HTTPS; otherwise False
+          network - Cloud Files network to use: 'public' or 'snet'
+          regions - data centers to report on; defaults to every one in the service catalog
+          concurrency - maximum number of requests in flight at the same time
+        """
+        self.log = logging.getLogger(__name__)
+        self.authenticator = authenticator
+        self.sslenabled = sslenabled
+        self.network = network
+        self.regions = regions
+        self.concurrency = max(1, int(concurrency))
+        # CloudFiles instances are not thread-safe; each worker thread uses its own
+        self.local = threading.local()
+        self.entries = []
+        self.failures = []
+        self.elapsed = 0.0
+
+    @property
+    def Entries(self):
+        """
+        List of dictionaries of 'region', 'container', 'object-count' and 'bytes-used'
+        """
+        return self.entries
+
+    @property
+    def Failures(self):
+        """List of (region, container, reason) for the containers that could not be reported"""
+        return self.failures
+
+    def __CloudFiles(self):
+        """
+        CloudFiles instance of the current thread
+        """
+        cloudfiles = getattr(self.local, 'cloudfiles', None)
+        if cloudfiles is None:
+            cloudfiles = self.local.cloudfiles = CloudFiles(self.sslenabled, self.authenticator)
+        return cloudfiles
+
+    def __RegionUri(self, region):
+        """
+        Cloud Files URI (without the scheme) of the selected network in a region; None if there is none
+        """
+        for uri in self.authenticator.GetCloudFilesUri(region):
+            if uri['name'] == self.network:
+                return uri['uri'].split('://', 1)[-1]
+        return None
+
+    def __ListRegion(self, region, uri):
+        """
+        Worker: names of every container in a region
+        """
+        return [container['name'] for container in self.__CloudFiles().IterContainers(uri)]
+
+    def __HeadContainer(self, region, uri, container):
+        """
+        Worker: usage of a single container
+        """
+        metadata = self.__CloudFiles().GetContainerMetadata(uri, container)
+        if not len(metadata):
+            raise UserWarning('HEAD failed')
+        entry = {}
+        entry['region'] = region
+        entry['container'] = container
+        entry['object-count'] = metadata['object-count']
+        entry['bytes-used'] = metadata['bytes-used']
+        return entry
+
+    def Run(self):
+        """
+        Collect the usage of every container
+
+        Returns True if every container was reported
+        """
+        start_time = time.time()
+        regions = self.regions
+        if regions is None:
+            regions = self.authenticator.GetCloudFilesDataCenters()
+        self.entries = []
+        self.failures = []
+
+        with futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            listings = {}
+            for region in regions:
+                uri = self.__RegionUri(region)
+                if uri is None:
+                    self.failures.append((region, '', 'no ' + self.network + ' endpoint'))
+                    continue
+                listings[executor.submit(self.__ListRegion, region, uri)] = (region, uri)
+
+            heads = {}
+            for listing in futures.as_completed(listings):
+                region, uri = listings[listing]
+                try:
+                    containers = listing.result()
+                except (UserWarning, ValueError, requests.exceptions.RequestException) as ex:
+                    self.log.error('Unable to list the containers in ' + region + ': ' + str(ex))
+                    self.failures.append((region, '', str(ex)))
+                    continue
+                self.log.info('Found {0} containers in {1}'.format(len(containers), region))
+                for container in containers:
+                    heads[executor.submit(self.__HeadContainer, region, uri, container)] = (region, container)
+
+            for head in futures.as_completed(heads):
+                region, container = heads[head]
+                try:
+                    self.entries.append(head.result())
+                except (UserWarning, ValueError, requests.exceptions.RequestException) as ex:
+                    self.log.error('Unable to retrieve the usage of ' + region + '/' + container + ': ' + str(ex))
+                    self.failures.append((region, container, str(ex)))
+
+        self.elapsed = time.time() - start_time
+        self.log.info('Collected the usage of {0} containers in {1:.2f} seconds'.format(len(self.entries), self.elapsed))
+        return not len(self.failures)
+
+    def Sorted(self, key=SORT_BYTES, reverse=None):
+        """
+        Entries ordered by region, container name, object count or bytes used (see SORT_CHOICES)
+          reverse - descending order; defaults to descending for counts and ascending for names
+        """
+        if key not in _SORT_KEYS:
+            raise UserWarning('Unknown sort key: ' + key)
+        if reverse is None:
+            reverse = key in (SORT_OBJECTS, SORT_BYTES)
+        return sorted(self.entries, key=_SORT_KEYS[key], reverse=reverse)
+
+    def Totals(self):
+        """
+        Dictionary of region to 'containers', 'object-count' and 'bytes-used', with the
+        account total under ''
+        """
+        totals = {}
+        for entry in self.entries:
+            for region in (entry['region'], ''):
+                total = totals.setdefault(region, {'containers': 0, 'object-count': 0, 'bytes-used': 0})
+                total['containers'] += 1
+                total['object-count'] += entry['object-count']
+                total['bytes-used'] += entry['bytes-used']
+        return totals
+
+    def ToJson(self, key=SORT_BYTES, reverse=None):
+        """
+        JSON text of the report: 'containers' (see Sorted), 'totals' (see Totals) and 'failures'
+        """
+        report = {}
+        report['time'] = time.time()
+        report['elapsed'] = self.elapsed
+        report['containers'] = self.Sorted(key, reverse)
+        report['totals'] = self.Totals()
+        report['failures'] = [{'region': region, 'container': container, 'reason': reason} for region, container, reason in self.failures]
+        return json.dumps(report, indent=4, sort_keys=True)
+
+    def ToTable(self, key=SORT_BYTES, reverse=None):
+        """
+        Text table of the report, followed by the totals of each region
+        """
+        entries = self.Sorted(key, reverse)
+        width = max([len('Container')] + [len(entry['container']) for entry in entries])
+        row = '{0:<8} {1:<' + str(width) + '} {2:>14} {3:>20}'
+        lines = [row.format('Region', 'Container', 'Objects', 'Bytes')]
+        for entry in entries:
+            lines.append(row.format(entry['region'], entry['container'], entry['object-count'], entry['bytes-used']))
+        lines.append('')
+        totals = self.Totals()
+        for region in sorted(totals, key=lambda region: (not len(region), region)):
+            total = totals[region]
+            lines.append(row.format(region or 'Total', '(' + str(total['containers']) + ' containers)', total['object-count'], total['bytes-used']))
+        return '\n'.join(lines)
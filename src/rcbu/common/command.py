@@ -1,13 +1,46 @@
 """
 RCBU Command API
 """
+import logging
+import threading
+import time
+
+import requests
+from requests.compat import urlparse
+
+from rcbu.common import metrics
+from rcbu.common import retry
+
+
+# Number of distinct API hosts to keep connection pools for
+DEFAULT_POOL_HOSTS = 10
+# Number of keep-alive connections kept open to each API host
+DEFAULT_POOL_SIZE = 16
 
 
 class Command(object):
     """
     Base class for defining HTTP REST API calls
+
+    All instances share a single requests.Session so that connections to an API
+    host are kept alive and reused across calls and across Command subclasses.
+    Every request is timed and aggregated per endpoint (see rcbu.common.metrics),
+    and is retried and rate limited per API host (see rcbu.common.retry).
     """
 
+    # Shared HTTP session and its configuration; see ConfigureConnectionPool()
+    __session = None
+    __session_lock = threading.Lock()
+    __pool_options = {
+        'pool_hosts': DEFAULT_POOL_HOSTS,
+        'pool_size': DEFAULT_POOL_SIZE,
+        'host_pool_sizes': {},
+        'keep_alive': True
+    }
+    # Retries and per-host limits of every request; see ConfigureRetries()
+    __retry_policy = retry.RetryPolicy()
+    __limiters = retry.HostLimiters()
+
     def __init__(self, sslenabled, apihost, uripath):
         """
         Initialize the Command Object
@@ -54,9 +87,207 @@ class Command(object):
         self.headers = {}
         self.headers['Content-Type'] = 'application/json; charset=utf-8'
         # HTTP or HTTPS
+        self.uri = self.BuildUri(sslenabled, self.apihost, uripath)
+
+    __ReInit = ReInit
+
+    @staticmethod
+    def BuildUri(sslenabled, apihost, uripath):
+        """
+        Build the HTTP URI for a REST API call without changing any Command state
+        """
         if (sslenabled):
-            self.uri = "https://" + self.apihost + uripath
+            return "https://" + apihost + uripath
         else:
-            self.uri = "http://" + self.apihost + uripath
+            return "http://" + apihost + uripath
 
-    __ReInit = ReInit
+    def Request(self, method, metric=None, retries=0, retry_policy=None, **kwargs):
+        """
+        Issue an HTTP request for the current Uri, Headers and Body over the shared session
+          method - HTTP method
+          metric - name the request is aggregated under in the metrics; defaults to the class name
+          retries - number of earlier attempts of the same request
+          retry_policy - rcbu.common.retry.RetryPolicy to use; defaults to the shared one
+
+        Any keyword arguments are passed through to requests.Session.request()
+        and take precedence over the current Uri, Headers and Body
+
+        When stream=True the request is only recorded in the metrics once the
+        caller passes the response to FinishRequest()
+        """
+        uri = kwargs.pop('uri', self.Uri)
+        kwargs.setdefault('headers', self.Headers)
+        if self.Body is not None:
+            kwargs.setdefault('data', self.Body)
+        if metric is None:
+            metric = type(self).__name__
+        return Command.SendRequest(method, uri, metric, retries, retry_policy, **kwargs)
+
+    @staticmethod
+    def SendRequest(method, uri, metric, retries=0, retry_policy=None, **kwargs):
+        """
+        Issue an HTTP request over the shared session, recording its timings
+          method - HTTP method
+          uri - full URI of the request
+          metric - name the request is aggregated under in the metrics
+          retries - number of earlier attempts of the same request
+          retry_policy - rcbu.common.retry.RetryPolicy to use; defaults to the shared one
+
+        Any keyword arguments are passed through to requests.Session.request()
+
+        Connection failures and retryable statuses (e.g. 429 and 503) are retried
+        with backoff; the last response (or exception) is returned (or raised)
+        once the retries are exhausted. Each request waits for room under the
+        limit of its API host (see rcbu.common.retry.HostLimiter); the room is
+        returned once the response headers arrive, so a streamed body is not held
+        against the limit while it is read.
+        """
+        if retry_policy is None:
+            retry_policy = Command.__retry_policy
+        host = urlparse(uri).netloc
+        limiter = Command.__limiters.Get(host)
+        attempt = 0
+        while True:
+            limiter.Acquire()
+            res = None
+            try:
+                with metrics.RequestTimer(metric, host, method, retries + attempt) as timer:
+                    res = Command.Session().request(method, uri, **kwargs)
+            except retry.RETRY_EXCEPTIONS as ex:
+                if attempt >= retry_policy.retries:
+                    raise
+                delay = retry_policy.Delay(attempt)
+                logging.getLogger(__name__).error('{0} {1} failed, retrying in {2:.2f} seconds ({3} of {4}): {5}'.format(
+                    method, uri, delay, attempt + 1, retry_policy.retries, str(ex)))
+            finally:
+                limiter.Release(res)
+            if res is not None:
+                timer.Response(res)
+                if attempt >= retry_policy.retries or not retry_policy.IsRetryable(res):
+                    break
+                delay = retry_policy.Delay(attempt, res)
+                logging.getLogger(__name__).error('{0} {1} returned {2}, retrying in {3:.2f} seconds ({4} of {5})'.format(
+                    method, uri, res.status_code, delay, attempt + 1, retry_policy.retries))
+                timer.Finish(0)
+                res.close()
+            time.sleep(delay)
+            attempt += 1
+
+        if kwargs.get('stream', False):
+            res.request_timer = timer
+        else:
+            timer.Finish(len(res.content))
+        return res
+
+    @staticmethod
+    def FinishRequest(res, bytes_received=None):
+        """
+        Record a streamed response as finished once its body has been consumed
+          res - response returned by Request() or SendRequest() with stream=True
+          bytes_received - body bytes consumed
+        """
+        timer = getattr(res, 'request_timer', None)
+        if timer is not None:
+            timer.Finish(bytes_received)
+
+    @staticmethod
+    def RetryPolicy():
+        """
+        Retrieve the retry policy shared by all Command instances (see rcbu.common.retry.RetryPolicy)
+        """
+        return Command.__retry_policy
+
+    @staticmethod
+    def ConfigureRetries(retries=retry.DEFAULT_RETRIES, base_delay=retry.DEFAULT_BASE_DELAY, max_delay=retry.DEFAULT_MAX_DELAY, host_concurrency=retry.DEFAULT_HOST_CONCURRENCY):
+        """
+        Configure the retries and per-host limits shared by all Command instances
+          retries - number of times a failed request is repeated
+          base_delay - seconds before the first retry; doubled for every later one
+          max_delay - longest backoff between two attempts, in seconds
+          host_concurrency - highest number of requests in flight to a single API host
+        """
+        Command.__retry_policy = retry.RetryPolicy(retries, base_delay, max_delay)
+        Command.__limiters = retry.HostLimiters(host_concurrency)
+
+    @staticmethod
+    def Limiter(host):
+        """
+        Retrieve the limiter of an API host (host[:port]) shared by all Command instances (see rcbu.common.retry.HostLimiter)
+        """
+        return Command.__limiters.Get(host)
+
+    @staticmethod
+    def LimiterStats():
+        """
+        Retrieve the adaptive limit of every API host (see rcbu.common.retry.HostLimiter.Stats)
+        """
+        return Command.__limiters.Stats()
+
+    @staticmethod
+    def Metrics():
+        """
+        Retrieve the request metrics of all Command instances (see rcbu.common.metrics.RequestMetrics)
+        """
+        return metrics.GetMetrics()
+
+    @staticmethod
+    def ConfigureConnectionPool(pool_hosts=DEFAULT_POOL_HOSTS, pool_size=DEFAULT_POOL_SIZE, host_pool_sizes=None, keep_alive=True):
+        """
+        Configure the connection pool shared by all Command instances
+          pool_hosts - number of API hosts to keep connection pools for
+          pool_size - number of connections kept open to each API host
+          host_pool_sizes - optional dictionary of API host to pool size overriding pool_size
+          keep_alive - False to close every connection after a single request
+
+        The shared session is rebuilt, closing any connection already open.
+        """
+        with Command.__session_lock:
+            Command.__pool_options = {
+                'pool_hosts': pool_hosts,
+                'pool_size': pool_size,
+                'host_pool_sizes': dict(host_pool_sizes or {}),
+                'keep_alive': keep_alive
+            }
+            if Command.__session is not None:
+                Command.__session.close()
+                Command.__session = None
+
+    @staticmethod
+    def Session():
+        """
+        Retrieve the requests.Session shared by all Command instances
+        """
+        with Command.__session_lock:
+            if Command.__session is None:
+                options = Command.__pool_options
+                session = requests.Session()
+                for scheme in ('http://', 'https://'):
+                    session.mount(scheme, metrics.TimedHTTPAdapter(pool_connections=options['pool_hosts'], pool_maxsize=options['pool_size']))
+                    for host, host_pool_size in options['host_pool_sizes'].items():
+                        session.mount(scheme + host, metrics.TimedHTTPAdapter(pool_connections=1, pool_maxsize=host_pool_size))
+                if not options['keep_alive']:
+                    session.headers['Connection'] = 'close'
+                Command.__session = session
+            return Command.__session
+
+    @staticmethod
+    def ConnectionStats():
+        """
+        Retrieve the connection reuse counters of the shared session
+
+        Returns a dictionary keyed by API host, each entry holding:
+            'requests' - number of requests issued to the host
+            'connections' - number of connections opened to the host
+            'reused' - number of requests that were sent over an already open connection
+        """
+        stats = {}
+        session = Command.Session()
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for pool_key in pools.keys():
+                pool = pools[pool_key]
+                host_stats = stats.setdefault(pool.host, {'requests': 0, 'connections': 0, 'reused': 0})
+                host_stats['requests'] += pool.num_requests
+                host_stats['connections'] += pool.num_connections
+                host_stats['reused'] = max(0, host_stats['requests'] - host_stats['connections'])
+        return stats
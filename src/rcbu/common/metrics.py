@@ -0,0 +1,394 @@
+"""
+RCBU Request Metrics
+
+Every HTTP request issued through rcbu.common.command.Command is timed by a
+RequestTimer and aggregated per endpoint (metric name and host) into latency
+histograms and counters:
+
+    dns - name resolution, when a new connection is opened
+    connect - TCP connection establishment, when a new connection is opened
+    tls - TLS handshake, when a new HTTPS connection is opened
+    first-byte - from sending the request until the response headers are received
+    total - from sending the request until the response body is consumed
+
+The aggregate can be exported as JSON (Snapshot/ToJson) or in the Prometheus
+text exposition format (ToPrometheus).
+"""
+import json
+import socket
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+
+PHASES = ('dns', 'connect', 'tls', 'first-byte', 'total')
+# Upper bounds (seconds) of the latency histogram buckets; the last bucket is +Inf
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+FORMAT_JSON = 'json'
+FORMAT_PROMETHEUS = 'prometheus'
+FORMAT_CHOICES = (FORMAT_JSON, FORMAT_PROMETHEUS)
+
+# Timer of the request being sent by the current thread, if any; the connection
+# classes below record the connection phases into it
+_current = threading.local()
+
+
+class Histogram(object):
+    """
+    Cumulative latency histogram in the style of Prometheus
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+          buckets - sorted upper bounds of the buckets in seconds
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def Observe(self, value):
+        """
+        Add a single observation
+        """
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def Snapshot(self):
+        """
+        Dictionary of 'buckets' (upper bound, cumulative count), 'sum' and 'count'
+        """
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            cumulative += count
+            buckets.append([bound, cumulative])
+        return {'buckets': buckets, 'sum': self.sum, 'count': self.count}
+
+
+class EndpointMetrics(object):
+    """
+    Aggregate of the requests made to a single endpoint
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.histograms = dict((phase, Histogram(buckets)) for phase in PHASES)
+        self.requests = 0
+        self.errors = 0
+        self.status_codes = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.retries = 0
+        self.connections = 0
+
+    def Snapshot(self):
+        """
+        Dictionary form of the aggregate
+        """
+        snapshot = {}
+        snapshot['requests'] = self.requests
+        snapshot['errors'] = self.errors
+        snapshot['status-codes'] = dict((str(status), count) for status, count in self.status_codes.items())
+        snapshot['bytes-sent'] = self.bytes_sent
+        snapshot['bytes-received'] = self.bytes_received
+        snapshot['retries'] = self.retries
+        snapshot['connections'] = self.connections
+        snapshot['timings'] = dict((phase, histogram.Snapshot()) for phase, histogram in self.histograms.items())
+        return snapshot
+
+
+class RequestMetrics(object):
+    """
+    Thread-safe registry of the per endpoint request aggregates
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.endpoints = {}
+
+    def Reset(self):
+        """
+        Discard everything recorded so far
+        """
+        with self.lock:
+            self.endpoints = {}
+
+    def Record(self, timer):
+        """
+        Add a finished RequestTimer to its endpoint aggregate
+        """
+        with self.lock:
+            key = (timer.metric, timer.host)
+            endpoint = self.endpoints.get(key)
+            if endpoint is None:
+                endpoint = self.endpoints[key] = EndpointMetrics(self.buckets)
+            endpoint.requests += 1
+            if timer.status is None:
+                endpoint.errors += 1
+            else:
+                endpoint.status_codes[timer.status] = endpoint.status_codes.get(timer.status, 0) + 1
+            endpoint.bytes_sent += timer.bytes_sent
+            endpoint.bytes_received += timer.bytes_received
+            endpoint.retries += timer.retries
+            if 'connect' in timer.timings:
+                endpoint.connections += 1
+            for phase, value in timer.timings.items():
+                endpoint.histograms[phase].Observe(value)
+
+    def Snapshot(self):
+        """
+        List of dictionaries, one per endpoint, with 'metric' and 'host' and the
+        aggregate (see EndpointMetrics.Snapshot)
+        """
+        with self.lock:
+            snapshot = []
+            for (metric, host), endpoint in sorted(self.endpoints.items()):
+                entry = endpoint.Snapshot()
+                entry['metric'] = metric
+                entry['host'] = host
+                snapshot.append(entry)
+            return snapshot
+
+    def ToJson(self):
+        """
+        JSON text of Snapshot()
+        """
+        return json.dumps({'time': time.time(), 'endpoints': self.Snapshot()}, indent=4, sort_keys=True)
+
+    def ToPrometheus(self):
+        """
+        Prometheus text exposition format of the aggregate
+        """
+        lines = []
+        counters = (
+            ('cloudfiles_requests_total', 'requests', 'Requests issued'),
+            ('cloudfiles_request_errors_total', 'errors', 'Requests that failed without a response'),
+            ('cloudfiles_request_retries_total', 'retries', 'Requests that were retries of an earlier request'),
+            ('cloudfiles_connections_total', 'connections', 'Connections opened'),
+            ('cloudfiles_request_bytes_sent_total', 'bytes-sent', 'Request body bytes sent'),
+            ('cloudfiles_response_bytes_received_total', 'bytes-received', 'Response body bytes received'))
+        snapshot = self.Snapshot()
+        for name, key, description in counters:
+            lines.append('# HELP ' + name + ' ' + description)
+            lines.append('# TYPE ' + name + ' counter')
+            for entry in snapshot:
+                lines.append('{0}{{{1}}} {2}'.format(name, _Labels(entry), entry[key]))
+
+        name = 'cloudfiles_responses_total'
+        lines.append('# HELP ' + name + ' Responses received by status code')
+        lines.append('# TYPE ' + name + ' counter')
+        for entry in snapshot:
+            for status, count in sorted(entry['status-codes'].items()):
+                lines.append('{0}{{{1},code="{2}"}} {3}'.format(name, _Labels(entry), status, count))
+
+        name = 'cloudfiles_request_duration_seconds'
+        lines.append('# HELP ' + name + ' Request latency by phase')
+        lines.append('# TYPE ' + name + ' histogram')
+        for entry in snapshot:
+            for phase in PHASES:
+                histogram = entry['timings'][phase]
+                labels = '{0},phase="{1}"'.format(_Labels(entry), phase)
+                for bound, count in histogram['buckets']:
+                    lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(name, labels, bound, count))
+                lines.append('{0}_sum{{{1}}} {2}'.format(name, labels, repr(histogram['sum'])))
+                lines.append('{0}_count{{{1}}} {2}'.format(name, labels, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def Export(self, path, export_format=FORMAT_JSON):
+        """
+        Write the aggregate to path as JSON or Prometheus text
+        """
+        if export_format == FORMAT_PROMETHEUS:
+            text = self.ToPrometheus()
+        else:
+            text = self.ToJson()
+        with open(path, 'w') as metrics_file:
+            metrics_file.write(text)
+
+
+def _Labels(entry):
+    """
+    Prometheus labels of an endpoint
+    """
+    return 'metric="{0}",host="{1}"'.format(_Escape(entry['metric']), _Escape(entry['host']))
+
+
+def _Escape(value):
+    """
+    Escape a Prometheus label value
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+_registry = RequestMetrics()
+
+
+def GetMetrics():
+    """
+    Retrieve the registry shared by all Command instances
+    """
+    return _registry
+
+
+class RequestTimer(object):
+    """
+    Timings of a single HTTP request
+
+    Started by Command before the request is sent; finished once the response
+    body has been consumed, at which point it is added to the registry.
+    """
+
+    def __init__(self, metric, host, method, retries=0):
+        """
+          metric - name of the API call, e.g. 'identity' or 'object-download'
+          host - API host the request is sent to
+          method - HTTP method
+          retries - number of earlier attempts of the same request
+        """
+        self.metric = metric
+        self.host = host
+        self.method = method
+        self.retries = retries
+        self.status = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.timings = {}
+        self.start_time = time.time()
+        self.finished = False
+
+    def __enter__(self):
+        _current.timer = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current.timer = None
+        if exc_type is not None:
+            # No response; the request is recorded as an error
+            self.Finish()
+
+    def Phase(self, phase, seconds):
+        """
+        Record the duration of a connection phase
+        """
+        self.timings[phase] = self.timings.get(phase, 0.0) + seconds
+
+    def Response(self, res):
+        """
+        Record the response headers being received
+        """
+        self.status = res.status_code
+        self.timings['first-byte'] = time.time() - self.start_time
+        body = res.request.body
+        if body is not None:
+            self.bytes_sent = len(body)
+
+    def Finish(self, bytes_received=None):
+        """
+        Record the response body being consumed and add the request to the registry
+          bytes_received - body bytes received
+        """
+        if self.finished:
+            return
+        self.finished = True
+        self.timings['total'] = time.time() - self.start_time
+        if bytes_received is not None:
+            self.bytes_received = bytes_received
+        _registry.Record(self)
+
+
+def _CurrentTimer():
+    """
+    RequestTimer of the request being sent by the current thread; None if not timed
+    """
+    return getattr(_current, 'timer', None)
+
+
+class _TimedConnectionMixin(object):
+    """
+    Records the dns, connect and tls phases of new connections into the current RequestTimer
+    """
+
+    def _new_conn(self):
+        timer = _CurrentTimer()
+        dns_host = getattr(self, '_dns_host', None)
+        if timer is None or dns_host is None:
+            return super(_TimedConnectionMixin, self)._new_conn()
+
+        # Resolve separately so that name resolution and the TCP connect can be
+        # timed apart, then connect to each address in turn as urllib3 would
+        start_time = time.time()
+        try:
+            addresses = socket.getaddrinfo(dns_host, self.port, 0, socket.SOCK_STREAM)
+        except socket.gaierror:
+            addresses = []
+        timer.Phase('dns', time.time() - start_time)
+
+        start_time = time.time()
+        try:
+            if not len(addresses):
+                # Let urllib3 raise its own resolution error
+                return super(_TimedConnectionMixin, self)._new_conn()
+            last_error = None
+            for address in addresses:
+                self._dns_host = address[4][0]
+                try:
+                    return super(_TimedConnectionMixin, self)._new_conn()
+                except (NewConnectionError, ConnectTimeoutError) as ex:
+                    last_error = ex
+            raise last_error
+        finally:
+            self._dns_host = dns_host
+            timer.Phase('connect', time.time() - start_time)
+
+    def connect(self):
+        timer = _CurrentTimer()
+        if timer is None:
+            return super(_TimedConnectionMixin, self).connect()
+        start_time = time.time()
+        opened = dict((phase, timer.timings.get(phase, 0.0)) for phase in ('dns', 'connect'))
+        super(_TimedConnectionMixin, self).connect()
+        if isinstance(self, HTTPSConnection):
+            # The handshake is whatever connect() spent beyond resolving and connecting
+            elapsed = time.time() - start_time
+            for phase in ('dns', 'connect'):
+                elapsed -= timer.timings.get(phase, 0.0) - opened[phase]
+            timer.Phase('tls', max(0.0, elapsed))
+
+
+class TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    """HTTP connection recording its connection phases"""
+    pass
+
+
+class TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    """HTTPS connection recording its connection phases"""
+    pass
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    """HTTP connection pool of TimedHTTPConnection"""
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    """HTTPS connection pool of TimedHTTPSConnection"""
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """
+    requests transport adapter whose connections record their connection phases
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
@@ -0,0 +1,225 @@
+"""
+RCBU Request Retries and Per-Host Rate Limiting
+
+Every request sent through rcbu.common.command.Command is retried under a
+RetryPolicy (exponential backoff with full jitter, honouring Retry-After) and
+admitted by the HostLimiter of its API host. The limiter allows up to a fixed
+number of requests in flight per host and adapts to the responses: the limit is
+halved when the host throttles (429/503) and grows back by one for every limit
+successful responses, so a heavy parallel workload settles at the highest rate
+the cluster sustains instead of failing or hammering it.
+"""
+import email.utils
+import random
+import threading
+import time
+
+import requests
+
+
+DEFAULT_RETRIES = 5
+# Seconds before the first retry; doubled for every later one
+DEFAULT_BASE_DELAY = 0.5
+DEFAULT_MAX_DELAY = 30.0
+# Longest Retry-After honoured, in seconds
+MAX_RETRY_AFTER = 300.0
+# Requests in flight to a single API host
+DEFAULT_HOST_CONCURRENCY = 64
+
+# Statuses that are worth repeating a request for
+RETRY_STATUS = frozenset([408, 429, 500, 502, 503, 504])
+# Statuses telling the client to slow down
+THROTTLE_STATUS = frozenset([429, 503])
+
+# Connection failures and timeouts are retried; other request errors are not
+RETRY_EXCEPTIONS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+# Seconds between two TryAcquire() calls of a caller that can not wait on the limiter
+POLL_INTERVAL = 0.01
+
+
+def ParseRetryAfter(value):
+    """
+    Convert a Retry-After header (seconds or an HTTP date) to seconds from now
+
+    Returns None if there is no usable value
+    """
+    if value is None:
+        return None
+    try:
+        return min(MAX_RETRY_AFTER, max(0.0, float(value)))
+    except ValueError:
+        pass
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return min(MAX_RETRY_AFTER, max(0.0, email.utils.mktime_tz(parsed) - time.time()))
+
+
+class RetryPolicy(object):
+    """
+    When and after how long a failed request is repeated
+    """
+
+    def __init__(self, retries=DEFAULT_RETRIES, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY, retry_status=RETRY_STATUS):
+        """
+          retries - number of times a request is repeated before giving up
+          base_delay - seconds before the first retry; doubled for every later one
+          max_delay - longest backoff between two attempts, in seconds
+          retry_status - HTTP statuses that are retried
+        """
+        self.retries = max(0, int(retries))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_status = frozenset(retry_status)
+
+    def IsRetryable(self, res):
+        """
+        Determine whether a response asks for the request to be repeated
+        """
+        return res.status_code in self.retry_status
+
+    def Delay(self, attempt, res=None):
+        """
+        Seconds to wait before retrying
+          attempt - number of the retry (0 for the first one)
+          res - response that failed, if any; its Retry-After is honoured
+
+        The backoff is drawn uniformly up to the exponential bound ("full jitter")
+        so that clients failing together do not all come back at the same time.
+        """
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if res is not None:
+            retry_after = ParseRetryAfter(res.headers.get('Retry-After'))
+            if retry_after is not None:
+                delay = retry_after + random.uniform(0, self.base_delay)
+        return delay
+
+
+# Policy of requests that must not be repeated
+NO_RETRY = RetryPolicy(retries=0)
+
+
+class HostLimiter(object):
+    """
+    Adaptive limit of the requests in flight to a single API host
+
+    The limit is halved (at most once per second) when the host responds with a
+    throttling status and raised by one after every limit successful responses. A
+    Retry-After on a throttling response holds back every new request to the host.
+
+    The limit applies to request starts, not to transfers: the room is returned as
+    soon as the response headers arrive, so streamed bodies (object downloads and
+    listings) being read do not count against it. A throttling host still slows
+    down the start of every new request, including downloads; the number of
+    transfers running at the same time is bounded by their callers (e.g. the
+    download concurrency and workers) and by the connection pool.
+    """
+
+    def __init__(self, max_concurrency=DEFAULT_HOST_CONCURRENCY):
+        """
+          max_concurrency - highest number of requests in flight to the host
+        """
+        self.condition = threading.Condition()
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.limit = self.max_concurrency
+        self.in_flight = 0
+        self.successes = 0
+        self.resume_at = 0.0
+        self.last_decrease = 0.0
+        self.throttled = 0
+
+    @property
+    def Limit(self):
+        """Current number of requests allowed in flight"""
+        return self.limit
+
+    def Acquire(self):
+        """
+        Wait for room to send a request to the host
+        """
+        with self.condition:
+            while True:
+                wait = self.resume_at - time.time()
+                if wait > 0:
+                    self.condition.wait(wait)
+                elif self.in_flight >= self.limit:
+                    self.condition.wait()
+                else:
+                    break
+            self.in_flight += 1
+
+    def TryAcquire(self):
+        """
+        Take room to send a request to the host without waiting, for callers that must
+        not block (e.g. an asyncio event loop)
+
+        Returns 0.0 if the room was taken; otherwise the seconds to wait before trying again
+        """
+        with self.condition:
+            wait = self.resume_at - time.time()
+            if wait > 0:
+                return wait
+            if self.in_flight >= self.limit:
+                return POLL_INTERVAL
+            self.in_flight += 1
+            return 0.0
+
+    def Release(self, res=None):
+        """
+        Return the room taken by Acquire() once the response (None on failure) is received
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if res is not None and res.status_code in THROTTLE_STATUS:
+                now = time.time()
+                self.throttled += 1
+                self.successes = 0
+                # Responses already in flight report the same congestion; react once
+                if now - self.last_decrease >= 1.0:
+                    self.limit = max(1, self.limit // 2)
+                    self.last_decrease = now
+                retry_after = ParseRetryAfter(res.headers.get('Retry-After'))
+                if retry_after is not None:
+                    self.resume_at = max(self.resume_at, now + retry_after)
+            elif res is not None and res.status_code < 500:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+    def Stats(self):
+        """
+        Dictionary of the current 'limit', 'in-flight' requests and 'throttled' responses
+        """
+        with self.condition:
+            return {'limit': self.limit, 'in-flight': self.in_flight, 'throttled': self.throttled}
+
+
+class HostLimiters(object):
+    """
+    The HostLimiter of every API host
+    """
+
+    def __init__(self, max_concurrency=DEFAULT_HOST_CONCURRENCY):
+        self.lock = threading.Lock()
+        self.max_concurrency = max_concurrency
+        self.limiters = {}
+
+    def Get(self, host):
+        """
+        Retrieve the limiter of an API host (host[:port])
+        """
+        with self.lock:
+            limiter = self.limiters.get(host)
+            if limiter is None:
+                limiter = self.limiters[host] = HostLimiter(self.max_concurrency)
+            return limiter
+
+    def Stats(self):
+        """
+        Dictionary of API host to its limiter statistics (see HostLimiter.Stats)
+        """
+        with self.lock:
+            limiters = dict(self.limiters)
+        return dict((host, limiter.Stats()) for host, limiter in limiters.items())